@@ -0,0 +1,293 @@
+#! /usr/bin/env python
+# script to microbenchmark the SQL node-assignment backend
+import os
+import time
+import uuid
+import pstats
+import cProfile
+import optparse
+import threading
+
+from mozsvc.exceptions import BackendError
+from sqlalchemy.sql import text as sqltext
+from sqlalchemy.sql.compiler import SQLCompiler
+
+from tokenserver.assignment.sqlnode import SQLNodeAssignment
+
+
+NODE = "https://node.example.com"
+
+# The unconditional update that get_best_node() used to make after picking a
+# node, for comparison with its current conditional one.
+_ADD_NODE_LOAD = sqltext("""\
+update
+    nodes
+set
+    current_load = current_load + 1,
+    available = case when available > 0 then available - 1 else 0 end
+where
+    id = :nodeid
+""")
+
+_GET_NODE_LOAD = sqltext("""\
+select
+    current_load, capacity
+from
+    nodes
+where
+    service = :service and node = :node
+""")
+
+
+class NullCache(dict):
+    """A compiled_cache that never keeps anything."""
+
+    def __setitem__(self, key, value):
+        pass
+
+
+def setup_service(backend, capacity=100):
+    """Add a fresh service with a single node, returning the service name.
+
+    Using a fresh service for each run means that runs can share a database.
+    """
+    service = "bench-" + uuid.uuid4().hex
+    backend.add_service(service, "{node}/1.5/{uid}")
+    backend.add_node(service, NODE, capacity, available=capacity)
+    return service
+
+
+def bench_allocation(backend, service, iterations):
+    """Repeatedly assign users to nodes, as on the request path.
+
+    Each iteration picks the best node (which updates its load) and then
+    adjusts the node's settings, so that it never runs out of capacity.
+    """
+    for i in xrange(iterations):
+        backend.get_best_node(service, "%d@example.com" % (i,))
+        backend.update_node(service, NODE, available=100, current_load=0)
+
+
+def run_compile_bench(sqluri, iterations, compiled_cache=True):
+    """Run the allocation benchmark, returning (seconds, statement compiles).
+
+    :param sqluri: the sqluri string used to connect to the database
+    :param iterations: the number of allocations to perform
+    :param compiled_cache: whether to re-use compiled statements
+    """
+    backend = SQLNodeAssignment(sqluri, create_tables=True)
+    if not compiled_cache:
+        backend._engine = backend._engine.execution_options(
+            compiled_cache=NullCache())
+    service = setup_service(backend)
+    # Warm up any caches before we start measuring.
+    bench_allocation(backend, service, 10)
+
+    profiler = cProfile.Profile()
+    start = time.time()
+    profiler.runcall(bench_allocation, backend, service, iterations)
+    elapsed = time.time() - start
+
+    # Count the calls to SQLCompiler.__init__ seen by the profiler.
+    code = SQLCompiler.__init__.im_func.func_code
+    key = (code.co_filename, code.co_firstlineno, code.co_name)
+    stats = pstats.Stats(profiler).stats
+    compiles = stats[key][1] if key in stats else 0
+    return elapsed, compiles
+
+
+def compile_bench(sqluri, opts):
+    """Compare allocation with and without the compiled statement cache."""
+    for compiled_cache in (False, True):
+        elapsed, compiles = run_compile_bench(sqluri, opts.iterations,
+                                              compiled_cache)
+        print("compiled_cache=%s: %d compiles, %.1f usec per allocation" % (
+            compiled_cache, compiles, elapsed * 1000000 / opts.iterations))
+
+
+def bench_token_requests(backend, service, thread_id, iterations, errors):
+    """Simulate the db traffic of token requests from a single thread.
+
+    Each iteration looks up (or creates) a user and then bumps their
+    generation number, as happens when a client re-authenticates.  Any
+    requests that fail with a BackendError are appended to `errors`.
+    """
+    for i in xrange(iterations):
+        email = "%d-%d@example.com" % (thread_id, i % 100)
+        try:
+            user = backend.get_or_create_user(service, email)
+            backend.update_user(service, user, generation=i + 1)
+        except BackendError, e:
+            errors.append(e)
+
+
+def run_sqlite_bench(sqluri, iterations, threads, performance_mode):
+    """Run concurrent token requests, returning (requests/second, errors).
+
+    :param sqluri: the sqluri string used to connect to the database
+    :param iterations: the number of requests to make from each thread
+    :param threads: the number of concurrent threads
+    :param performance_mode: whether to use SQLite performance mode
+    """
+    backend = SQLNodeAssignment(sqluri, create_tables=True,
+                                sqlite_performance_mode=performance_mode)
+    service = setup_service(backend, capacity=threads * 100)
+    errors = []
+    workers = [
+        threading.Thread(target=bench_token_requests,
+                         args=(backend, service, n, iterations, errors))
+        for n in xrange(threads)
+    ]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+    backend._engine.dispose()
+    return threads * iterations / elapsed, len(errors)
+
+
+def sqlite_bench(sqluri, opts):
+    """Compare token-request throughput with and without performance mode."""
+    for performance_mode in (False, True):
+        rate, errors = run_sqlite_bench(sqluri, opts.iterations,
+                                        opts.threads, performance_mode)
+        print("sqlite_performance_mode=%s: %.1f requests per second, "
+              "%d errors" % (performance_mode, rate, errors))
+
+
+def select_then_update(backend, service, email):
+    """Assign a node by picking one and then updating its load separately.
+
+    This is how get_best_node() used to work, and lets concurrent workers
+    that picked the same node all take a slot on it.
+    """
+    res = backend._safe_execute(backend._get_least_loaded_node_query,
+                                service=service)
+    row = res.fetchone()
+    res.close()
+    if row is None:
+        raise BackendError('unable to get a node')
+    backend._safe_execute(_ADD_NODE_LOAD, nodeid=row.id).close()
+    return row.id, str(row.node)
+
+
+def bench_node_claims(get_best_node, service, thread_id, iterations,
+                      latencies, errors):
+    """Assign nodes to new users from a single thread, timing each one."""
+    for i in xrange(iterations):
+        email = "%d-%d@example.com" % (thread_id, i)
+        start = time.time()
+        try:
+            get_best_node(service, email)
+        except BackendError, e:
+            errors.append(e)
+        else:
+            latencies.append(time.time() - start)
+
+
+def run_contention_bench(sqluri, iterations, threads, atomic):
+    """Run concurrent node assignments against a node with too few slots.
+
+    Returns (overshoot, latencies), where overshoot is the number of users
+    assigned to the node beyond its capacity and latencies is the sorted
+    list of times taken by each successful assignment.
+
+    :param sqluri: the sqluri string used to connect to the database
+    :param iterations: the number of assignments to make from each thread
+    :param threads: the number of concurrent threads
+    :param atomic: whether to claim slots atomically, or the old way
+    """
+    backend = SQLNodeAssignment(sqluri, create_tables=True)
+    # Only offer slots for half of the users, so they have to compete.
+    capacity = max(threads * iterations // 2, 1)
+    service = setup_service(backend, capacity)
+    if atomic:
+        def get_best_node(service, email):
+            return backend.get_best_node(service, email)
+    else:
+        def get_best_node(service, email):
+            return select_then_update(backend, service, email)
+    latencies = []
+    errors = []
+    workers = [
+        threading.Thread(target=bench_node_claims,
+                         args=(get_best_node, service, n, iterations,
+                               latencies, errors))
+        for n in xrange(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    res = backend._safe_execute(_GET_NODE_LOAD, service=service, node=NODE)
+    row = res.fetchone()
+    res.close()
+    backend._engine.dispose()
+    latencies.sort()
+    return max(row.current_load - row.capacity, 0), latencies
+
+
+def contention_bench(sqluri, opts):
+    """Compare node assignment under contention with and without claims."""
+    for atomic in (False, True):
+        overshoot, latencies = run_contention_bench(
+            sqluri, opts.iterations, opts.threads, atomic)
+        if latencies:
+            p50 = latencies[len(latencies) // 2] * 1000
+            p99 = latencies[len(latencies) * 99 // 100] * 1000
+        else:
+            p50 = p99 = 0
+        print("atomic=%s: %d assigned, overshoot %d, "
+              "p50 %.2f msec, p99 %.2f msec" % (
+                  atomic, len(latencies), overshoot, p50, p99))
+
+
+BENCHMARKS = {
+    "compile": compile_bench,
+    "contention": contention_bench,
+    "sqlite": sqlite_bench,
+}
+
+
+def main():
+    """Run the named benchmark against the given database.
+
+    Example use:
+
+        python microbench.py --iterations=1000 compile mysql://u:p@host/db
+        python microbench.py --threads=8 sqlite
+        python microbench.py --threads=16 contention mysql://u:p@host/db
+
+    If no sqluri is given, a temporary sqlite database is used.
+    """
+    usage = "usage: %%prog [options] {%s} [sqluri]" % "|".join(
+        sorted(BENCHMARKS))
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--iterations", type="int", default=1000,
+                      help="Number of operations to perform per thread")
+    parser.add_option("", "--threads", type="int", default=4,
+                      help="Number of concurrent threads, where applicable")
+
+    opts, args = parser.parse_args()
+    if not 1 <= len(args) <= 2 or args[0] not in BENCHMARKS:
+        parser.print_usage()
+        return 1
+    if len(args) > 1:
+        BENCHMARKS[args[0]](args[1], opts)
+        return 0
+
+    path = "/tmp/tokenserver.bench." + uuid.uuid4().hex
+    try:
+        BENCHMARKS[args[0]]("sqlite:///" + path, opts)
+    finally:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -0,0 +1,108 @@
+#! /usr/bin/env python
+# script to compare the load spread produced by node selection policies
+import math
+import random
+import optparse
+from collections import namedtuple
+
+from tokenserver.assignment.sqlnode.selection import NODE_SELECTION_POLICIES
+
+
+Node = namedtuple('Node', ('node', 'current_load', 'capacity', 'available'))
+
+
+def simulate(policy, nodes, users, workers, refresh_interval, rand):
+    """Simulate assigning new users to nodes from several workers.
+
+    Each worker chooses from its own snapshot of the nodes, which it only
+    refreshes every `refresh_interval` users, as happens when many workers
+    assign users before the load they've added becomes visible.  Workers
+    take turns assigning one user each.  Returns the final load of each
+    node, and the largest number of users sent to a single node by the
+    workers between two refreshes.
+
+    :param policy: the node selection policy to use
+    :param nodes: a list of (current_load, capacity) pairs
+    :param users: the number of new users to assign
+    :param workers: the number of concurrent workers
+    :param refresh_interval: users assigned by a worker between refreshes
+    :param rand: the random.Random instance to use
+    """
+    loads = [current_load for current_load, _ in nodes]
+    capacities = [capacity for _, capacity in nodes]
+
+    def take_snapshot():
+        return [Node(i, loads[i], capacities[i], capacities[i] - loads[i])
+                for i in xrange(len(nodes)) if loads[i] < capacities[i]]
+
+    snapshots = [take_snapshot() for _ in xrange(workers)]
+    window = [0] * len(nodes)
+    max_burst = 0
+    for n in xrange(users):
+        worker = n % workers
+        if n and n % (workers * refresh_interval) == 0:
+            snapshots = [take_snapshot() for _ in xrange(workers)]
+            window = [0] * len(nodes)
+        if not snapshots[worker]:
+            break
+        i = policy(snapshots[worker], rand).node
+        if loads[i] >= capacities[i]:
+            # The claim failed, as the node filled up since the snapshot.
+            snapshots[worker] = take_snapshot()
+            continue
+        loads[i] += 1
+        window[i] += 1
+        max_burst = max(max_burst, window[i])
+    return [load * 1.0 / capacity
+            for load, capacity in zip(loads, capacities)], max_burst
+
+
+def main():
+    """Compare the load spread of each node selection policy.
+
+    Example use:
+
+        python simulate-node-selection.py --nodes=20 --users=100000
+
+    Nodes start with a random load of up to half their capacity, and the
+    spread is reported as the standard deviation and range of the final
+    proportion of each node's capacity that is in use.
+    """
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--nodes", type="int", default=10,
+                      help="Number of nodes")
+    parser.add_option("", "--capacity", type="int", default=10000,
+                      help="Capacity of each node")
+    parser.add_option("", "--users", type="int", default=20000,
+                      help="Number of new users to assign")
+    parser.add_option("", "--workers", type="int", default=16,
+                      help="Number of concurrent workers")
+    parser.add_option("", "--refresh-interval", type="int", default=10,
+                      help="Users assigned by a worker between refreshes")
+    parser.add_option("", "--seed", type="int", default=0,
+                      help="Seed for the random number generator")
+
+    opts, args = parser.parse_args()
+    if args:
+        parser.print_usage()
+        return 1
+
+    rand = random.Random(opts.seed)
+    nodes = [(rand.randint(0, opts.capacity // 2), opts.capacity)
+             for _ in xrange(opts.nodes)]
+    for name in sorted(NODE_SELECTION_POLICIES):
+        policy = NODE_SELECTION_POLICIES[name]
+        loads, max_burst = simulate(policy, nodes, opts.users, opts.workers,
+                                    opts.refresh_interval,
+                                    random.Random(opts.seed))
+        mean = sum(loads) / len(loads)
+        stddev = math.sqrt(sum((l - mean) ** 2 for l in loads) / len(loads))
+        print("%s: stddev %.4f, range %.4f-%.4f, max burst %d" % (
+            name, stddev, min(loads), max(loads), max_burst))
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -32,6 +32,27 @@ class INodeAssignment(Interface):
         for the get_user() method.
         """
 
+    def allocate_users(self, service, emails, node=None):
+        """Create new user records for each of the given emails.
+
+        Emails that already have a user record for the service are skipped.
+        The newly-created user records are returned as a list, in the format
+        described for the get_user() method.
+        """
+
+    def get_or_create_user(self, service, email, generation=0,
+                           client_state='', keys_changed_at=0):
+        """Returns the user record for the given service and email,
+        creating a new one if it does not exist.
+
+        This is equivalent to calling get_user() and then allocate_user()
+        if no record was found, but allows the backend to perform both
+        steps as a single operation.  The time taken by each step is still
+        reported in the request metrics, as `tokenserver.backend.get_user`
+        and `tokenserver.backend.allocate_user`.  The user record is
+        returned in the format described for the get_user() method.
+        """
+
     def update_user(self, service, user, generation=None, client_state=None,
                     keys_changed_at=None, node=None):
         """Update the user record for the given service.
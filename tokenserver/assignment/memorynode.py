@@ -4,6 +4,7 @@ from tokenserver.assignment import INodeAssignment
 from tokenserver.util import get_timestamp
 
 from mozsvc.exceptions import BackendError
+from mozsvc.metrics import metrics_timer
 
 
 class MemoryNodeAssignmentBackend(object):
@@ -49,6 +50,23 @@ class MemoryNodeAssignmentBackend(object):
         self._next_uid += 1
         return user.copy()
 
+    def allocate_users(self, service, emails, node=None):
+        users = []
+        for email in emails:
+            if (service, email) not in self._users:
+                users.append(self.allocate_user(service, email, node=node))
+        return users
+
+    def get_or_create_user(self, service, email, generation=0,
+                           client_state='', keys_changed_at=0):
+        with metrics_timer('tokenserver.backend.get_user'):
+            user = self.get_user(service, email)
+        if user is None:
+            with metrics_timer('tokenserver.backend.allocate_user'):
+                user = self.allocate_user(service, email, generation,
+                                          client_state, keys_changed_at)
+        return user
+
     def update_user(self, service, user, generation=None, client_state=None,
                     keys_changed_at=None, node=None):
         if (service, user['email']) not in self._users:
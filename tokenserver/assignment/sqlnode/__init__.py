@@ -1 +1,2 @@
 from tokenserver.assignment.sqlnode.sql import SQLNodeAssignment  # NOQA
+from tokenserver.assignment.sqlnode.sharded import ShardedSQLNodeAssignment  # NOQA
@@ -0,0 +1,37 @@
+"""add user history summary columns
+
+Revision ID: 1312f685728c
+Revises: 5d056c5b8f57
+Create Date: 2026-10-17 09:12:41.302117
+
+This adds columns summarizing each user's history to their active record,
+so that it can be used without reading their older records.  Existing
+records still work without a summary, they just need the full history to be
+read, after which the summary is filled in.  To fill them in ahead of time,
+run the tokenserver.scripts.backfill_user_history script once this has been
+applied.  It commits as it goes and can be resumed, so it's not done here
+in the migration's single transaction.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '1312f685728c'
+down_revision = '5d056c5b8f57'
+
+
+def upgrade():
+    op.add_column(
+        'users',
+        sa.Column('old_client_states', sa.Text(), nullable=True)
+    )
+    op.add_column(
+        'users',
+        sa.Column('first_seen_at', sa.BigInteger(), nullable=True)
+    )
+
+
+def downgrade():
+    op.drop_column('users', 'first_seen_at')
+    op.drop_column('users', 'old_client_states')
@@ -14,7 +14,7 @@ We have the following tables:
 """
 
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy import Column, Integer, String, BigInteger, Index
+from sqlalchemy import Column, Integer, String, BigInteger, Index, Text
 
 
 bases = {}
@@ -39,6 +39,11 @@ class _UsersBase(object):
     A user is uniquely identified by their email.  For each service they have
     a uid, an allocated node, and last-seen generation and client-state values.
     Rows are timestamped for easy cleanup of old records.
+
+    Each record also carries a summary of the user's history, so that the
+    active record can be used without reading any older ones: a JSON list of
+    previously-seen client-state values, and the time at which the user was
+    first seen.  These are null on records written before they were added.
     """
     uid = Column(BigInteger(), primary_key=True, autoincrement=True,
                  nullable=False)
@@ -50,6 +55,8 @@ class _UsersBase(object):
     replaced_at = Column(BigInteger(), nullable=True)
     nodeid = Column(BigInteger(), nullable=False)
     keys_changed_at = Column(BigInteger(), nullable=True)
+    old_client_states = Column(Text(), nullable=True)
+    first_seen_at = Column(BigInteger(), nullable=True)
 
     @declared_attr
     def __table_args__(cls):
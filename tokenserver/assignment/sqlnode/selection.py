@@ -0,0 +1,64 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Policies for choosing which node to assign a new user to.
+
+Each policy is a function taking a non-empty list of candidate nodes and
+returning the one to use.  Candidates are rows from the nodes table (or any
+objects with `current_load`, `capacity` and `available` attributes), and
+are only those nodes that can currently accept new users.
+
+Picking the least-loaded node sends every new user to the same node until
+its load is updated, so policies that spread users between the nodes that
+have room can give a more even load when many users arrive at once.
+"""
+import random
+
+
+def _load(node):
+    return node.current_load * 1.0 / node.capacity
+
+
+def _free_slots(node):
+    return max(min(node.available, node.capacity - node.current_load), 0)
+
+
+def least_loaded(nodes, rand=random):
+    """Pick the node with the lowest proportion of its capacity in use."""
+    return min(nodes, key=_load)
+
+
+def weighted_random(nodes, rand=random):
+    """Pick a node at random, weighted by its number of free slots."""
+    total = sum(_free_slots(node) for node in nodes)
+    if total <= 0:
+        return rand.choice(nodes)
+    target = rand.uniform(0, total)
+    for node in nodes:
+        target -= _free_slots(node)
+        if target < 0:
+            return node
+    return nodes[-1]
+
+
+def power_of_two(nodes, rand=random):
+    """Pick two nodes at random, and use the less loaded of them."""
+    if len(nodes) < 2:
+        return nodes[0]
+    return least_loaded(rand.sample(nodes, 2))
+
+
+NODE_SELECTION_POLICIES = {
+    'least_loaded': least_loaded,
+    'weighted_random': weighted_random,
+    'power_of_two': power_of_two,
+}
+
+
+def get_node_selection_policy(name):
+    """Get the node selection policy with the given name."""
+    try:
+        return NODE_SELECTION_POLICIES[name]
+    except KeyError:
+        raise ValueError("Unknown node_selection_policy: %r" % (name,))
@@ -0,0 +1,335 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Sharded SQLAlchemy-based node-assignment database.
+
+This spreads users across several independent node-assignment databases,
+picking the database for each user by a stable hash of their email.  Each
+shard is a complete database in its own right, with its own copy of the
+services and nodes tables, so that user records can be joined to their node
+without leaving the shard.
+
+Node capacity is partitioned between the shards, so that each shard accounts
+for the load of its own users on a share of each node.  Since users are
+spread evenly by the hash, this keeps overall node load balanced.
+
+To keep uids globally unique, each shard-local uid is combined with the
+index of the shard that issued it, as `local_uid * num_shards + index`.
+With a single shard this leaves uids unchanged.
+
+Batched operations, such as unassigning a node, walk each shard's users in
+parallel, in order of their shard-local uids, so there's no single uid from
+which an interrupted run could be resumed on every shard.  A `start_uid` can
+only be given when there's a single shard; otherwise just re-run the
+operation, which skips the records that have already been done, or run it
+against each shard's database on its own.
+"""
+import hashlib
+from collections import namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from mozsvc.exceptions import BackendError
+from zope.interface import implements
+
+from tokenserver.assignment import INodeAssignment
+from tokenserver.assignment.sqlnode.sql import SQLNodeAssignment
+
+
+# Node fields that count users, and hence are split between the shards.
+_PARTITIONED_NODE_FIELDS = ("capacity", "available", "current_load")
+
+
+def _split_count(value, num_shards, index):
+    """Get the share of `value` that belongs to the shard at `index`."""
+    share, remainder = divmod(int(value), num_shards)
+    if index < remainder:
+        share += 1
+    return share
+
+
+class ShardedSQLNodeAssignment(object):
+
+    implements(INodeAssignment)
+
+    def __init__(self, shard_sqluris, **kw):
+        if isinstance(shard_sqluris, basestring):
+            shard_sqluris = shard_sqluris.split()
+        if not shard_sqluris:
+            raise ValueError("Must specify at least one shard_sqluris")
+        kw.pop('sqluri', None)
+        self.shards = [SQLNodeAssignment(uri, **kw) for uri in shard_sqluris]
+        self._pool = ThreadPool(len(self.shards))
+        self._row_types = {}
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self._pool.close()
+        self._pool.join()
+
+    #
+    # Helpers for routing and for translating uids.
+    #
+
+    def _get_shard_index(self, email):
+        digest = hashlib.sha1(email.encode('utf8')).hexdigest()
+        return int(digest, 16) % len(self.shards)
+
+    def _get_shard(self, email):
+        return self.shards[self._get_shard_index(email)]
+
+    def _to_global_uid(self, index, uid):
+        return uid * len(self.shards) + index
+
+    def _to_local_uid(self, uid):
+        """Returns the (shard, local_uid) pair for a global uid."""
+        local_uid, index = divmod(uid, len(self.shards))
+        return self.shards[index], local_uid
+
+    def _globalize_user(self, index, user):
+        if user is not None:
+            user['uid'] = self._to_global_uid(index, user['uid'])
+        return user
+
+    def _globalize_row(self, index, row):
+        keys = tuple(row.keys())
+        try:
+            row_type = self._row_types[keys]
+        except KeyError:
+            row_type = self._row_types[keys] = namedtuple('UserRecord', keys)
+        row = row_type(*row)
+        return row._replace(uid=self._to_global_uid(index, row.uid))
+
+    def _fan_out(self, func):
+        """Call func(index, shard) for every shard in parallel.
+
+        Returns the list of results, in shard order.
+        """
+        return self._pool.map(lambda i: func(i, self.shards[i]),
+                              range(len(self.shards)))
+
+    def _fan_out_batches(self, method, *args, **kwds):
+        """Call a batched node-management method on every shard.
+
+        The uids reported to any `progress` callback are translated to
+        global ones.  Returns the last uid processed if there's a single
+        shard, since only then can it be used to resume.
+        """
+        if kwds.get('start_uid') and len(self.shards) > 1:
+            raise ValueError("start_uid can't be used with more than one "
+                             "shard; re-run without it, or run against "
+                             "each shard's database on its own")
+        progress = kwds.pop('progress', None)
+
+        def call_method(i, shard):
+            shard_kwds = kwds.copy()
+            if progress is not None:
+                shard_kwds['progress'] = lambda last_uid, count: progress(
+                    self._to_global_uid(i, last_uid), count)
+            return getattr(shard, method)(*args, **shard_kwds)
+        results = self._fan_out(call_method)
+        if len(self.shards) == 1:
+            return results[0]
+
+    #
+    # Per-user operations, routed to the user's shard.
+    #
+
+    def should_allocate_to_spanner(self, email):
+        return self._get_shard(email).should_allocate_to_spanner(email)
+
+    def get_user(self, service, email, **kwds):
+        index = self._get_shard_index(email)
+        user = self.shards[index].get_user(service, email, **kwds)
+        return self._globalize_user(index, user)
+
+    def get_or_create_user(self, service, email, generation=0,
+                           client_state='', keys_changed_at=0):
+        index = self._get_shard_index(email)
+        user = self.shards[index].get_or_create_user(
+            service, email, generation, client_state, keys_changed_at)
+        return self._globalize_user(index, user)
+
+    def allocate_user(self, service, email, generation=0, client_state='',
+                      keys_changed_at=0, node=None, timestamp=None):
+        index = self._get_shard_index(email)
+        user = self.shards[index].allocate_user(
+            service, email, generation, client_state, keys_changed_at,
+            node=node, timestamp=timestamp)
+        return self._globalize_user(index, user)
+
+    def allocate_users(self, service, emails, node=None):
+        emails = list(emails)
+        emails_by_shard = [[] for _ in self.shards]
+        for email in emails:
+            emails_by_shard[self._get_shard_index(email)].append(email)
+
+        def allocate_users(i, shard):
+            if not emails_by_shard[i]:
+                return []
+            users = shard.allocate_users(service, emails_by_shard[i], node)
+            return [self._globalize_user(i, user) for user in users]
+
+        users_by_email = {}
+        for users in self._fan_out(allocate_users):
+            for user in users:
+                users_by_email[user['email']] = user
+        # Put them back in the order the emails were given.
+        return [users_by_email.pop(email) for email in emails
+                if email in users_by_email]
+
+    def update_user(self, service, user, generation=None, client_state=None,
+                    keys_changed_at=None, node=None):
+        index = self._get_shard_index(user['email'])
+        user['uid'] = user['uid'] // len(self.shards)
+        try:
+            self.shards[index].update_user(service, user, generation,
+                                           client_state, keys_changed_at,
+                                           node)
+        finally:
+            self._globalize_user(index, user)
+
+    def get_user_records(self, service, email, **kwds):
+        index = self._get_shard_index(email)
+        rows = self.shards[index].get_user_records(service, email, **kwds)
+        for row in rows:
+            yield self._globalize_row(index, row)
+
+    def replace_user_records(self, service, email, timestamp=None):
+        shard = self._get_shard(email)
+        shard.replace_user_records(service, email, timestamp)
+
+    def replace_user_record(self, service, uid, timestamp=None):
+        shard, uid = self._to_local_uid(uid)
+        shard.replace_user_record(service, uid, timestamp)
+
+    def delete_user_record(self, service, uid):
+        shard, uid = self._to_local_uid(uid)
+        shard.delete_user_record(service, uid)
+
+    def get_best_node(self, service, email):
+        return self._get_shard(email).get_best_node(service, email)
+
+    #
+    # Cross-shard operations, fanned out to every shard in parallel.
+    #
+
+    def retire_user(self, email):
+        # The user's records should all be on their own shard, but it's
+        # cheap to make sure that none were left behind on other shards,
+        # e.g. by a change in the number of shards.
+        self._fan_out(lambda i, shard: shard.retire_user(email))
+
+    def count_users(self, timestamp=None):
+        return sum(self._fan_out(
+            lambda i, shard: shard.count_users(timestamp)))
+
+    def get_old_user_records(self, service, grace_period=-1, limit=100,
+                             offset=0, **kwds):
+        # The records are listed shard by shard, so that each shard is only
+        # asked for the page that it contributes.  A shard that has nothing
+        # at the offset is counted, to find how far into the next to start.
+        for i, shard in enumerate(self.shards):
+            if limit <= 0:
+                break
+            count = 0
+            for row in shard.get_old_user_records(service, grace_period,
+                                                  limit=limit, offset=offset,
+                                                  **kwds):
+                count += 1
+                yield self._globalize_row(i, row)
+            if count:
+                offset = 0
+                limit -= count
+            elif offset:
+                offset -= min(offset, shard.count_old_user_records(
+                    service, grace_period, **kwds))
+
+    def release_node_leases(self, service=None, node=None, expired=False):
+        self._fan_out(lambda i, shard: shard.release_node_leases(
+            service, node, expired))
+
+    def release_node_capacity(self):
+        return sum(self._fan_out(
+            lambda i, shard: shard.release_node_capacity()))
+
+    def reconcile_node_loads(self, service=None, **kwds):
+        # Each shard has its own part of every node's load, along with the
+        # records of its own users, so each is reconciled on its own and
+        # the results added up.
+        def reconcile_node_loads(i, shard):
+            return shard.reconcile_node_loads(service, **kwds)
+        totals = OrderedDict()
+        for results in self._fan_out(reconcile_node_loads):
+            for node_service, node, recorded, actual in results:
+                total = totals.setdefault((node_service, node), [0, 0])
+                total[0] += recorded
+                total[1] += actual
+        return [(node_service, node, recorded, actual)
+                for (node_service, node), (recorded, actual)
+                in totals.iteritems()]
+
+    def get_pool_status(self):
+        return {'shards': [shard.get_pool_status() for shard in self.shards]}
+
+    def get_patterns(self):
+        # Every shard has the same services, so any one will do.
+        return self.shards[0].get_patterns()
+
+    def get_migration_percent(self):
+        # Each shard reads the setting from its own db, and new users are
+        # migrated according to that of their shard.  It's expected to be
+        # set the same on every shard, so report that of the first.
+        return self.shards[0].get_migration_percent()
+
+    def get_node_id(self, service, node):
+        # Node ids are assigned by each shard's db.  They match as long as
+        # nodes are only ever added through this class, but if not then
+        # there's no one id that could be used for the node.
+        nodeids = set(self._fan_out(
+            lambda i, shard: shard.get_node_id(service, node)))
+        if len(nodeids) != 1:
+            raise BackendError("node %s has a different id on each shard"
+                               % (node,))
+        return nodeids.pop()
+
+    def add_service(self, service, pattern, **kwds):
+        self._fan_out(lambda i, shard: shard.add_service(service, pattern,
+                                                         **kwds))
+
+    def add_node(self, service, node, capacity, **kwds):
+        def add_node(i, shard):
+            shard_kwds = kwds.copy()
+            for field in _PARTITIONED_NODE_FIELDS:
+                if shard_kwds.get(field) is not None:
+                    shard_kwds[field] = _split_count(shard_kwds[field],
+                                                     len(self.shards), i)
+            shard_capacity = _split_count(capacity, len(self.shards), i)
+            shard.add_node(service, node, shard_capacity, **shard_kwds)
+        self._fan_out(add_node)
+
+    def update_node(self, service, node, **kwds):
+        def update_node(i, shard):
+            shard_kwds = kwds.copy()
+            for field in _PARTITIONED_NODE_FIELDS:
+                if field in shard_kwds:
+                    shard_kwds[field] = _split_count(shard_kwds[field],
+                                                     len(self.shards), i)
+            shard.update_node(service, node, **shard_kwds)
+        self._fan_out(update_node)
+
+    def remove_node(self, service, node, timestamp=None, **kwds):
+        self._fan_out_batches('remove_node', service, node, timestamp, **kwds)
+
+    def unassign_node(self, service, node, timestamp=None, **kwds):
+        return self._fan_out_batches('unassign_node', service, node,
+                                     timestamp, **kwds)
+
+    def reassign_replaced_users(self, service, timestamp, **kwds):
+        return self._fan_out_batches('reassign_replaced_users', service,
+                                     timestamp, **kwds)
+
+    def backfill_user_history_summaries(self, **kwds):
+        return self._fan_out_batches('backfill_user_history_summaries',
+                                     **kwds)
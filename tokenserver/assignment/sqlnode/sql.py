@@ -12,17 +12,33 @@ import math
 import traceback
 import hashlib
 import time
+import copy
+import atexit
+import random
+import threading
+import contextlib
+import json
+import weakref
+from collections import defaultdict, OrderedDict
 from mozsvc.exceptions import BackendError
+from mozsvc.metrics import annotate_request, metrics_timer
+from pyramid.threadlocal import get_current_request
+from repoze.lru import ExpiringLRUCache
 
-from sqlalchemy.sql import select, update, and_
+from sqlalchemy.sql import select, update, and_, bindparam
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import create_engine
-from sqlalchemy.pool import NullPool
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Connection
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.util import LRUCache
 from sqlalchemy.sql import text as sqltext, func as sqlfunc
 from sqlalchemy.exc import OperationalError, TimeoutError
 
 from zope.interface import implements
 from tokenserver.assignment import INodeAssignment
+from tokenserver.assignment.sqlnode.selection import (
+    get_node_selection_policy, least_loaded)
 from tokenserver.util import get_timestamp
 
 
@@ -35,6 +51,12 @@ logger = logging.getLogger('tokenserver.assignment.sqlnode')
 MAX_GENERATION = 9223372036854775807
 
 
+# The longest that in-place user updates may be queued in memory, in seconds.
+# Until they're written, other processes will still accept the credentials
+# that a bump of generation or keys_changed_at is meant to revoke.
+MAX_UPDATE_FLUSH_INTERVAL = 5
+
+
 NODE_FIELDS = ("capacity", "available", "current_load", "downed", "backoff")
 
 
@@ -44,7 +66,7 @@ _Base = declarative_base()
 _GET_USER_RECORDS = sqltext("""\
 select
     uid, nodes.node, generation, keys_changed_at, client_state, created_at,
-    replaced_at
+    replaced_at, old_client_states
 from
     users left outer join nodes on users.nodeid = nodes.id
 where
@@ -55,14 +77,31 @@ limit
     20
 """)
 
+# Fetches just the active record for a user, along with the summary of their
+# history that it carries.  We fetch up to two rows so that we can detect
+# races in record creation, which need the full history to repair.
+_GET_ACTIVE_USER_RECORD = sqltext("""\
+select
+    uid, nodes.node, generation, keys_changed_at, client_state, created_at,
+    old_client_states, first_seen_at
+from
+    users left outer join nodes on users.nodeid = nodes.id
+where
+    email = :email and users.service = :service and replaced_at is null
+order by
+    created_at desc, uid desc
+limit
+    2
+""")
+
 _CREATE_USER_RECORD = sqltext("""\
 insert into
     users
     (service, email, nodeid, generation, keys_changed_at, client_state,
-     created_at, replaced_at)
+     created_at, replaced_at, old_client_states, first_seen_at)
 values
     (:service, :email, :nodeid, :generation, :keys_changed_at,
-     :client_state, :timestamp, NULL)
+     :client_state, :timestamp, NULL, :old_client_states, :first_seen_at)
 """)
 
 # The `where` clause on this statement is designed as an extra layer of
@@ -84,6 +123,29 @@ where
     replaced_at is null
 """)
 
+# Queued in-place updates merge bumps to both fields, which may have been
+# made by separate requests, so they can't be guarded by a single `where`
+# clause like the one above: if another process had moved one field past
+# the queued value then the bump to the other would be lost.  Instead each
+# field is only ever moved forward on its own.
+_MERGE_USER_RECORD_UPDATE = sqltext("""\
+update
+    users
+set
+    generation = CASE
+        WHEN generation < :generation THEN :generation
+        ELSE generation
+    END,
+    keys_changed_at = CASE
+        WHEN COALESCE(keys_changed_at, 0) < :keys_changed_at
+            THEN :keys_changed_at
+        ELSE keys_changed_at
+    END
+where
+    service = :service and email = :email and
+    replaced_at is null
+""")
+
 
 _REPLACE_USER_RECORDS = sqltext("""\
 update
@@ -96,6 +158,21 @@ where
 """)
 
 
+# Mark all records for the user that come before the given one as replaced.
+# Records created in the same millisecond are ordered by uid, as they are
+# when reading them back, so that the new record always replaces them.
+_REPLACE_EARLIER_USER_RECORDS = sqltext("""\
+update
+    users
+set
+    replaced_at = :timestamp
+where
+    service = :service and email = :email
+    and replaced_at is null
+    and (created_at < :timestamp or (created_at = :timestamp and uid < :uid))
+""")
+
+
 # Mark all records for the user as replaced,
 # and set a large generation number to block future logins.
 _RETIRE_USER_RECORDS = sqltext("""\
@@ -119,7 +196,7 @@ from
 where
     users.service = :service
 and
-    replaced_at is not null and replaced_at < :timestamp
+    replaced_at is not null and replaced_at <= :timestamp
 order by
     replaced_at desc, uid desc
 limit
@@ -129,6 +206,18 @@ offset
 """)
 
 
+_COUNT_OLD_USER_RECORDS_FOR_SERVICE = sqltext("""\
+select
+    count(uid)
+from
+    users
+where
+    service = :service
+and
+    replaced_at is not null and replaced_at <= :timestamp
+""")
+
+
 _GET_ALL_USER_RECORDS_FOR_SERVICE = sqltext("""\
 select
     uid, nodes.node, created_at, replaced_at
@@ -153,6 +242,62 @@ and
 """)
 
 
+_REPLACE_USER_RECORDS_BY_UID = sqltext("""\
+update
+    users
+set
+    replaced_at = :timestamp
+where
+    service = :service
+and
+    uid in :uids
+and
+    replaced_at is null
+""").bindparams(bindparam('uids', expanding=True))
+
+
+_SET_USER_HISTORY_SUMMARY = sqltext("""\
+update
+    users
+set
+    old_client_states = :old_client_states,
+    first_seen_at = :first_seen_at
+where
+    service = :service
+and
+    uid = :uid
+""")
+
+
+# Forget the summary of a user's history that's carried on their active
+# record, so that it will be re-computed from their remaining records.
+_CLEAR_USER_HISTORY_SUMMARY = sqltext("""\
+update
+    users
+set
+    old_client_states = NULL,
+    first_seen_at = NULL
+where
+    service = :service
+and
+    email = :email
+and
+    replaced_at is null
+""")
+
+
+_GET_EMAIL_FOR_USER_RECORD = sqltext("""\
+select
+    email
+from
+    users
+where
+    service = :service
+and
+    uid = :uid
+""")
+
+
 _DELETE_USER_RECORD = sqltext("""\
 delete from
     users
@@ -193,8 +338,297 @@ where
     setting = :setting
 """)
 
+_GET_NODE_ID = sqltext("""\
+select
+    id
+from
+    nodes
+where
+    service = :service and node = :node
+""")
+
+
+_DELETE_NODE = sqltext("""\
+delete from
+    nodes
+where
+    id = :nodeid
+""")
+
+
+_UNASSIGN_NODE = sqltext("""\
+update
+    users
+set
+    replaced_at = :timestamp
+where
+    nodeid = :nodeid
+""")
+
 MIGRATION_CACHE_LIFESPAN = 300
 
+# Pragmas applied to each connection in SQLite performance mode.  WAL lets
+# readers proceed concurrently with a writer, and with WAL it's safe to
+# sync less often since a crash can only lose the most recent commits.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+)
+
+# The maximum number of times to try claiming a slot on a node before giving
+# up, should other allocations keep claiming the last slots from under us.
+MAX_NODE_CLAIM_ATTEMPTS = 10
+
+# The number of users to create in each transaction in allocate_users().
+ALLOCATE_USERS_BATCH_SIZE = 500
+
+# The maximum number of compiled statements to cache per engine.
+COMPILED_CACHE_SIZE = 100
+
+# The maximum number of queued in-place user updates to send to the db
+# in a single batch when flushing them.
+UPDATE_FLUSH_BATCH_SIZE = 500
+
+
+def _encode_client_states(client_states):
+    """Encode a collection of client-state strings for storage in the db."""
+    return json.dumps(sorted(client_states))
+
+
+def _decode_client_states(value):
+    """Decode client-state strings from the db, as a dict like get_user's."""
+    return dict((str(client_state), True)
+                for client_state in json.loads(value))
+
+
+def _needs_new_node(row):
+    """Whether the user with this active record must be given a new node.
+
+    That's if their record was replaced, e.g. because their node was
+    unassigned, or lost its node, and they haven't been retired.
+    """
+    if row.replaced_at is not None or row.node is None:
+        return row.generation < MAX_GENERATION
+    return False
+
+
+def _summarize_user_history(rows):
+    """Summarize a user's history from their records, newest first.
+
+    Returns the dict of their previously-seen client-state values, and the
+    time at which they were first seen, as carried on their active record.
+    """
+    cur_row = rows[0]
+    old_client_states = {}
+    first_seen_at = cur_row.created_at
+    for old_row in rows[1:]:
+        if old_row.client_state != cur_row.client_state:
+            old_client_states[old_row.client_state] = True
+        # Track backwards to the oldest timestamp at which we saw them.
+        first_seen_at = old_row.created_at
+    return old_client_states, first_seen_at
+
+
+# Backends with background threads, which are closed when the process exits
+# so that what those threads would have written to the db isn't lost.  It's
+# a weak set so that closed backends aren't kept alive by it.
+_open_backends = weakref.WeakSet()
+
+
+@atexit.register
+def _close_open_backends():
+    for backend in list(_open_backends):
+        try:
+            backend.close()
+        except Exception:
+            logger.exception("Error while closing node-assignment backend")
+
+
+def _throttle(start, count, max_rate):
+    """Sleep as needed to keep the rate of work since `start` to at most
+    `max_rate` items per second, having done `count` items."""
+    if max_rate:
+        delay = count / float(max_rate) - (time.time() - start)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _get_grace_period_cutoff(grace_period):
+    """Get the timestamp before which replaced records count as old."""
+    if grace_period < 0:
+        grace_period = 60 * 60 * 24 * 7  # one week, in seconds
+    grace_period = int(grace_period * 1000)  # convert seconds -> millis
+    return get_timestamp() - grace_period
+
+
+def _set_request_metric(key, value):
+    """Set an entry in the current request's metrics, if there is one.
+
+    Unlike annotate_request(), this overwrites any existing value, so it is
+    suitable for gauges that may be sampled several times in a request.
+    """
+    request = get_current_request()
+    if request is not None:
+        try:
+            request.metrics[key] = value
+        except AttributeError:
+            pass
+
+
+class _InstrumentedQueuePool(QueuePool):
+    """A QueuePool that reports on how its connections are used.
+
+    Each checkout adds the time spent waiting for a connection to the
+    request metrics, along with gauges of the connections currently in use,
+    idle and in overflow.  Checkouts that fail with pool_timeout are counted
+    in the request metrics, and all of these are also accumulated on the
+    pool itself for reporting by get_pool_status().
+    """
+
+    def __init__(self, *args, **kwds):
+        super(_InstrumentedQueuePool, self).__init__(*args, **kwds)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.checkout_time = 0
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            conn = super(_InstrumentedQueuePool, self)._do_get()
+        except TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            annotate_request(None, 'tokenserver.backend.pool.timeout', 1)
+            raise
+        duration = time.time() - start
+        with self._stats_lock:
+            self.checkouts += 1
+            self.checkout_time += duration
+        annotate_request(None, 'tokenserver.backend.pool.checkout_time',
+                         duration)
+        _set_request_metric('tokenserver.backend.pool.in_use',
+                            self.checkedout())
+        _set_request_metric('tokenserver.backend.pool.idle',
+                            self.checkedin())
+        _set_request_metric('tokenserver.backend.pool.overflow',
+                            max(self.overflow(), 0))
+        return conn
+
+
+def _is_sqlite_file(sqluri):
+    """Check whether an sqluri refers to an on-disk SQLite database."""
+    url = make_url(sqluri)
+    return url.drivername.startswith('sqlite') and \
+        url.database not in (None, '', ':memory:')
+
+
+def _on_sqlite_connect(dbapi_connection, connection_record):
+    # Stop pysqlite from managing transactions itself, since it only begins
+    # them lazily at the first write; we begin them in _on_sqlite_begin.
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+    finally:
+        cursor.close()
+
+
+def _on_sqlite_begin(connection):
+    # Take the write lock at the start of each transaction, rather than
+    # trying to upgrade a read lock on the first write.  Such an upgrade
+    # fails immediately if another process has written in the meantime,
+    # whereas waiting for the write lock is subject to the busy timeout.
+    connection.execute("BEGIN IMMEDIATE")
+
+
+def _get_pool_status(pool):
+    """Get a JSON-able dict describing the current state of a pool."""
+    status = {'class': pool.__class__.__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            'size': pool.size(),
+            'max_overflow': pool._max_overflow,
+            'in_use': pool.checkedout(),
+            'idle': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0),
+        })
+    if isinstance(pool, _InstrumentedQueuePool):
+        with pool._stats_lock:
+            status.update({
+                'checkouts': pool.checkouts,
+                'timeouts': pool.timeouts,
+                'checkout_time': pool.checkout_time,
+            })
+    return status
+
+
+class _NodeLease(object):
+    """A block of slots on a node, reserved for allocation by this process."""
+
+    def __init__(self, nodeid, node, size, expires_at):
+        self.nodeid = nodeid
+        self.node = node
+        self.remaining = size
+        self.expires_at = expires_at
+
+
+class _CachedNode(object):
+    """A copy of a row from the nodes table, held in a _NodeSnapshot."""
+
+    def __init__(self, row):
+        self.id = row.id
+        self.service = row.service
+        self.node = row.node
+        self.available = row.available
+        self.current_load = row.current_load
+        self.capacity = row.capacity
+        self.downed = row.downed
+        self.backoff = row.backoff
+
+    def is_available(self):
+        return (self.available > 0 and self.capacity > self.current_load and
+                not self.downed and not self.backoff)
+
+
+class _NodeSnapshot(object):
+    """An in-memory copy of the services and nodes tables.
+
+    The copy of each node's load is kept roughly up to date by applying
+    this process' own allocations to it, but may lag behind changes made
+    by other processes until the snapshot is refreshed.
+    """
+
+    def __init__(self, version, service_rows, node_rows):
+        self.version = version
+        self.loaded_at = time.time()
+        self.service_ids = dict((row.service, row.id) for row in service_rows)
+        self.nodes_by_id = {}
+        self.node_ids = {}
+        self.nodes_by_service = defaultdict(list)
+        for row in node_rows:
+            node = _CachedNode(row)
+            self.nodes_by_id[node.id] = node
+            self.node_ids[(node.service, node.node)] = node.id
+            self.nodes_by_service[node.service].append(node)
+
+    def get_available_nodes(self, service_id):
+        return [node for node in self.nodes_by_service.get(service_id, ())
+                if node.is_available()]
+
+
+class _Replica(object):
+    """A read-only replica of the db, along with its last-known health."""
+
+    def __init__(self, sqluri, engine):
+        self.sqluri = sqluri
+        self.engine = engine
+        self.healthy = True
+        self.lag = None
+        self.checked_at = 0
+
 
 class SQLNodeAssignment(object):
 
@@ -204,8 +638,77 @@ class SQLNodeAssignment(object):
                  pool_recycle=60, pool_timeout=30, max_overflow=10,
                  pool_reset_on_return='rollback', capacity_release_rate=0.1,
                  spanner_node_id=None, migrate_new_user_percentage=0,
-                 **kw):
+                 user_cache_size=0, user_cache_ttl=60,
+                 update_flush_interval=0, replica_sqluris=None,
+                 replica_check_interval=30, max_replica_lag=None,
+                 sqlite_performance_mode=False, sqlite_busy_timeout=5,
+                 node_lease_size=0, node_lease_ttl=60,
+                 node_selection_policy='least_loaded',
+                 capacity_release_interval=0, node_snapshot_interval=0,
+                 spanner_load_flush_interval=0, **kw):
         self._cached_service_ids = {}
+        # Background threads are started once we're ready to talk to the db,
+        # below, and run until close() is called.
+        self._closing = threading.Event()
+        self._workers = []
+        # How to choose between the nodes that can accept new users.  The
+        # default least-loaded policy can be done in the db, but the others
+        # choose from the full list of candidate nodes.
+        if node_selection_policy == 'least_loaded':
+            self._node_selection_policy = None
+        else:
+            self._node_selection_policy = get_node_selection_policy(
+                node_selection_policy)
+        # An optional in-process cache of user records, keyed by
+        # (service, email).  Since it's per-process, changes made by other
+        # workers will only become visible once the entry expires.
+        if int(user_cache_size) > 0:
+            self._user_cache = ExpiringLRUCache(int(user_cache_size),
+                                                int(user_cache_ttl))
+        else:
+            self._user_cache = None
+        # Optionally queue in-place bumps of generation/keys_changed_at
+        # and write them to the db in batches from a background thread,
+        # rather than doing a separate UPDATE on each request.
+        self._update_flush_interval = float(update_flush_interval)
+        if self._update_flush_interval > MAX_UPDATE_FLUSH_INTERVAL:
+            raise ValueError("update_flush_interval must be at most %d "
+                             "seconds" % (MAX_UPDATE_FLUSH_INTERVAL,))
+        if self._update_flush_interval > 0:
+            self._pending_updates = {}
+            self._pending_updates_lock = threading.Lock()
+        else:
+            self._pending_updates = None
+        # Optionally reserve blocks of slots on a node and hand them out
+        # from memory, rather than updating the node's load in the db for
+        # each new user.  Unused slots are returned to the node once the
+        # lease expires, by a background thread, or when the process exits.
+        self._node_lease_size = int(node_lease_size)
+        self._node_lease_ttl = float(node_lease_ttl)
+        if self._node_lease_size > 0:
+            self._node_leases = {}
+            self._node_leases_lock = threading.Lock()
+        else:
+            self._node_leases = None
+        # Optionally count the users sent to the spanner node in memory,
+        # and add them to its load from a background thread, so that every
+        # new user for spanner isn't an update of the same row.
+        self._spanner_load_flush_interval = float(spanner_load_flush_interval)
+        if self._spanner_load_flush_interval > 0:
+            self._pending_spanner_load = defaultdict(int)
+            self._pending_spanner_load_lock = threading.Lock()
+        else:
+            self._pending_spanner_load = None
+        # Optionally release node capacity ahead of demand from a background
+        # thread, rather than when an allocation finds no available slots.
+        self._capacity_release_interval = float(capacity_release_interval)
+        # Optionally keep an in-memory snapshot of the services and nodes
+        # tables, reloaded every node_snapshot_interval seconds, for the
+        # node lookups done on the request path.
+        self._node_snapshot_interval = float(node_snapshot_interval)
+        self._node_snapshot = None
+        self._node_snapshot_version = 0
+        self._node_snapshot_lock = threading.Lock()
         self._migration_percentage_cache_ttl = 0
         self.sqluri = sqluri
         if pool_reset_on_return.lower() in ('', 'none'):
@@ -220,24 +723,34 @@ class SQLNodeAssignment(object):
         # Use production-ready pool settings for the MySQL backend.
         # We also need to work around mysql using "LEAST(a,b)" and
         # sqlite using "MIN(a,b)" in expressions.
+        self._pool_kwds = {
+            'pool_size': pool_size,
+            'pool_recycle': pool_recycle,
+            'pool_timeout': pool_timeout,
+            'pool_reset_on_return': pool_reset_on_return,
+            'max_overflow': max_overflow,
+        }
+        self._sqlite_performance_mode = sqlite_performance_mode
+        self._sqlite_busy_timeout = float(sqlite_busy_timeout)
+        self._engine = self._create_engine(sqluri, kw.get('echo', False))
         if sqluri.startswith('mysql') or sqluri.startswith('pymysql'):
-            self._engine = create_engine(
-                sqluri,
-                pool_size=pool_size,
-                pool_recycle=pool_recycle,
-                pool_timeout=pool_timeout,
-                pool_reset_on_return=pool_reset_on_return,
-                max_overflow=max_overflow,
-                logging_name='tokenserver.assignment.sqlnode'
-            )
             self._sqlfunc_min = sqlfunc.least
             self._sqlfunc_max = sqlfunc.greatest
         else:
-            self._engine = create_engine(sqluri, poolclass=NullPool)
             self._sqlfunc_min = sqlfunc.min
             self._sqlfunc_max = sqlfunc.max
 
-        self._engine.echo = kw.get('echo', False)
+        # Optional read replicas, to take pure reads off the primary.
+        if isinstance(replica_sqluris, basestring):
+            replica_sqluris = replica_sqluris.split()
+        self._replicas = [
+            _Replica(uri, self._create_engine(uri, kw.get('echo', False)))
+            for uri in (replica_sqluris or ())
+        ]
+        self._replica_check_interval = float(replica_check_interval)
+        if max_replica_lag is not None:
+            max_replica_lag = float(max_replica_lag)
+        self._max_replica_lag = max_replica_lag
         self.capacity_release_rate = capacity_release_rate
 
         self._is_sqlite = (self._engine.driver == 'pysqlite')
@@ -255,22 +768,386 @@ class SQLNodeAssignment(object):
                       self.users, self.dyn_settings):
             table.metadata.bind = self._engine
             if create_tables:
-                table.create(checkfirst=True)
+                table.create(bind=self._engine, checkfirst=True)
+
+        self._prepare_statements()
+
+        if self._pending_updates is not None:
+            self._start_worker(self._update_flush_interval,
+                               self.flush_pending_updates,
+                               "flushing user updates")
+        if self._node_leases is not None:
+            self._start_worker(self._node_lease_ttl,
+                               lambda: self.release_node_leases(expired=True),
+                               "releasing node leases")
+        if self._pending_spanner_load is not None:
+            self._start_worker(self._spanner_load_flush_interval,
+                               self.flush_spanner_load,
+                               "flushing spanner node load")
+        if self._capacity_release_interval > 0:
+            self._start_worker(self._capacity_release_interval,
+                               self.release_node_capacity,
+                               "releasing node capacity")
+
+    def _start_worker(self, interval, task, description):
+        """Call task() every `interval` seconds from a background thread,
+        until this backend is closed."""
+        def run_worker():
+            while not self._closing.wait(interval):
+                try:
+                    task()
+                except Exception:
+                    logger.exception("Error while %s", description)
+
+        worker = threading.Thread(target=run_worker)
+        worker.daemon = True
+        worker.start()
+        self._workers.append(worker)
+        _open_backends.add(self)
+
+    def close(self):
+        """Stop any background threads, and do what they were waiting to.
+
+        This writes out any queued updates and spanner node load, and gives
+        back any leased slots, so that nothing held in memory is lost.  It's
+        done for any backends still open when the process exits.
+        """
+        self._closing.set()
+        for worker in self._workers:
+            worker.join()
+        del self._workers[:]
+        _open_backends.discard(self)
+        self.flush_pending_updates()
+        self.flush_spanner_load()
+        self.release_node_leases()
+
+    def _prepare_statements(self):
+        """Build the dynamically-constructed statements used by this class.
+
+        These are built once for the dialect in use and then re-used with
+        different parameters, so that their compiled form can be re-used
+        from the engine's compiled_cache rather than re-compiled each time.
+        Any parameter named `service` will be converted from a service name
+        to a service id by _safe_execute(), but update statements may not
+        use bind parameters named after their columns, so those take the
+        already-converted service id as `b_service`.
+        """
+        services = self._get_services_table(None)
+        nodes = self._get_nodes_table(None)
+
+        self._get_service_id_query = select([services.c.id]).where(
+            services.c.service == bindparam('service_name'))
+
+        self._get_all_services_query = select([services])
+        self._get_all_nodes_query = select([nodes])
+
+        self._get_spanner_node_query = select([nodes]).where(
+            nodes.c.id == bindparam('nodeid'))
+
+        query = select([nodes]).where(and_(
+            nodes.c.service == bindparam('service'),
+            nodes.c.available > 0,
+            nodes.c.capacity > nodes.c.current_load,
+            nodes.c.downed == 0,
+            nodes.c.backoff == 0
+        ))
+        self._get_available_nodes_query = query
+        if self._is_sqlite:
+            # sqlite doesn't have the 'log' funtion, and requires
+            # coercion to a float for the sorting to work.
+            query = query.order_by(
+                nodes.c.current_load * 1.0 /
+                nodes.c.capacity)
+        else:
+            # using log() increases floating-point precision on mysql
+            # and thus makes the sorting more accurate.
+            query = query.order_by(
+                sqlfunc.log(nodes.c.current_load) /
+                sqlfunc.log(nodes.c.capacity))
+        self._get_least_loaded_node_query = query.limit(1)
+
+        # Release additional capacity from any nodes that are not
+        # fully occupied.
+        self._release_node_capacity_query = update(nodes).where(and_(
+            nodes.c.service == bindparam('b_service'),
+            nodes.c.available <= 0,
+            nodes.c.capacity > nodes.c.current_load,
+            nodes.c.downed == 0
+        )).values({
+            'available': self._sqlfunc_min(
+                nodes.c.capacity * bindparam('release_rate'),
+                nodes.c.capacity - nodes.c.current_load
+            ),
+        })
+
+        self._add_spanner_node_load_query = update(nodes).where(and_(
+            nodes.c.service == bindparam('b_service'),
+            nodes.c.node == bindparam('b_node')
+        )).values({
+            'current_load': nodes.c.current_load + bindparam('size'),
+        })
+
+        # Claim a slot on a node, provided that it's still eligible for new
+        # users.  This re-checks the conditions that the node was selected
+        # on as part of the update, so that concurrent allocations can't
+        # claim more slots than are available.
+        self._claim_node_slot_query = update(nodes).where(and_(
+            nodes.c.id == bindparam('b_nodeid'),
+            nodes.c.available > 0,
+            nodes.c.capacity > nodes.c.current_load,
+            nodes.c.downed == 0,
+            nodes.c.backoff == 0
+        )).values({
+            'current_load': nodes.c.current_load + 1,
+            'available': nodes.c.available - 1,
+        })
+
+        # Reserve a block of slots on a node for a lease, provided that
+        # they're still available, and return unused ones.  The load may
+        # have been recounted without the leased slots in the meantime, so
+        # returned slots are kept within the node's capacity.  As in
+        # _correct_node_load_query, both sides see the old current_load.
+        self._lease_node_slots_query = update(nodes).where(and_(
+            nodes.c.id == bindparam('b_nodeid'),
+            nodes.c.available >= bindparam('size'),
+            nodes.c.downed == 0,
+            nodes.c.backoff == 0
+        )).values({
+            'current_load': nodes.c.current_load + bindparam('size'),
+            'available': nodes.c.available - bindparam('size'),
+        })
+        returned_load = self._sqlfunc_max(
+            0, nodes.c.current_load - bindparam('size'))
+        self._return_node_slots_query = update(
+            nodes, preserve_parameter_order=True
+        ).where(
+            nodes.c.id == bindparam('b_nodeid')
+        ).values([
+            ('available', self._sqlfunc_min(
+                nodes.c.available + bindparam('size'),
+                nodes.c.capacity - returned_load
+            )),
+            ('current_load', returned_load),
+        ])
+
+        # Top up the available slots on all nodes that are running low, for
+        # release_node_capacity().  This only ever increases them.
+        release_size = nodes.c.capacity * bindparam('release_rate')
+        room = nodes.c.capacity - nodes.c.current_load
+        self._replenish_node_capacity_query = update(nodes).where(and_(
+            nodes.c.available < nodes.c.capacity * bindparam('low_water'),
+            nodes.c.available < release_size,
+            nodes.c.available < room,
+            nodes.c.downed == 0
+        )).values({
+            'available': self._sqlfunc_min(release_size, room),
+        })
+
+        # Statements for allocate_users(), which work on a batch of emails.
+        users = self._get_users_table(None)
+        self._get_active_emails_query = select([users.c.email]).where(and_(
+            users.c.service == bindparam('service'),
+            users.c.email.in_(bindparam('emails', expanding=True)),
+            users.c.replaced_at.is_(None)
+        ))
+        self._get_created_uids_query = select([
+            users.c.email, users.c.uid
+        ]).where(and_(
+            users.c.service == bindparam('service'),
+            users.c.email.in_(bindparam('emails', expanding=True)),
+            users.c.created_at == bindparam('timestamp'),
+            users.c.replaced_at.is_(None)
+        ))
+
+        # Statements for unassigning the users of a node in batches, in
+        # order of uid.
+        self._get_node_user_batch_query = select([users.c.uid]).where(and_(
+            users.c.nodeid == bindparam('nodeid'),
+            users.c.replaced_at.is_(None),
+            users.c.uid > bindparam('last_uid')
+        )).order_by(users.c.uid).limit(bindparam('batch_size'))
+        self._unassign_user_batch_query = update(users).where(and_(
+            users.c.nodeid == bindparam('b_nodeid'),
+            users.c.replaced_at.is_(None),
+            users.c.uid >= bindparam('b_first_uid'),
+            users.c.uid <= bindparam('b_last_uid')
+        )).values({
+            'replaced_at': bindparam('b_timestamp'),
+        })
+
+        # Statements for backfilling the summary of users' history onto
+        # active records that lack one, in batches in order of uid.  The
+        # summary is only written if it's still missing, in case the user
+        # has been read or changed in the meantime.
+        self._get_unsummarized_user_batch_query = select([
+            users.c.uid, users.c.service, users.c.email
+        ]).where(and_(
+            users.c.replaced_at.is_(None),
+            users.c.old_client_states.is_(None),
+            users.c.uid > bindparam('last_uid')
+        )).order_by(users.c.uid).limit(bindparam('batch_size'))
+        self._backfill_user_history_summary_query = update(users).where(and_(
+            users.c.uid == bindparam('b_uid'),
+            users.c.old_client_states.is_(None)
+        )).values({
+            'old_client_states': bindparam('b_old_client_states'),
+            'first_seen_at': bindparam('b_first_seen_at'),
+        })
+
+        # Count a node's active records in chunks of up to batch_size, for
+        # reconcile_node_loads().  Each chunk picks up in node_idx where the
+        # last one stopped, so no one statement scans all of a node's users.
+        chunk = self._get_node_user_batch_query.alias('chunk')
+        self._count_node_user_chunk_query = select([
+            sqlfunc.count(chunk.c.uid), sqlfunc.max(chunk.c.uid)
+        ])
+        # Correct a node's load by the given amount, moving its available
+        # slots the other way but keeping them within the room left on the
+        # node.  The order matters, so that both sides of the update see
+        # the old current_load on MySQL as well as SQLite.
+        self._correct_node_load_query = update(
+            nodes, preserve_parameter_order=True
+        ).where(
+            nodes.c.id == bindparam('b_nodeid')
+        ).values([
+            ('available', self._sqlfunc_max(0, self._sqlfunc_min(
+                nodes.c.available - bindparam('delta'),
+                nodes.c.capacity - nodes.c.current_load - bindparam('delta')
+            ))),
+            ('current_load', nodes.c.current_load + bindparam('delta')),
+        ])
+
+        # Find the users whose records were replaced at a given time,
+        # for reassign_replaced_users().
+        self._get_replaced_user_batch_query = select([
+            users.c.uid, users.c.email
+        ]).where(and_(
+            users.c.service == bindparam('service'),
+            users.c.replaced_at >= bindparam('timestamp'),
+            users.c.uid > bindparam('last_uid')
+        )).order_by(users.c.uid).limit(bindparam('batch_size'))
+
+        # Statements for update_node(), keyed by the fields they update.
+        self._update_node_queries = {}
+
+    def _create_engine(self, sqluri, echo=False):
+        if sqluri.startswith('mysql') or sqluri.startswith('pymysql'):
+            engine = create_engine(
+                sqluri,
+                logging_name='tokenserver.assignment.sqlnode',
+                poolclass=_InstrumentedQueuePool,
+                **self._pool_kwds
+            )
+        elif self._sqlite_performance_mode and _is_sqlite_file(sqluri):
+            # Keep a pool of connections to SQLite too, since opening one
+            # means re-reading the schema.  Each connection is only used by
+            # one thread at a time, so it's safe to share them.
+            engine = create_engine(
+                sqluri,
+                poolclass=_InstrumentedQueuePool,
+                connect_args={
+                    'check_same_thread': False,
+                    'timeout': self._sqlite_busy_timeout,
+                },
+                **self._pool_kwds
+            )
+            event.listen(engine, 'connect', _on_sqlite_connect)
+            event.listen(engine, 'begin', _on_sqlite_begin)
+        else:
+            engine = create_engine(sqluri, poolclass=NullPool)
+        engine.echo = echo
+        # Re-use the compiled form of statements that we execute repeatedly.
+        return engine.execution_options(
+            compiled_cache=LRUCache(COMPILED_CACHE_SIZE))
 
     def _get_engine(self, service=None):
         return self._engine
 
-    def _safe_execute(self, *args, **kwds):
-        """Execute an sqlalchemy query, raise BackendError on failure."""
-        if hasattr(args[0], 'bind'):
-            engine = args[0].bind
+    def get_pool_status(self):
+        """Get the state of the connection pools used by this backend.
+
+        Replicas are listed in the order they were configured, rather than
+        by sqluri, to avoid exposing any credentials in the sqluri.
+        """
+        status = {'primary': _get_pool_status(self._engine.pool)}
+        if self._replicas:
+            status['replicas'] = [_get_pool_status(replica.engine.pool)
+                                  for replica in self._replicas]
+        return status
+
+    def _get_read_replica(self):
+        """Pick a healthy read replica, or None to read from the primary."""
+        now = time.time()
+        for replica in self._replicas:
+            if now - replica.checked_at >= self._replica_check_interval:
+                self._check_replica(replica)
+        healthy = [r for r in self._replicas if r.healthy]
+        if not healthy:
+            return None
+        return random.choice(healthy)
+
+    def _check_replica(self, replica):
+        """Check whether a replica is reachable and not lagging too far."""
+        replica.checked_at = time.time()
+        try:
+            replica.engine.execute("select 1").close()
+            replica.lag = None
+            if replica.engine.dialect.name == 'mysql':
+                try:
+                    res = replica.engine.execute("show slave status")
+                    row = res.fetchone()
+                    res.close()
+                except OperationalError:
+                    # We may not have permission to check this.
+                    row = None
+                if row is not None and 'Seconds_Behind_Master' in row:
+                    replica.lag = row['Seconds_Behind_Master']
+        except Exception:
+            logger.exception("Read replica %s is unavailable", replica.sqluri)
+            replica.healthy = False
         else:
-            engine = None
+            replica.healthy = True
+            if replica.lag is not None:
+                annotate_request(None, 'tokenserver.backend.replica.lag',
+                                 replica.lag)
+                if self._max_replica_lag is not None:
+                    if replica.lag > self._max_replica_lag:
+                        logger.warning("Read replica %s is lagging by %ss",
+                                       replica.sqluri, replica.lag)
+                        replica.healthy = False
+        if not replica.healthy:
+            annotate_request(None, 'tokenserver.backend.replica.unhealthy', 1)
+
+    def _safe_read(self, *args, **kwds):
+        """Execute a read-only query, preferring a replica if we have one.
+
+        If the replica fails then it is marked as unhealthy until its next
+        check, and the query is re-run against the primary.
+        """
+        replica = self._get_read_replica()
+        if replica is not None:
+            try:
+                res = self._safe_execute(*args, engine=replica.engine, **kwds)
+            except BackendError:
+                replica.healthy = False
+                annotate_request(None, 'tokenserver.backend.replica.error', 1)
+            else:
+                annotate_request(None, 'tokenserver.backend.replica.read', 1)
+                return res
+        return self._safe_execute(*args, **kwds)
+
+    def _safe_execute(self, *args, **kwds):
+        """Execute an sqlalchemy query, raise BackendError on failure.
 
+        An explicit `engine` keyword argument can be used to pass in a
+        connection on which a transaction is already in progress.  We don't
+        use any engine bound to the query, because the table metadata is
+        shared between instances and will be bound to whichever instance
+        was created most recently.
+        """
+        engine = kwds.pop('engine', None)
         if engine is None:
-            engine = kwds.pop('engine', None)
-            if engine is None:
-                engine = self._get_engine(kwds.get('service'))
+            engine = self._get_engine(kwds.get('service'))
 
         if 'service' in kwds:
             kwds['service'] = self._get_service_id(kwds['service'])
@@ -282,55 +1159,246 @@ class SQLNodeAssignment(object):
             logger.error(err)
             raise BackendError(str(exc))
 
-    def get_user(self, service, email):
+    @contextlib.contextmanager
+    def _safe_transaction(self, service=None):
+        """Run a block in a db transaction, raise BackendError on failure.
+
+        This yields a connection that can be passed as the `engine` argument
+        to the other methods of this class, so that a sequence of statements
+        is run on a single connection and committed together.
+        """
+        engine = self._get_engine(service)
+        try:
+            connection = engine.connect()
+        except (OperationalError, TimeoutError), exc:
+            err = traceback.format_exc()
+            logger.error(err)
+            raise BackendError(str(exc))
+        try:
+            with connection.begin():
+                yield connection
+        finally:
+            connection.close()
+
+    def _get_cached_user(self, service, email):
+        if self._user_cache is None:
+            return None
+        user = self._user_cache.get((service, email))
+        if user is None:
+            annotate_request(None, 'tokenserver.backend.user_cache.miss', 1)
+            return None
+        annotate_request(None, 'tokenserver.backend.user_cache.hit', 1)
+        # Callers are free to modify the returned record, so hand out a copy.
+        return copy.deepcopy(user)
+
+    def _cache_user(self, service, user):
+        if self._user_cache is None:
+            return
+        evictions = self._user_cache.evictions
+        self._user_cache.put((service, user['email']), copy.deepcopy(user))
+        evictions = self._user_cache.evictions - evictions
+        if evictions:
+            annotate_request(None, 'tokenserver.backend.user_cache.eviction',
+                             evictions)
+
+    def _uncache_user(self, service, email):
+        if self._user_cache is not None:
+            self._user_cache.invalidate((service, email))
+
+    def _uncache_users_on_node(self, service, node):
+        if self._user_cache is None:
+            return
+        # The cache doesn't index users by node, so scan a snapshot of its
+        # contents.  Entries are (pos, user, expires) triples.
+        for key, entry in list(self._user_cache.data.items()):
+            if key[0] == service and entry[1]['node'] == node:
+                self._user_cache.invalidate(key)
+
+    def get_user(self, service, email, engine=None, primary=False):
+        """Returns the user record for the given service and email.
+
+        If read replicas are configured then this will read from one of them
+        by default; pass `primary=True` to read back the results of a recent
+        write.  It always reads from the primary if the records need repair.
+        """
+        user = None
+        if engine is None and not primary:
+            user = self._get_cached_user(service, email)
+        if user is None:
+            user = self._get_user_from_db(service, email, engine, primary)
+        return user
+
+    def _get_user_rows(self, service, email, engine=None):
         params = {'service': service, 'email': email}
-        res = self._safe_execute(_GET_USER_RECORDS, **params)
+        if engine is None:
+            res = self._safe_read(_GET_USER_RECORDS, **params)
+        else:
+            res = self._safe_execute(_GET_USER_RECORDS, engine=engine,
+                                     **params)
+        try:
+            rows = res.fetchall()
+        finally:
+            res.close()
+        # The query fetches rows ordered by created_at, but we want
+        # to ensure that they're ordered by (generation, created_at).
+        # This is almost always true, except for strange race conditions
+        # during row creation.  Sorting them is an easy way to enforce
+        # this without bloating the db index.
+        rows.sort(key=lambda r: (r.generation, r.created_at), reverse=True)
+        return rows
+
+    def _user_rows_need_repair(self, rows):
+        if not rows:
+            return False
+        if _needs_new_node(rows[0]):
+            return True
+        for old_row in rows[1:]:
+            if old_row.replaced_at is None:
+                return True
+        return False
+
+    def _get_user_from_db(self, service, email, engine=None, primary=False,
+                          history=True):
+        user = self._get_user_from_active_row(service, email, engine, primary)
+        # Only cache records that we've read without writing anything.
+        # Reading their history may write to the db, e.g. to assign them a
+        # new node, and writes invalidate the cache rather than populating
+        # it.  Nor do we cache what's read inside a caller's transaction,
+        # since it may yet be rolled back.
+        cacheable = user is not None and engine is None
+        if user is None and history:
+            user = self._get_user_from_history(service, email, engine,
+                                               primary)
+        self._apply_pending_updates(service, user)
+        if cacheable:
+            self._cache_user(service, user)
+        return user
+
+    def _apply_pending_updates(self, service, user):
+        """Reflect any bumps that we've queued but not yet written,
+        so that this process always reads its own writes."""
+        if user is None or self._pending_updates is None:
+            return
+        with self._pending_updates_lock:
+            pending = self._pending_updates.get((service, user['email']))
+        if pending is not None:
+            user['generation'] = max(pending['generation'],
+                                     user['generation'])
+            user['keys_changed_at'] = max(pending['keys_changed_at'],
+                                          user['keys_changed_at'])
+
+    def _get_user_from_active_row(self, service, email, engine=None,
+                                  primary=False):
+        """Get the user from their active record alone, if possible.
+
+        The active record carries a summary of the user's previously-seen
+        client-state values and the time they were first seen, so in the
+        common case we don't need to read their history.  This returns None
+        if the user's history needs to be consulted, i.e. if there is no
+        active record, it lacks a node or a summary, or there's more than
+        one of them due to a race in record creation.
+        """
+        params = {'service': service, 'email': email}
+        if engine is None and not primary:
+            res = self._safe_read(_GET_ACTIVE_USER_RECORD, **params)
+        else:
+            if engine is None:
+                engine = self._get_engine(service)
+            res = self._safe_execute(_GET_ACTIVE_USER_RECORD, engine=engine,
+                                     **params)
         try:
-            # The query fetches rows ordered by created_at, but we want
-            # to ensure that they're ordered by (generation, created_at).
-            # This is almost always true, except for strange race conditions
-            # during row creation.  Sorting them is an easy way to enforce
-            # this without bloating the db index.
             rows = res.fetchall()
-            rows.sort(key=lambda r: (r.generation, r.created_at), reverse=True)
-            if not rows:
-                return None
-            # The first row is the most up-to-date user record.
-            # The rest give previously-seen client-state values.
-            cur_row = rows[0]
-            old_rows = rows[1:]
-            user = {
-                'email': email,
-                'uid': cur_row.uid,
-                'node': cur_row.node,
-                'generation': cur_row.generation,
-                'keys_changed_at': cur_row.keys_changed_at or 0,
-                'client_state': cur_row.client_state,
-                'old_client_states': {},
-                'first_seen_at': cur_row.created_at,
-            }
-            # If the current row is marked as replaced or is missing a node,
-            # and they haven't been retired, then assign them a new node.
-            if cur_row.replaced_at is not None or cur_row.node is None:
-                if cur_row.generation < MAX_GENERATION:
-                    user = self.allocate_user(service, email,
-                                              cur_row.generation,
-                                              cur_row.client_state,
-                                              cur_row.keys_changed_at)
-            for old_row in old_rows:
-                # Collect any previously-seen client-state values.
-                if old_row.client_state != user['client_state']:
-                    user['old_client_states'][old_row.client_state] = True
-                # Make sure each old row is marked as replaced.
-                # They might not be, due to races in row creation.
-                if old_row.replaced_at is None:
-                    timestamp = cur_row.created_at
-                    self.replace_user_record(service, old_row.uid, timestamp)
-                # Track backwards to the oldest timestamp at which we saw them.
-                user['first_seen_at'] = old_row.created_at
-            return user
         finally:
             res.close()
+        if len(rows) != 1:
+            return None
+        row = rows[0]
+        if row.node is None or row.old_client_states is None or \
+                row.first_seen_at is None:
+            return None
+        return {
+            'email': email,
+            'uid': row.uid,
+            'node': row.node,
+            'generation': row.generation,
+            'keys_changed_at': row.keys_changed_at or 0,
+            'client_state': row.client_state,
+            'old_client_states': _decode_client_states(row.old_client_states),
+            'first_seen_at': row.first_seen_at,
+        }
+
+    def _get_user_from_history(self, service, email, engine=None,
+                               primary=False, rows=None, node=None,
+                               nodeid=None):
+        """Get the user from their full history, repairing it if need be.
+
+        The records can be given as `rows`, if they've already been read
+        from the primary.  If the user needs a new node then they're given
+        `node` if it's given, and otherwise the best one available.
+        """
+        from_primary = True
+        if rows is None and engine is None and not primary and \
+                self._replicas:
+            rows = self._get_user_rows(service, email)
+            from_primary = False
+            # Repairing the records means writing to the primary, and we
+            # mustn't do that based on possibly-stale data from a replica.
+            if self._user_rows_need_repair(rows):
+                rows = self._get_user_rows(service, email,
+                                           self._get_engine(service))
+                from_primary = True
+        elif rows is None:
+            # Leave `engine` as None unless the caller gave one, so that
+            # writes below know that they're not in a caller's transaction.
+            rows = self._get_user_rows(service, email,
+                                       engine or self._get_engine(service))
+        if not rows:
+            return None
+        # The first row is the most up-to-date user record.
+        # The rest give previously-seen client-state values.
+        cur_row = rows[0]
+        old_client_states, first_seen_at = _summarize_user_history(rows)
+        user = {
+            'email': email,
+            'uid': cur_row.uid,
+            'node': cur_row.node,
+            'generation': cur_row.generation,
+            'keys_changed_at': cur_row.keys_changed_at or 0,
+            'client_state': cur_row.client_state,
+            'old_client_states': old_client_states,
+            'first_seen_at': first_seen_at,
+        }
+        # Make sure each old row is marked as replaced.
+        # They might not be, due to races in row creation.
+        unreplaced_uids = [old_row.uid for old_row in rows[1:]
+                           if old_row.replaced_at is None]
+        # If the current row is marked as replaced or is missing a node,
+        # and they haven't been retired, then assign them a new node.
+        # The new record carries forward the summary of their history.
+        if _needs_new_node(cur_row):
+            user = self.allocate_user(
+                service, email, cur_row.generation, cur_row.client_state,
+                cur_row.keys_changed_at, node=node, nodeid=nodeid,
+                engine=engine, old_client_states=user['old_client_states'],
+                first_seen_at=user['first_seen_at'])
+        # Repair them all with a single statement, rather than
+        # one write per row.
+        if unreplaced_uids:
+            self._replace_user_records_by_uid(service, unreplaced_uids,
+                                              cur_row.created_at,
+                                              engine=engine)
+        # If the active record doesn't have a summary of their history,
+        # e.g. because it was written by an older version of this code,
+        # then store one so that future reads can use it alone.
+        elif cur_row.old_client_states is None and \
+                cur_row.uid == user['uid'] and from_primary:
+            res = self._safe_execute(
+                _SET_USER_HISTORY_SUMMARY, engine=engine, service=service,
+                uid=cur_row.uid, first_seen_at=user['first_seen_at'],
+                old_client_states=_encode_client_states(
+                    user['old_client_states']))
+            res.close()
+        return user
 
     def get_migration_percent(self):
         """get a cached Ops controllable percentage value for the number of
@@ -352,6 +1420,9 @@ class SQLNodeAssignment(object):
                 "Could not get migration percent \"{}\" using default: {}"
                 .format(ex, default)
             )
+            # Don't look it up again for every new user in the meantime.
+            self._migration_percentage_cache_ttl = \
+                time.time() + MIGRATION_CACHE_LIFESPAN
         return self.migrate_new_user_percentage
 
     def should_allocate_to_spanner(self, email):
@@ -365,14 +1436,64 @@ class SQLNodeAssignment(object):
         else:
             return False
 
+    def get_or_create_user(self, service, email, generation=0,
+                           client_state='', keys_changed_at=0):
+        # The two steps are timed separately, under the same names as when
+        # the caller did them with get_user() and allocate_user().
+        # Returning users are read from their active record, outside of any
+        # transaction, so they can be served from the cache or a replica
+        # when we have them.
+        with metrics_timer('tokenserver.backend.get_user'):
+            user = self._get_cached_user(service, email)
+            if user is None:
+                user = self._get_user_from_db(service, email, history=False)
+        if user is not None:
+            return user
+        with metrics_timer('tokenserver.backend.allocate_user'):
+            # Claim a slot on a node first, in its own statement, so that
+            # the lock on the node's row is released straight away rather
+            # than being held until the user's record is written.
+            nodeid, node = self.get_best_node(service, email)
+            try:
+                # Then read their full history, just once, in the
+                # transaction that creates their record.  That tells us
+                # whether they're new, or had their node unassigned, or
+                # were created by a concurrent request.
+                with self._safe_transaction(service) as connection:
+                    rows = self._get_user_rows(service, email, connection)
+                    if not rows:
+                        user = self.allocate_user(
+                            service, email, generation, client_state,
+                            keys_changed_at, node=node, nodeid=nodeid,
+                            engine=connection)
+                        slot_used = True
+                    else:
+                        slot_used = _needs_new_node(rows[0])
+                        user = self._get_user_from_history(
+                            service, email, connection, rows=rows,
+                            node=node, nodeid=nodeid)
+            except Exception:
+                self._return_node_slot(service, nodeid, node)
+                raise
+            if not slot_used:
+                self._return_node_slot(service, nodeid, node)
+        self._apply_pending_updates(service, user)
+        return user
+
     def allocate_user(self, service, email, generation=0, client_state='',
-                      keys_changed_at=0, node=None, timestamp=None):
+                      keys_changed_at=0, node=None, timestamp=None,
+                      engine=None, old_client_states=None,
+                      first_seen_at=None, nodeid=None):
         if timestamp is None:
             timestamp = get_timestamp()
+        if old_client_states is None:
+            old_client_states = {}
+        if first_seen_at is None:
+            first_seen_at = timestamp
         if node is None:
-            nodeid, node = self.get_best_node(service, email)
-        else:
-            nodeid = self.get_node_id(service, node)
+            nodeid, node = self.get_best_node(service, email, engine=engine)
+        elif nodeid is None:
+            nodeid = self.get_node_id(service, node, engine=engine)
         params = {
             'service': service,
             'email': email,
@@ -380,19 +1501,149 @@ class SQLNodeAssignment(object):
             'generation': generation,
             'keys_changed_at': keys_changed_at,
             'client_state': client_state,
-            'timestamp': timestamp
+            'timestamp': timestamp,
+            'old_client_states': _encode_client_states(old_client_states),
+            'first_seen_at': first_seen_at,
         }
-        res = self._safe_execute(_CREATE_USER_RECORD, **params)
-        return {
+        res = self._safe_execute(_CREATE_USER_RECORD, engine=engine, **params)
+        user = {
             'email': email,
             'uid': res.lastrowid,
             'node': node,
             'generation': generation,
             'keys_changed_at': keys_changed_at,
             'client_state': client_state,
-            'old_client_states': {},
-            'first_seen_at': timestamp,
+            'old_client_states': dict(old_client_states),
+            'first_seen_at': first_seen_at,
         }
+        # Don't cache the new record directly; if we raced with another
+        # allocation then the next read from the db needs to sort it out.
+        self._uncache_user(service, email)
+        return user
+
+    def allocate_users(self, service, emails, node=None):
+        """Create new user records for many emails at once.
+
+        Users are created in batches, each in a single transaction, with
+        the load on their nodes updated once per node per batch rather than
+        once per user.  Emails that already have an active record are
+        skipped.  Returns the newly-created user records, in the format
+        described for get_user(), in the order the emails were given.
+        """
+        users = []
+        batch = []
+        for email in emails:
+            batch.append(email)
+            if len(batch) >= ALLOCATE_USERS_BATCH_SIZE:
+                users.extend(self._allocate_user_batch(service, batch, node))
+                batch = []
+        if batch:
+            users.extend(self._allocate_user_batch(service, batch, node))
+        return users
+
+    def _allocate_user_batch(self, service, emails, node=None):
+        emails = list(OrderedDict.fromkeys(emails))
+        timestamp = get_timestamp()
+        with self._safe_transaction(service) as connection:
+            res = self._safe_execute(self._get_active_emails_query,
+                                     engine=connection, service=service,
+                                     emails=emails)
+            existing = set(row.email for row in res)
+            res.close()
+            emails = [email for email in emails if email not in existing]
+            if not emails:
+                return []
+            # Work out which node each new user goes on.
+            if node is not None:
+                nodeid = self.get_node_id(service, node, engine=connection)
+                assignments = [(nodeid, node)] * len(emails)
+            else:
+                assignments = self._claim_nodes_for_emails(service, emails,
+                                                           connection)
+            service_id = self._get_service_id(service)
+            params = []
+            for email, (nodeid, _) in zip(emails, assignments):
+                params.append({
+                    'service': service_id,
+                    'email': email,
+                    'nodeid': nodeid,
+                    'generation': 0,
+                    'keys_changed_at': 0,
+                    'client_state': '',
+                    'timestamp': timestamp,
+                    'old_client_states': _encode_client_states(()),
+                    'first_seen_at': timestamp,
+                })
+            self._safe_execute(_CREATE_USER_RECORD, params,
+                               engine=connection).close()
+            res = self._safe_execute(self._get_created_uids_query,
+                                     engine=connection, service=service,
+                                     emails=emails, timestamp=timestamp)
+            uids = dict((row.email, row.uid) for row in res)
+            res.close()
+        users = []
+        for email, (_, node) in zip(emails, assignments):
+            self._uncache_user(service, email)
+            users.append({
+                'email': email,
+                'uid': uids[email],
+                'node': node,
+                'generation': 0,
+                'keys_changed_at': 0,
+                'client_state': '',
+                'old_client_states': {},
+                'first_seen_at': timestamp,
+            })
+        return users
+
+    def _claim_nodes_for_emails(self, service, emails, engine):
+        """Assign each email to a node, claiming slots on the nodes in bulk.
+
+        Returns a list of (nodeid, node) pairs, one for each email.
+        """
+        assignments = [None] * len(emails)
+        to_spanner = []
+        to_nodes = []
+        for i, email in enumerate(emails):
+            if self.should_allocate_to_spanner(email):
+                to_spanner.append(i)
+            else:
+                to_nodes.append(i)
+        if to_spanner:
+            nodeid, node = self._get_spanner_node(service, engine,
+                                                  size=len(to_spanner))
+            for i in to_spanner:
+                assignments[i] = (nodeid, node)
+        # Claim a block of slots on the chosen node, as many as we need or
+        # as it has available, and go round again until we have enough.
+        # The node snapshot can't see the slots we've claimed so far in
+        # this transaction, so always choose from the db.
+        failures = 0
+        while to_nodes:
+            row = self._select_node(service, engine=engine,
+                                    use_snapshot=False)
+            if row is None:
+                if self._release_capacity_on_demand(service, engine):
+                    continue
+                raise BackendError('unable to get a node')
+            size = int(min(len(to_nodes), row.available,
+                           row.capacity - row.current_load))
+            res = self._safe_execute(self._lease_node_slots_query,
+                                     engine=engine, b_nodeid=row.id,
+                                     size=size)
+            res.close()
+            self._invalidate_node_snapshot()
+            if res.rowcount == 0:
+                annotate_request(None, 'tokenserver.backend.claim_conflict',
+                                 1)
+                failures += 1
+                if failures >= MAX_NODE_CLAIM_ATTEMPTS:
+                    raise BackendError('unable to get a node')
+                continue
+            for i in to_nodes[:size]:
+                assignments[i] = (row.id, str(row.node))
+            to_nodes = to_nodes[size:]
+        return assignments
 
     def update_user(self, service, user, generation=None, client_state=None,
                     keys_changed_at=None, node=None):
@@ -401,14 +1652,19 @@ class SQLNodeAssignment(object):
             # Note that if we're changing keys_changed_at without changing
             # client_state, it's because we're seeing an existing value of
             # keys_changed_at for the first time.
-            params = {
-                'service': service,
-                'email': user['email'],
-                'generation': generation,
-                'keys_changed_at': keys_changed_at
-            }
-            res = self._safe_execute(_UPDATE_USER_RECORD_IN_PLACE, **params)
-            res.close()
+            if self._pending_updates is not None:
+                self._queue_in_place_update(service, user['email'],
+                                            generation, keys_changed_at)
+            else:
+                params = {
+                    'service': service,
+                    'email': user['email'],
+                    'generation': generation,
+                    'keys_changed_at': keys_changed_at
+                }
+                res = self._safe_execute(_UPDATE_USER_RECORD_IN_PLACE,
+                                         **params)
+                res.close()
             user['generation'] = max(generation, user['generation'])
             user['keys_changed_at'] = max(keys_changed_at,
                                           user['keys_changed_at'])
@@ -442,25 +1698,94 @@ class SQLNodeAssignment(object):
                 keys_changed_at = max(user['keys_changed_at'], keys_changed_at)
             else:
                 keys_changed_at = user['keys_changed_at']
+            # The new record carries the summary of their history,
+            # including the client-state that it replaces.
+            old_client_states = dict(user['old_client_states'])
+            if client_state != user['client_state']:
+                old_client_states[user['client_state']] = True
             now = get_timestamp()
             params = {
                 'service': service, 'email': user['email'],
                 'nodeid': nodeid, 'generation': generation,
                 'keys_changed_at': keys_changed_at,
                 'client_state': client_state, 'timestamp': now,
+                'old_client_states': _encode_client_states(old_client_states),
+                'first_seen_at': user['first_seen_at'],
             }
             res = self._safe_execute(_CREATE_USER_RECORD, **params)
             res.close()
             user['uid'] = res.lastrowid
             user['generation'] = generation
             user['keys_changed_at'] = keys_changed_at
-            user['old_client_states'][user['client_state']] = True
+            user['old_client_states'] = old_client_states
             user['client_state'] = client_state
             # mark old records as having been replaced.
             # if we crash here, they are unmarked and we may fail to
             # garbage collect them for a while, but the active state
             # will be undamaged.
-            self.replace_user_records(service, user['email'], now)
+            res = self._safe_execute(_REPLACE_EARLIER_USER_RECORDS,
+                                     service=service, email=user['email'],
+                                     uid=user['uid'], timestamp=now)
+            res.close()
+        self._uncache_user(service, user['email'])
+
+    def _queue_in_place_update(self, service, email, generation=None,
+                               keys_changed_at=None):
+        """Queue an in-place update to be written by the next flush.
+
+        Repeated updates for the same user are merged, keeping the largest
+        value seen for each field.
+        """
+        key = (service, email)
+        with self._pending_updates_lock:
+            pending = self._pending_updates.get(key)
+            if pending is None:
+                pending = self._pending_updates[key] = {
+                    'generation': None,
+                    'keys_changed_at': None,
+                }
+            pending['generation'] = max(pending['generation'], generation)
+            pending['keys_changed_at'] = max(pending['keys_changed_at'],
+                                             keys_changed_at)
+
+    def flush_pending_updates(self):
+        """Write any queued in-place user updates to the db.
+
+        The updates are sent in batches, moving each field forward
+        independently so that none is ever moved backwards.  If the
+        write fails then the updates are put back in the queue to be retried
+        by the next flush.  Returns the number of user records updated.
+        """
+        if self._pending_updates is None:
+            return 0
+        with self._pending_updates_lock:
+            pending = self._pending_updates
+            self._pending_updates = {}
+        if not pending:
+            return 0
+        items = pending.items()
+        try:
+            while items:
+                params = []
+                for (service, email), fields in \
+                        items[:UPDATE_FLUSH_BATCH_SIZE]:
+                    params.append({
+                        'service': self._get_service_id(service),
+                        'email': email,
+                        'generation': fields['generation'],
+                        'keys_changed_at': fields['keys_changed_at'],
+                    })
+                with self._safe_transaction() as connection:
+                    res = self._safe_execute(_MERGE_USER_RECORD_UPDATE,
+                                             params, engine=connection)
+                    res.close()
+                # This batch is safely written, don't retry it on error.
+                del items[:UPDATE_FLUSH_BATCH_SIZE]
+        except Exception:
+            for (service, email), fields in items:
+                self._queue_in_place_update(service, email, **fields)
+            raise
+        return len(pending)
 
     def retire_user(self, email, engine=None):
         now = get_timestamp()
@@ -471,11 +1796,14 @@ class SQLNodeAssignment(object):
         # since we can't shard by service name here.
         res = self._safe_execute(_RETIRE_USER_RECORDS, engine=engine, **params)
         res.close()
+        # Retirement applies to every service, so drop them all from cache.
+        for service in self._cached_service_ids.keys():
+            self._uncache_user(service, email)
 
     def count_users(self, timestamp=None):
         if timestamp is None:
             timestamp = get_timestamp()
-        res = self._safe_execute(_COUNT_USER_RECORDS, timestamp=timestamp)
+        res = self._safe_read(_COUNT_USER_RECORDS, timestamp=timestamp)
         row = res.fetchone()
         res.close()
         return row[0]
@@ -484,10 +1812,14 @@ class SQLNodeAssignment(object):
     # Methods for low-level user record management.
     #
 
-    def get_user_records(self, service, email):
+    def get_user_records(self, service, email, primary=False):
         """Get all the user's records for a service, including the old ones."""
         params = {'service': service, 'email': email}
-        res = self._safe_execute(_GET_ALL_USER_RECORDS_FOR_SERVICE, **params)
+        if primary:
+            res = self._safe_execute(_GET_ALL_USER_RECORDS_FOR_SERVICE,
+                                     **params)
+        else:
+            res = self._safe_read(_GET_ALL_USER_RECORDS_FOR_SERVICE, **params)
         try:
             for row in res:
                 yield row
@@ -495,24 +1827,42 @@ class SQLNodeAssignment(object):
             res.close()
 
     def get_old_user_records(self, service, grace_period=-1, limit=100,
-                             offset=0):
+                             offset=0, primary=False):
         """Get user records that were replaced outside the grace period."""
-        if grace_period < 0:
-            grace_period = 60 * 60 * 24 * 7  # one week, in seconds
-        grace_period = int(grace_period * 1000)  # convert seconds -> millis
         params = {
             "service": service,
-            "timestamp": get_timestamp() - grace_period,
+            "timestamp": _get_grace_period_cutoff(grace_period),
             "limit": limit,
             "offset": offset
         }
-        res = self._safe_execute(_GET_OLD_USER_RECORDS_FOR_SERVICE, **params)
+        if primary:
+            res = self._safe_execute(_GET_OLD_USER_RECORDS_FOR_SERVICE,
+                                     **params)
+        else:
+            res = self._safe_read(_GET_OLD_USER_RECORDS_FOR_SERVICE, **params)
         try:
             for row in res:
                 yield row
         finally:
             res.close()
 
+    def count_old_user_records(self, service, grace_period=-1,
+                               primary=False):
+        """Count user records that were replaced outside the grace period."""
+        params = {
+            "service": service,
+            "timestamp": _get_grace_period_cutoff(grace_period),
+        }
+        if primary:
+            res = self._safe_execute(_COUNT_OLD_USER_RECORDS_FOR_SERVICE,
+                                     **params)
+        else:
+            res = self._safe_read(_COUNT_OLD_USER_RECORDS_FOR_SERVICE,
+                                  **params)
+        row = res.fetchone()
+        res.close()
+        return row[0]
+
     def replace_user_records(self, service, email, timestamp=None):
         """Mark all existing service records for a user as replaced."""
         if timestamp is None:
@@ -522,37 +1872,99 @@ class SQLNodeAssignment(object):
         }
         res = self._safe_execute(_REPLACE_USER_RECORDS, **params)
         res.close()
+        self._uncache_user(service, email)
 
-    def replace_user_record(self, service, uid, timestamp=None):
+    def replace_user_record(self, service, uid, timestamp=None, engine=None):
         """Mark an existing service record as replaced."""
         if timestamp is None:
             timestamp = get_timestamp()
         params = {
             'service': service, 'uid': uid, 'timestamp': timestamp
         }
-        res = self._safe_execute(_REPLACE_USER_RECORD, **params)
+        res = self._safe_execute(_REPLACE_USER_RECORD, engine=engine, **params)
+        res.close()
+
+    def _replace_user_records_by_uid(self, service, uids, timestamp,
+                                     engine=None):
+        """Mark several existing service records as replaced at once."""
+        params = {
+            'service': service, 'uids': uids, 'timestamp': timestamp
+        }
+        res = self._safe_execute(_REPLACE_USER_RECORDS_BY_UID, engine=engine,
+                                 **params)
         res.close()
 
     def delete_user_record(self, service, uid):
         """Delete the user record with the given uid."""
         params = {'service': service, 'uid': uid}
+        res = self._safe_execute(_GET_EMAIL_FOR_USER_RECORD, **params)
+        row = res.fetchone()
+        res.close()
         res = self._safe_execute(_FREE_SLOT_ON_NODE, **params)
         res.close()
         res = self._safe_execute(_DELETE_USER_RECORD, **params)
         res.close()
+        # The deleted record no longer contributes to the user's history,
+        # so their active record's summary of it must be re-computed.
+        if row is not None:
+            res = self._safe_execute(_CLEAR_USER_HISTORY_SUMMARY,
+                                     service=service, email=row.email)
+            res.close()
+            # This can change the first_seen_at of their cached record.
+            self._uncache_user(service, row.email)
 
     #
     # Nodes management
     #
 
+    def _get_node_snapshot(self):
+        """Get the current snapshot of the services and nodes tables.
+
+        The snapshot is reloaded if it's older than node_snapshot_interval,
+        or has been invalidated by a change made through this backend.
+        Returns None if snapshots are disabled.
+        """
+        interval = self._node_snapshot_interval
+        if interval <= 0:
+            return None
+        snapshot = self._node_snapshot
+        now = time.time()
+        if snapshot is None or now - snapshot.loaded_at > interval:
+            with self._node_snapshot_lock:
+                # Another thread may have reloaded it while we waited.
+                snapshot = self._node_snapshot
+                if snapshot is None or now - snapshot.loaded_at > interval:
+                    snapshot = self._load_node_snapshot()
+        _set_request_metric('tokenserver.backend.node_snapshot.version',
+                            snapshot.version)
+        _set_request_metric('tokenserver.backend.node_snapshot.age',
+                            time.time() - snapshot.loaded_at)
+        return snapshot
+
+    def _load_node_snapshot(self):
+        res = self._safe_execute(self._get_all_services_query)
+        service_rows = res.fetchall()
+        res.close()
+        res = self._safe_execute(self._get_all_nodes_query)
+        node_rows = res.fetchall()
+        res.close()
+        self._node_snapshot_version += 1
+        snapshot = _NodeSnapshot(self._node_snapshot_version,
+                                 service_rows, node_rows)
+        self._cached_service_ids.update(snapshot.service_ids)
+        self._node_snapshot = snapshot
+        return snapshot
+
+    def _invalidate_node_snapshot(self):
+        """Have the node snapshot reloaded the next time it's used."""
+        self._node_snapshot = None
+
     def _get_service_id(self, service):
         try:
             return self._cached_service_ids[service]
         except KeyError:
-            services = self._get_services_table(service)
-            query = select([services.c.id])
-            query = query.where(services.c.service == service)
-            res = self._safe_execute(query)
+            res = self._safe_execute(self._get_service_id_query,
+                                     service_name=service)
             row = res.fetchone()
             res.close()
             if row is None:
@@ -563,7 +1975,7 @@ class SQLNodeAssignment(object):
     def get_patterns(self):
         """Returns all the service URL patterns."""
         query = select([self.services])
-        res = self._safe_execute(query)
+        res = self._safe_read(query)
         patterns = list(res.fetchall())
         for row in patterns:
             self._cached_service_ids[row.service] = row.id
@@ -577,6 +1989,7 @@ class SQLNodeAssignment(object):
           values (:servicename, :pattern)
         """), servicename=service, pattern=pattern, **kwds)
         res.close()
+        self._invalidate_node_snapshot()
         return res.lastrowid
 
     def add_node(self, service, node, capacity, **kwds):
@@ -608,149 +2021,596 @@ class SQLNodeAssignment(object):
             backoff=kwds.get('backoff', 0),
         )
         res.close()
+        self._invalidate_node_snapshot()
 
     def update_node(self, service, node, **kwds):
         """Updates node fields in the db."""
 
-        nodes = self._get_nodes_table(service)
-        service = self._get_service_id(service)
-
-        where = [nodes.c.service == service, nodes.c.node == node]
-        where = and_(*where)
         values = {}
         for field in NODE_FIELDS:
             try:
-                values[field] = kwds.pop(field)
+                values['new_' + field] = kwds.pop(field)
             except KeyError:
                 pass
         if kwds:
             raise ValueError("unknown fields: " + str(kwds.keys()))
-        query = update(nodes, where, values)
-        con = self._safe_execute(query, close=True)
+        # Stop handing out slots from any lease on the node, since it may
+        # be going out of service.  If its load is being reset then the
+        # leased slots are accounted for by the new values.
+        if 'new_current_load' in values or 'new_available' in values:
+            self._forget_node_leases(service, node)
+        else:
+            self.release_node_leases(service, node)
+        service_id = self._get_service_id(service)
+        fields = tuple(sorted(values))
+        try:
+            query = self._update_node_queries[fields]
+        except KeyError:
+            nodes = self._get_nodes_table(service)
+            query = update(nodes).where(and_(
+                nodes.c.service == bindparam('b_service'),
+                nodes.c.node == bindparam('b_node'),
+            )).values(dict(
+                (field[len('new_'):], bindparam(field)) for field in fields
+            ))
+            self._update_node_queries[fields] = query
+        con = self._safe_execute(query, b_service=service_id, b_node=node,
+                                 **values)
         con.close()
+        self._invalidate_node_snapshot()
 
-    def get_node_id(self, service, node):
+    def get_node_id(self, service, node, engine=None):
         """Get numeric id for a node."""
-        res = self._safe_execute(sqltext(
-            """
-            select id from nodes
-            where service=:service and node=:node
-            """),
-            service=service, node=node
-        )
+        snapshot = self._get_node_snapshot()
+        if snapshot is not None:
+            service_id = snapshot.service_ids.get(service)
+            nodeid = snapshot.node_ids.get((service_id, node))
+            if nodeid is not None:
+                return nodeid
+            # It may have been added since the snapshot was taken.
+        res = self._safe_execute(_GET_NODE_ID, service=service, node=node,
+                                 engine=engine)
         row = res.fetchone()
         res.close()
         if row is None:
             raise ValueError("unknown node: " + node)
         return row[0]
 
-    def remove_node(self, service, node, timestamp=None):
-        """Remove definition for a node."""
+    def remove_node(self, service, node, timestamp=None, batch_size=None,
+                    max_rate=None, start_uid=0, progress=None):
+        """Remove definition for a node.
+
+        If `batch_size` is given then the node's users are unassigned in
+        batches, as for unassign_node().  In that case the node is marked
+        as downed and its users unassigned before it's removed, so that if
+        this is interrupted it can be re-run to pick up where it left off.
+        """
         nodeid = self.get_node_id(service, node)
-        res = self._safe_execute(sqltext(
-            """
-            delete from nodes where id=:nodeid
-            """),
-            service=service, nodeid=nodeid
-        )
+        self._forget_node_leases(service, node)
+        if not batch_size:
+            res = self._safe_execute(_DELETE_NODE, service=service,
+                                     nodeid=nodeid)
+            res.close()
+            self._invalidate_node_snapshot()
+            self.unassign_node(service, node, timestamp, nodeid=nodeid)
+            return
+        self.update_node(service, node, downed=1)
+        last_uid = self.unassign_node(service, node, timestamp, nodeid,
+                                      batch_size, max_rate, start_uid,
+                                      progress)
+        res = self._safe_execute(_DELETE_NODE, service=service,
+                                 nodeid=nodeid)
         res.close()
-        self.unassign_node(service, node, timestamp, nodeid=nodeid)
-
-    def unassign_node(self, service, node, timestamp=None, nodeid=None):
-        """Clear any assignments to a node."""
+        self._invalidate_node_snapshot()
+        # Catch any users that were assigned to the node while we worked.
+        # They'll have been given higher uids than the ones we've done.
+        self.unassign_node(service, node, timestamp, nodeid, batch_size,
+                           max_rate, last_uid, progress)
+
+    def unassign_node(self, service, node, timestamp=None, nodeid=None,
+                      batch_size=None, max_rate=None, start_uid=0,
+                      progress=None):
+        """Clear any assignments to a node.
+
+        By default this is done in a single statement.  If `batch_size` is
+        given then the node's active records are instead walked in order of
+        uid, starting after `start_uid`, and marked as replaced in separate
+        batches of up to that many records, so that no one transaction gets
+        too big.  `max_rate` optionally limits the number of records per
+        second, and `progress` is called as progress(last_uid, count) after
+        each batch.  Records that have already been replaced are skipped,
+        so an interrupted run can be resumed by running it again, or more
+        quickly by giving the last uid that it reported as `start_uid`.
+        Returns the last uid that was processed, in batched mode.
+        """
         if timestamp is None:
             timestamp = get_timestamp()
         if nodeid is None:
             nodeid = self.get_node_id(service, node)
-        res = self._safe_execute(sqltext(
-            """
-            update users
-            set replaced_at=:timestamp
-            where nodeid=:nodeid
-            """),
-            nodeid=nodeid, timestamp=timestamp
-        )
+        self.release_node_leases(service, node)
+        try:
+            if batch_size:
+                return self._unassign_node_in_batches(
+                    nodeid, timestamp, batch_size, max_rate, start_uid,
+                    progress)
+            res = self._safe_execute(_UNASSIGN_NODE, nodeid=nodeid,
+                                     timestamp=timestamp)
+            res.close()
+        finally:
+            self._uncache_users_on_node(service, node)
+
+    def _unassign_node_in_batches(self, nodeid, timestamp, batch_size,
+                                  max_rate=None, start_uid=0, progress=None):
+        last_uid = start_uid
+        count = 0
+        start = time.time()
+        while True:
+            res = self._safe_execute(self._get_node_user_batch_query,
+                                     nodeid=nodeid, last_uid=last_uid,
+                                     batch_size=int(batch_size))
+            uids = [row.uid for row in res]
+            res.close()
+            if not uids:
+                break
+            res = self._safe_execute(self._unassign_user_batch_query,
+                                     b_nodeid=nodeid, b_first_uid=uids[0],
+                                     b_last_uid=uids[-1],
+                                     b_timestamp=timestamp)
+            res.close()
+            count += res.rowcount
+            last_uid = uids[-1]
+            if progress is not None:
+                progress(last_uid, count)
+            _throttle(start, count, max_rate)
+        return last_uid
+
+    def reassign_replaced_users(self, service, timestamp, batch_size=100,
+                                max_rate=None, start_uid=0, progress=None):
+        """Give new node assignments to users whose records were replaced
+        at or after the given timestamp, e.g. by unassign_node() or
+        remove_node().
+
+        Otherwise they'd be reassigned when they next show up, and after a
+        node is drained that tends to happen to many of them at once.  This
+        works through the replaced records in order of uid, in batches of
+        `batch_size`, and does the same reassignment for each user as their
+        next request would.  Users who have already been reassigned, or who
+        have been retired, are left alone.  `max_rate` optionally limits
+        the number of users per second, and `progress` is called as
+        progress(last_uid, count) after each batch.  If interrupted, this
+        can be resumed by running it again with the same timestamp, even
+        if the node has been unassigned again since, or more quickly by
+        giving the last uid that it reported as `start_uid`.  A user with
+        several records replaced since the timestamp is counted once for
+        each of them.  Returns the last uid that was processed.
+        """
+        last_uid = start_uid
+        count = 0
+        start = time.time()
+        while True:
+            res = self._safe_execute(self._get_replaced_user_batch_query,
+                                     service=service, timestamp=timestamp,
+                                     last_uid=last_uid,
+                                     batch_size=int(batch_size))
+            rows = res.fetchall()
+            res.close()
+            if not rows:
+                break
+            for row in rows:
+                self.get_user(service, row.email, primary=True)
+            count += len(rows)
+            last_uid = rows[-1].uid
+            if progress is not None:
+                progress(last_uid, count)
+            _throttle(start, count, max_rate)
+        return last_uid
+
+    def reconcile_node_loads(self, service=None, batch_size=1000,
+                             max_rate=None, dry_run=False):
+        """Recompute the load on each node from its active records.
+
+        A node's current_load can drift from the number of users actually
+        assigned to it, e.g. through races between concurrent allocations.
+        This counts the active records on each node, optionally only those
+        for the given service, in chunks of up to `batch_size` records and
+        at up to `max_rate` records per second, and corrects current_load
+        to match, adjusting the available slots by the same amount.  Unless
+        `dry_run` is set, in which case nothing is changed.
+
+        Users allocated while a node is being counted may be missed, and
+        load on the spanner node that other processes have yet to flush will
+        be counted twice.  Slots leased by other processes are not counted
+        as in use, so once they're returned the node's load is undercounted
+        until it's next reconciled, although its available slots are kept
+        within its capacity.  So this is best run while the nodes are quiet.
+        Returns a list of (service, node, recorded load, actual load) for
+        every node.
+        """
+        # Return any slots that we've leased, so that they're not counted,
+        # and write out any load that we've been counting in memory.
+        self.release_node_leases()
+        self.flush_spanner_load()
+        res = self._safe_execute(self._get_all_services_query)
+        service_names = dict((row.id, row.service) for row in res)
         res.close()
-
-    def get_best_node(self, service, email):
+        res = self._safe_execute(self._get_all_nodes_query)
+        node_rows = sorted(res.fetchall(), key=lambda row: row.id)
+        res.close()
+        results = []
+        count = 0
+        start = time.time()
+        for row in node_rows:
+            node_service = service_names.get(row.service)
+            if service is not None and node_service != service:
+                continue
+            actual = 0
+            last_uid = 0
+            while True:
+                res = self._safe_execute(self._count_node_user_chunk_query,
+                                         nodeid=row.id, last_uid=last_uid,
+                                         batch_size=int(batch_size))
+                chunk_count, chunk_last_uid = res.fetchone()
+                res.close()
+                actual += chunk_count
+                count += chunk_count
+                _throttle(start, count, max_rate)
+                if chunk_count < batch_size:
+                    break
+                last_uid = chunk_last_uid
+            results.append((node_service, row.node, row.current_load, actual))
+            if not dry_run and actual != row.current_load:
+                res = self._safe_execute(self._correct_node_load_query,
+                                         b_nodeid=row.id,
+                                         delta=actual - row.current_load)
+                res.close()
+                self._invalidate_node_snapshot()
+        return results
+
+    def backfill_user_history_summaries(self, batch_size=1000, max_rate=None,
+                                        start_uid=0, progress=None):
+        """Store a summary of their history on active records lacking one.
+
+        Active records written before the summary was added to the schema
+        can't be used on their own, so get_user() reads the user's history
+        and fills in the summary the first time it sees them.  This does the
+        same ahead of time for every such record, in order of uid starting
+        after `start_uid`, in batches of up to `batch_size` records that
+        are each written in their own transaction.  `max_rate` optionally
+        limits the number of records per second, and `progress` is called
+        as progress(last_uid, count) after each batch.  Records whose
+        history needs repair are left for get_user() to deal with.  If
+        interrupted, this can be resumed by running it again, or more quickly
+        by giving the last uid that it reported as `start_uid`.  Returns the
+        last uid that was processed.
+        """
+        res = self._safe_execute(self._get_all_services_query)
+        service_names = dict((row.id, row.service) for row in res)
+        res.close()
+        last_uid = start_uid
+        count = 0
+        start = time.time()
+        while True:
+            res = self._safe_execute(self._get_unsummarized_user_batch_query,
+                                     last_uid=last_uid,
+                                     batch_size=int(batch_size))
+            batch = res.fetchall()
+            res.close()
+            if not batch:
+                break
+            params = []
+            for row in batch:
+                # Read their history just as get_user() would, so that the
+                # summary covers the same records.
+                rows = self._get_user_rows(service_names[row.service],
+                                           row.email,
+                                           self._get_engine(None))
+                if not rows or rows[0].uid != row.uid or \
+                        self._user_rows_need_repair(rows):
+                    continue
+                old_client_states, first_seen_at = \
+                    _summarize_user_history(rows)
+                params.append({
+                    'b_uid': row.uid,
+                    'b_old_client_states':
+                        _encode_client_states(old_client_states),
+                    'b_first_seen_at': first_seen_at,
+                })
+            if params:
+                res = self._safe_execute(
+                    self._backfill_user_history_summary_query, params)
+                res.close()
+            last_uid = batch[-1].uid
+            count += len(batch)
+            if progress is not None:
+                progress(last_uid, count)
+            _throttle(start, count, max_rate)
+        return last_uid
+
+    def get_best_node(self, service, email, engine=None):
         """Returns the 'least loaded' node currently available, increments the
         active count on that node, and decrements the slots currently available
         """
-        nodes = self._get_nodes_table(service)
-        service = self._get_service_id(service)
-        query = select([nodes])
         send_to_spanner = self.should_allocate_to_spanner(email)
         if send_to_spanner:
-            query = query.where(nodes.c.id == self._spanner_node_id)
-        else:
-            # Pick the least-loaded node that has available slots.
-            query = query.where(and_(
-                nodes.c.service == service,
-                nodes.c.available > 0,
-                nodes.c.capacity > nodes.c.current_load,
-                nodes.c.downed == 0,
-                nodes.c.backoff == 0
-            ))
-            if self._is_sqlite:
-                # sqlite doesn't have the 'log' funtion, and requires
-                # coercion to a float for the sorting to work.
-                query = query.order_by(
-                    nodes.c.current_load * 1.0 /
-                    nodes.c.capacity)
-            else:
-                # using log() increases floating-point precision on mysql
-                # and thus makes the sorting more accurate.
-                query = query.order_by(
-                    sqlfunc.log(nodes.c.current_load) /
-                    sqlfunc.log(nodes.c.capacity))
-            query = query.limit(1)
-
-        # We may have to re-try the query if we need to release more capacity.
-        # This loop allows a maximum of five retries before bailing out.
-        for _ in xrange(5):
-            res = self._safe_execute(query)
-            row = res.fetchone()
-            res.close()
+            return self._get_spanner_node(service, engine)
+        if self._node_leases is not None:
+            assignment = self._get_node_from_lease(service, engine)
+            if assignment is not None:
+                return assignment
+
+        # Pick a node that has available slots, then claim a slot on it
+        # with a conditional update.  If a concurrent allocation claimed
+        # the last slot first then the update won't match, and we go round
+        # again to pick another node.  We may also have to re-try the
+        # query if we need to release more capacity.  If a concurrent
+        # allocation released it first then ours won't match, so we look
+        # once more before giving up.
+        looked_again = False
+        for _ in xrange(MAX_NODE_CLAIM_ATTEMPTS):
+            row = self._select_node(service, engine=engine)
             if row is None:
-                # Try to release additional capacity from any nodes
-                # that are not fully occupied.
-                where = and_(nodes.c.service == service,
-                             nodes.c.available <= 0,
-                             nodes.c.capacity > nodes.c.current_load,
-                             nodes.c.downed == 0)
-                fields = {
-                    'available': self._sqlfunc_min(
-                        nodes.c.capacity * self.capacity_release_rate,
-                        nodes.c.capacity - nodes.c.current_load
-                    ),
-                }
-                res = self._safe_execute(update(nodes, where, fields))
-                res.close()
-                if res.rowcount == 0:
+                if self._release_capacity_on_demand(service, engine):
+                    continue
+                if looked_again:
                     break
-            else:
-                break
+                looked_again = True
+                continue
+            res = self._safe_execute(self._claim_node_slot_query,
+                                     engine=engine, b_nodeid=row.id)
+            res.close()
+            if res.rowcount > 0:
+                if isinstance(row, _CachedNode):
+                    row.current_load += 1
+                    row.available -= 1
+                return row.id, str(row.node)
+            annotate_request(None, 'tokenserver.backend.claim_conflict', 1)
+            # Our snapshot of the node may be out of date.
+            self._invalidate_node_snapshot()
+
+        raise BackendError('unable to get a node')
+
+    def _release_capacity_on_demand(self, service, engine=None):
+        """Try to release additional capacity from any nodes of the service
+        that are not fully occupied, because none have available slots.
+
+        This is skipped if capacity is being released in the background, so
+        as to keep these writes off the request path.  Returns whether any
+        capacity was released.
+        """
+        if self._capacity_release_interval > 0:
+            annotate_request(None, 'tokenserver.backend.capacity_exhausted', 1)
+            return False
+        res = self._safe_execute(self._release_node_capacity_query,
+                                 engine=engine,
+                                 b_service=self._get_service_id(service),
+                                 release_rate=self.capacity_release_rate)
+        res.close()
+        return res.rowcount > 0
+
+    def release_node_capacity(self):
+        """Release additional capacity ahead of demand, on all services.
 
-        # Did we succeed in finding a node?
+        This tops up the available slots on any node that has used up more
+        than half of its last release and has room for more users, so that
+        allocations don't have to stop and release capacity themselves.
+        Returns the number of nodes that had capacity released.
+        """
+        res = self._safe_execute(self._replenish_node_capacity_query,
+                                 release_rate=self.capacity_release_rate,
+                                 low_water=self.capacity_release_rate / 2.0)
+        res.close()
+        return res.rowcount
+
+    def _select_node(self, service, engine=None, use_snapshot=True):
+        """Choose a node that can accept new users, using the configured
+        node selection policy.  Returns None if there are no such nodes.
+
+        If there's a node snapshot then this chooses from the nodes that it
+        thinks are available, and otherwise, or if it has none, from the
+        db.  Going to the db lets us see any capacity that was released in
+        the caller's transaction.
+        """
+        snapshot = self._get_node_snapshot() if use_snapshot else None
+        if snapshot is not None:
+            nodes = snapshot.get_available_nodes(
+                self._get_service_id(service))
+            if nodes:
+                return (self._node_selection_policy or least_loaded)(nodes)
+        if self._node_selection_policy is None:
+            res = self._safe_execute(self._get_least_loaded_node_query,
+                                     engine=engine, service=service)
+            row = res.fetchone()
+            res.close()
+            return row
+        res = self._safe_execute(self._get_available_nodes_query,
+                                 engine=engine, service=service)
+        rows = res.fetchall()
+        res.close()
+        if not rows:
+            return None
+        return self._node_selection_policy(rows)
+
+    def _get_spanner_node(self, service, engine=None, size=1):
+        """Returns the spanner node, and adds `size` to its active count.
+
+        The spanner node isn't limited by its available slots, so there's
+        no need to claim one before assigning a user to it.  If its load is
+        being counted in memory then it's not updated in the db here.
+        """
+        snapshot = self._get_node_snapshot()
+        if snapshot is not None and \
+                self._spanner_node_id in snapshot.nodes_by_id:
+            row = snapshot.nodes_by_id[self._spanner_node_id]
+        else:
+            res = self._safe_execute(self._get_spanner_node_query,
+                                     engine=engine,
+                                     nodeid=self._spanner_node_id)
+            row = res.fetchone()
+            res.close()
         if row is None:
             raise BackendError('unable to get a node')
-
-        nodeid = row.id
         node = str(row.node)
+        self._add_spanner_node_load(service, node, size, engine=engine)
+        return row.id, node
+
+    def _add_spanner_node_load(self, service, node, size, engine=None):
+        if self._pending_spanner_load is not None:
+            with self._pending_spanner_load_lock:
+                self._pending_spanner_load[(service, node)] += size
+            return
+        res = self._safe_execute(self._add_spanner_node_load_query,
+                                 engine=engine,
+                                 b_service=self._get_service_id(service),
+                                 b_node=node, size=size)
+        res.close()
 
-        # Update the node to reflect the new assignment.
-        # This is a little racy with concurrent assignments, but no big
-        # deal.
-        where = [nodes.c.service == service, nodes.c.node == node]
-        where = and_(*where)
-        fields = {'current_load': nodes.c.current_load + 1}
-        if not send_to_spanner:
-            fields['available'] = self._sqlfunc_max(nodes.c.available - 1, 0)
-        query = update(nodes, where, fields)
-        con = self._safe_execute(query, close=True)
-        con.close()
+    def _return_node_slot(self, service, nodeid, node):
+        """Give back a slot from get_best_node() that went unused."""
+        if nodeid == self._spanner_node_id:
+            self._add_spanner_node_load(service, node, -1)
+            return
+        res = self._safe_execute(self._return_node_slots_query,
+                                 b_nodeid=nodeid, size=1)
+        res.close()
+        self._invalidate_node_snapshot()
+
+    def flush_spanner_load(self):
+        """Add the users counted in memory to the spanner node's load.
 
-        return nodeid, node
+        Each node's count is added in a single update.  If the write fails
+        then the counts are kept, to be added by the next flush.  Returns
+        the number of users whose load was added.
+        """
+        if self._pending_spanner_load is None:
+            return 0
+        with self._pending_spanner_load_lock:
+            pending = self._pending_spanner_load
+            self._pending_spanner_load = defaultdict(int)
+        items = pending.items()
+        try:
+            while items:
+                (service, node), size = items[-1]
+                res = self._safe_execute(
+                    self._add_spanner_node_load_query,
+                    b_service=self._get_service_id(service),
+                    b_node=node, size=size)
+                res.close()
+                items.pop()
+        except Exception:
+            with self._pending_spanner_load_lock:
+                for key, size in items:
+                    self._pending_spanner_load[key] += size
+            raise
+        return sum(pending.itervalues())
+
+    def _get_node_from_lease(self, service, engine=None):
+        """Allocate a slot from this process' lease on a node.
+
+        If there's no current lease for the service, or it's used up or
+        expired, then any unused slots are returned and a new lease taken
+        out on the least-loaded node.  A lease mustn't be taken out in a
+        transaction that the caller is in, in case that's rolled back, nor
+        on another connection while the caller's transaction may be holding
+        the lock that it needs.  So if `engine` is a connection and there's
+        no usable lease, this returns None, and the caller should claim a
+        single slot in its transaction instead.
+
+        The lock is only held while looking at the leases in memory, never
+        while talking to the db, so that other threads aren't held up.
+        """
+        with self._node_leases_lock:
+            lease = self._node_leases.get(service)
+            if lease is not None:
+                if lease.remaining > 0 and lease.expires_at > time.time():
+                    lease.remaining -= 1
+                    annotate_request(None, 'tokenserver.backend.lease.hit', 1)
+                    return lease.nodeid, lease.node
+                del self._node_leases[service]
+        if lease is not None:
+            self._return_node_lease(lease)
+        if isinstance(engine, Connection):
+            return None
+        lease = self._acquire_node_lease(service)
+        annotate_request(None, 'tokenserver.backend.lease.acquire', 1)
+        lease.remaining -= 1
+        # Another thread may have taken out a lease for the service at the
+        # same time, in which case we keep ours and return theirs.
+        with self._node_leases_lock:
+            other_lease = self._node_leases.get(service)
+            self._node_leases[service] = lease
+        if other_lease is not None:
+            self._return_node_lease(other_lease)
+        return lease.nodeid, lease.node
+
+    def _acquire_node_lease(self, service):
+        # We may have to re-try if we need to release more capacity, or if
+        # another process reserved the slots before we could.  This loop
+        # allows a maximum of five retries before bailing out.
+        for _ in xrange(5):
+            row = self._select_node(service)
+            if row is None:
+                if not self._release_capacity_on_demand(service):
+                    break
+                continue
+            size = min(self._node_lease_size, row.available)
+            res = self._safe_execute(self._lease_node_slots_query,
+                                     b_nodeid=row.id, size=size)
+            res.close()
+            # Our snapshot of the node's load is out of date either way.
+            self._invalidate_node_snapshot()
+            if res.rowcount > 0:
+                expires_at = time.time() + self._node_lease_ttl
+                return _NodeLease(row.id, str(row.node), size, expires_at)
+        raise BackendError('unable to get a node')
+
+    def _return_node_lease(self, lease):
+        if lease.remaining > 0:
+            res = self._safe_execute(self._return_node_slots_query,
+                                     b_nodeid=lease.nodeid,
+                                     size=lease.remaining)
+            res.close()
+            lease.remaining = 0
+
+    def release_node_leases(self, service=None, node=None, expired=False):
+        """Return the unused slots from this process' leases on nodes.
+
+        By default this releases all leases, but it can be limited to a
+        particular service and/or node, or to leases that have expired.
+        """
+        if self._node_leases is None:
+            return
+        now = time.time()
+        leases = []
+        with self._node_leases_lock:
+            for lease_service, lease in self._node_leases.items():
+                if service is not None and lease_service != service:
+                    continue
+                if node is not None and lease.node != node:
+                    continue
+                if expired and lease.expires_at > now:
+                    continue
+                del self._node_leases[lease_service]
+                leases.append((lease_service, lease))
+        # Once they're out of the dict, no other thread can touch them.
+        # If we fail to return some, put them back to be retried later.
+        try:
+            while leases:
+                self._return_node_lease(leases[-1][1])
+                leases.pop()
+        except Exception:
+            with self._node_leases_lock:
+                for lease_service, lease in leases:
+                    self._node_leases.setdefault(lease_service, lease)
+            raise
+
+    def _forget_node_leases(self, service, node):
+        """Discard leases on a node without returning their slots to it."""
+        if self._node_leases is None:
+            return
+        with self._node_leases_lock:
+            lease = self._node_leases.get(service)
+            if lease is not None and lease.node == node:
+                del self._node_leases[service]
 
     def _get_services_table(self, service):
         return self.services
@@ -11,11 +11,20 @@ may be specified, or the best available node used by default.
 
 The allocated node is printed to stdout.
 
+With the --emails-file option, it instead allocates every user listed in the
+given file (or stdin, given "-"), one email per line.  Users are allocated
+in chunks, skipping any that already exist, and each newly-allocated user is
+printed to stdout along with their node.  The overall throughput is reported
+on stderr.
+
 """
 
 import os
+import sys
+import time
 import logging
 import optparse
+from itertools import islice
 
 import tokenserver.scripts
 from tokenserver.assignment import INodeAssignment
@@ -45,21 +54,66 @@ def allocate_user(config, service, email, node=None):
         config.end()
 
 
+def allocate_users(config, service, emails_file, node=None, chunk_size=1000):
+    logger.info("Allocating nodes for users in %s", emails_file.name)
+    config.begin()
+    try:
+        backend = config.registry.getUtility(INodeAssignment)
+        emails = (line.strip() for line in emails_file)
+        emails = (email for email in emails if email)
+        num_emails = num_allocated = 0
+        start = time.time()
+        while True:
+            chunk = list(islice(emails, chunk_size))
+            if not chunk:
+                break
+            users = backend.allocate_users(service, chunk, node=node)
+            for user in users:
+                print user["email"], user["node"]
+            num_emails += len(chunk)
+            num_allocated += len(users)
+            logger.info("Allocated %d of %d users so far",
+                        num_allocated, num_emails)
+        elapsed = time.time() - start
+        sys.stderr.write("Allocated %d new users out of %d in %.1f seconds "
+                         "(%.1f emails per second)\n" % (
+                             num_allocated, num_emails, elapsed,
+                             num_emails / elapsed if elapsed else 0))
+    except Exception:
+        logger.exception("Error while allocating users")
+        return False
+    else:
+        logger.info("Finished allocating users")
+        return True
+    finally:
+        config.end()
+
+
 def main(args=None):
     """Main entry-point for running this script.
 
     This function parses command-line arguments and passes them on
     to the allocate_user() function.
     """
-    usage = "usage: %prog [options] config_file service email [node_name]"
+    usage = "usage: %prog [options] config_file service email [node_name]\n"\
+            "       %prog [options] --emails-file=FILE config_file service "\
+            "[node_name]"
     descr = "Allocate a user to a node.  You may specify a particular node, "\
             "or omit to use the best available node."
     parser = optparse.OptionParser(usage=usage, description=descr)
+    parser.add_option("", "--emails-file",
+                      help="Allocate each email in this file, or - for stdin")
+    parser.add_option("", "--chunk-size", type="int", default=1000,
+                      help="Number of emails to allocate at a time")
     parser.add_option("-v", "--verbose", action="count", dest="verbosity",
                       help="Control verbosity of log messages")
 
     opts, args = parser.parse_args(args)
-    if not 3 <= len(args) <= 4:
+    if opts.emails_file is not None:
+        if not 2 <= len(args) <= 3:
+            parser.print_usage()
+            return 1
+    elif not 3 <= len(args) <= 4:
         parser.print_usage()
         return 1
 
@@ -70,6 +124,17 @@ def main(args=None):
     config = tokenserver.scripts.load_configurator(config_file)
 
     service = args[1]
+    if opts.emails_file is not None:
+        node_name = args[2] if len(args) == 3 else None
+        if opts.emails_file == "-":
+            allocate_users(config, service, sys.stdin, node_name,
+                           opts.chunk_size)
+        else:
+            with open(opts.emails_file) as emails_file:
+                allocate_users(config, service, emails_file, node_name,
+                               opts.chunk_size)
+        return 0
+
     email = args[2]
     if len(args) == 3:
         node_name = None
@@ -0,0 +1,87 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Script to fill in the summary of each user's history on their active record.
+
+This script takes a tokenserver config file, uses it to load the assignment
+backend, and then stores a summary of their history on every active user
+record that lacks one, so that their older records needn't be read when
+they next sync.  It works through the records in batches ordered by uid,
+committing each one, so it can be interrupted and resumed.
+
+"""
+
+import os
+import logging
+import optparse
+
+import tokenserver.scripts
+from tokenserver.assignment import INodeAssignment
+
+
+logger = logging.getLogger("tokenserver.scripts.backfill_user_history")
+
+
+def backfill_user_history(config_file, batch_size=1000, max_rate=None,
+                          start_uid=0):
+    """Fill in the history summary of active user records lacking one."""
+    logger.info("Backfilling user history summaries")
+    logger.debug("Using config file %r", config_file)
+    config = tokenserver.scripts.load_configurator(config_file)
+    config.begin()
+    try:
+        backend = config.registry.getUtility(INodeAssignment)
+        backend.backfill_user_history_summaries(batch_size=batch_size,
+                                                max_rate=max_rate,
+                                                start_uid=start_uid,
+                                                progress=_report_progress)
+    except Exception:
+        logger.exception("Error while backfilling user history summaries")
+        return False
+    else:
+        logger.info("Finished backfilling user history summaries")
+        return True
+    finally:
+        config.end()
+
+
+def _report_progress(last_uid, count):
+    logger.info("  checked %d records, up to uid %d", count, last_uid)
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments and passes them on
+    to the backfill_user_history() function.
+    """
+    usage = "usage: %prog [options] config_file"
+    descr = "Fill in the summary of user history in the tokenserver database"
+    parser = optparse.OptionParser(usage=usage, description=descr)
+    parser.add_option("", "--batch-size", type="int", default=1000,
+                      help="Backfill users in batches of this many records")
+    parser.add_option("", "--max-rate", type="float",
+                      help="Max records per second to backfill")
+    parser.add_option("", "--start-uid", type="int", default=0,
+                      help="Resume batches after this uid")
+    parser.add_option("-v", "--verbose", action="count", dest="verbosity",
+                      help="Control verbosity of log messages")
+
+    opts, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.print_usage()
+        return 1
+
+    tokenserver.scripts.configure_script_logging(opts)
+
+    config_file = os.path.abspath(args[0])
+
+    backfill_user_history(config_file, opts.batch_size, opts.max_rate,
+                          opts.start_uid)
+    return 0
+
+
+if __name__ == "__main__":
+    tokenserver.scripts.run_script(main)
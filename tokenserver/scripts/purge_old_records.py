@@ -60,10 +60,13 @@ def purge_old_records(config_file, grace_period=-1, max_per_loop=10,
             # Process batches of <max_per_loop> items, until we run out.
             while True:
                 offset = random.randint(0, max_offset)
+                # Read from the primary, since a lagging replica could
+                # hand back records that we've already purged.
                 kwds = {
                     "grace_period": grace_period,
                     "limit": max_per_loop,
                     "offset": offset,
+                    "primary": True,
                 }
                 rows = list(backend.get_old_user_records(service, **kwds))
                 if not rows:
@@ -0,0 +1,97 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Script to correct the recorded load on each node.
+
+This script takes a tokenserver config file, uses it to load the assignment
+backend, and then counts the users actually assigned to each node and
+corrects the node's current_load to match.  It prints a report of the nodes
+whose load was wrong, and with --dry-run it only prints the report.
+
+"""
+
+import os
+import sys
+import logging
+import optparse
+
+import tokenserver.scripts
+from tokenserver.assignment import INodeAssignment
+
+
+logger = logging.getLogger("tokenserver.scripts.reconcile_node_loads")
+
+
+def reconcile_node_loads(config_file, outfile, service=None, batch_size=1000,
+                         max_rate=None, dry_run=False):
+    """Correct the recorded load on each node, and report the differences."""
+    logger.info("Reconciling node loads")
+    logger.debug("Using config file %r", config_file)
+    config = tokenserver.scripts.load_configurator(config_file)
+    config.begin()
+    try:
+        backend = config.registry.getUtility(INodeAssignment)
+        results = backend.reconcile_node_loads(service, batch_size=batch_size,
+                                               max_rate=max_rate,
+                                               dry_run=dry_run)
+        num_wrong = 0
+        for node_service, node, recorded, actual in results:
+            if recorded != actual:
+                num_wrong += 1
+                outfile.write("%s %s %d -> %d (%+d)\n" % (
+                    node_service, node, recorded, actual, actual - recorded))
+            else:
+                logger.debug("%s %s %d", node_service, node, recorded)
+    except Exception:
+        logger.exception("Error while reconciling node loads")
+        return False
+    else:
+        if dry_run:
+            logger.info("Found %d of %d nodes with the wrong load",
+                        num_wrong, len(results))
+        else:
+            logger.info("Corrected %d of %d nodes with the wrong load",
+                        num_wrong, len(results))
+        return True
+    finally:
+        config.end()
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments and passes them on
+    to the reconcile_node_loads() function.
+    """
+    usage = "usage: %prog [options] config_file"
+    descr = "Correct the load on each node in the tokenserver database"
+    parser = optparse.OptionParser(usage=usage, description=descr)
+    parser.add_option("", "--service",
+                      help="Only reconcile the nodes for this service")
+    parser.add_option("", "--batch-size", type="int", default=1000,
+                      help="Count users in batches of this many records")
+    parser.add_option("", "--max-rate", type="float",
+                      help="Max records per second to count")
+    parser.add_option("", "--dry-run", action="store_true",
+                      help="Only report the differences, don't fix them")
+    parser.add_option("-v", "--verbose", action="count", dest="verbosity",
+                      help="Control verbosity of log messages")
+
+    opts, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.print_usage()
+        return 1
+
+    tokenserver.scripts.configure_script_logging(opts)
+
+    config_file = os.path.abspath(args[0])
+
+    reconcile_node_loads(config_file, sys.stdout, opts.service,
+                         opts.batch_size, opts.max_rate, opts.dry_run)
+    return 0
+
+
+if __name__ == "__main__":
+    tokenserver.scripts.run_script(main)
@@ -18,12 +18,15 @@ import optparse
 
 import tokenserver.scripts
 from tokenserver.assignment import INodeAssignment
+from tokenserver.util import get_timestamp
 
 
 logger = logging.getLogger("tokenserver.scripts.remove_node")
 
 
-def remove_node(config_file, node):
+def remove_node(config_file, node, batch_size=None, max_rate=None,
+                start_uid=0, reassign=False, since_timestamp=None,
+                reassign_start_uid=0):
     """Remove the named node from the system."""
     logger.info("Removing node %s", node)
     logger.debug("Using config file %r", config_file)
@@ -33,15 +36,32 @@ def remove_node(config_file, node):
         backend = config.registry.getUtility(INodeAssignment)
         patterns = config.registry['endpoints_patterns']
         found = False
+        timestamp = get_timestamp()
+        if since_timestamp is None:
+            since_timestamp = timestamp
+        if reassign:
+            logger.info("Reassigning users replaced since %d; to resume an "
+                        "interrupted run, pass --since-timestamp=%d",
+                        since_timestamp, since_timestamp)
         for service in patterns:
             logger.debug("Removing node for service: %s", service)
             try:
-                backend.remove_node(service, node)
+                backend.get_node_id(service, node)
             except ValueError:
                 logger.debug("  not found")
-            else:
-                found = True
-                logger.debug("  removed")
+                continue
+            found = True
+            backend.remove_node(service, node, timestamp,
+                                batch_size=batch_size, max_rate=max_rate,
+                                start_uid=start_uid,
+                                progress=_report_progress)
+            logger.debug("  removed")
+            if reassign:
+                logger.info("Reassigning users for service: %s", service)
+                backend.reassign_replaced_users(
+                    service, since_timestamp, batch_size=batch_size or 100,
+                    max_rate=max_rate, start_uid=reassign_start_uid,
+                    progress=_report_reassignment)
     except Exception:
         logger.exception("Error while removing node")
         return False
@@ -55,6 +75,14 @@ def remove_node(config_file, node):
         config.end()
 
 
+def _report_progress(last_uid, count):
+    logger.info("  unassigned %d records, up to uid %d", count, last_uid)
+
+
+def _report_reassignment(last_uid, count):
+    logger.info("  reassigned %d records, up to uid %d", count, last_uid)
+
+
 def main(args=None):
     """Main entry-point for running this script.
 
@@ -64,6 +92,18 @@ def main(args=None):
     usage = "usage: %prog [options] config_file node_name"
     descr = "Remove a node from the tokenserver database"
     parser = optparse.OptionParser(usage=usage, description=descr)
+    parser.add_option("", "--batch-size", type="int",
+                      help="Unassign users in batches of this many records")
+    parser.add_option("", "--max-rate", type="float",
+                      help="Max records per second to unassign in batches")
+    parser.add_option("", "--start-uid", type="int", default=0,
+                      help="Resume batches after this uid")
+    parser.add_option("", "--reassign", action="store_true",
+                      help="Then give the users new assignments in batches")
+    parser.add_option("", "--since-timestamp", type="int",
+                      help="Reassign users replaced since this timestamp")
+    parser.add_option("", "--reassign-start-uid", type="int", default=0,
+                      help="Resume reassignment batches after this uid")
     parser.add_option("-v", "--verbose", action="count", dest="verbosity",
                       help="Control verbosity of log messages")
 
@@ -77,7 +117,9 @@ def main(args=None):
     config_file = os.path.abspath(args[0])
     node_name = args[1]
 
-    remove_node(config_file, node_name)
+    remove_node(config_file, node_name, opts.batch_size, opts.max_rate,
+                opts.start_uid, opts.reassign, opts.since_timestamp,
+                opts.reassign_start_uid)
     return 0
 
 
@@ -6,7 +6,9 @@
 Script to remove a node from the system.
 
 This script takes a tokenserver config file, uses it to load the assignment
-backend, and then clears any assignments to the named node.
+backend, and then clears any assignments to the named node.  With the
+--reassign option, the node is first marked as down and the users who were
+on it are then given new assignments.
 
 """
 
@@ -16,12 +18,15 @@ import optparse
 
 import tokenserver.scripts
 from tokenserver.assignment import INodeAssignment
+from tokenserver.util import get_timestamp
 
 
 logger = logging.getLogger("tokenserver.scripts.unassign_node")
 
 
-def unassign_node(config_file, node):
+def unassign_node(config_file, node, batch_size=None, max_rate=None,
+                  start_uid=0, reassign=False, since_timestamp=None,
+                  reassign_start_uid=0):
     """Clear any assignments to the named node."""
     logger.info("Unassignment node %s", node)
     logger.debug("Using config file %r", config_file)
@@ -31,15 +36,36 @@ def unassign_node(config_file, node):
         backend = config.registry.getUtility(INodeAssignment)
         patterns = config.registry['endpoints_patterns']
         found = False
+        timestamp = get_timestamp()
+        if since_timestamp is None:
+            since_timestamp = timestamp
+        if reassign:
+            logger.info("Reassigning users replaced since %d; to resume an "
+                        "interrupted run, pass --since-timestamp=%d",
+                        since_timestamp, since_timestamp)
         for service in patterns:
             logger.debug("Unassigning node for service: %s", service)
             try:
-                backend.unassign_node(service, node)
+                backend.get_node_id(service, node)
             except ValueError:
                 logger.debug("  not found")
-            else:
-                found = True
-                logger.debug("  unassigned")
+                continue
+            found = True
+            if reassign:
+                # Take the node out of service first, so that users
+                # aren't given their old node back as they're moved.
+                backend.update_node(service, node, downed=1)
+            backend.unassign_node(service, node, timestamp,
+                                  batch_size=batch_size, max_rate=max_rate,
+                                  start_uid=start_uid,
+                                  progress=_report_progress)
+            logger.debug("  unassigned")
+            if reassign:
+                logger.info("Reassigning users for service: %s", service)
+                backend.reassign_replaced_users(
+                    service, since_timestamp, batch_size=batch_size or 100,
+                    max_rate=max_rate, start_uid=reassign_start_uid,
+                    progress=_report_reassignment)
     except Exception:
         logger.exception("Error while unassigning node")
         return False
@@ -53,6 +79,14 @@ def unassign_node(config_file, node):
         config.end()
 
 
+def _report_progress(last_uid, count):
+    logger.info("  unassigned %d records, up to uid %d", count, last_uid)
+
+
+def _report_reassignment(last_uid, count):
+    logger.info("  reassigned %d records, up to uid %d", count, last_uid)
+
+
 def main(args=None):
     """Main entry-point for running this script.
 
@@ -62,6 +96,18 @@ def main(args=None):
     usage = "usage: %prog [options] config_file node_name"
     descr = "Clear all assignments to node in the tokenserver database"
     parser = optparse.OptionParser(usage=usage, description=descr)
+    parser.add_option("", "--batch-size", type="int",
+                      help="Unassign users in batches of this many records")
+    parser.add_option("", "--max-rate", type="float",
+                      help="Max records per second to unassign in batches")
+    parser.add_option("", "--start-uid", type="int", default=0,
+                      help="Resume batches after this uid")
+    parser.add_option("", "--reassign", action="store_true",
+                      help="Then give the users new assignments in batches")
+    parser.add_option("", "--since-timestamp", type="int",
+                      help="Reassign users replaced since this timestamp")
+    parser.add_option("", "--reassign-start-uid", type="int", default=0,
+                      help="Resume reassignment batches after this uid")
     parser.add_option("-v", "--verbose", action="count", dest="verbosity",
                       help="Control verbosity of log messages")
 
@@ -75,7 +121,9 @@ def main(args=None):
     config_file = os.path.abspath(args[0])
     node_name = args[1]
 
-    unassign_node(config_file, node_name)
+    unassign_node(config_file, node_name, opts.batch_size, opts.max_rate,
+                  opts.start_uid, opts.reassign, opts.since_timestamp,
+                  opts.reassign_start_uid)
     return 0
 
 
@@ -0,0 +1,51 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import random
+import unittest
+from collections import namedtuple, Counter
+
+from tokenserver.assignment.sqlnode.selection import (
+    least_loaded, weighted_random, power_of_two, get_node_selection_policy)
+
+
+Node = namedtuple('Node', ('node', 'current_load', 'capacity', 'available'))
+
+
+class TestNodeSelectionPolicies(unittest.TestCase):
+
+    def setUp(self):
+        self.rand = random.Random(42)
+        self.nodes = [
+            Node('https://phx12', 90, 100, 10),
+            Node('https://phx13', 10, 100, 90),
+            Node('https://phx14', 50, 100, 0),
+        ]
+
+    def test_least_loaded(self):
+        self.assertEqual(least_loaded(self.nodes).node, 'https://phx13')
+
+    def test_weighted_random_is_weighted_by_free_slots(self):
+        counts = Counter(weighted_random(self.nodes, self.rand).node
+                         for _ in xrange(1000))
+        self.assertEqual(counts['https://phx14'], 0)
+        self.assertTrue(counts['https://phx13'] > 5 * counts['https://phx12'])
+        self.assertTrue(counts['https://phx12'] > 0)
+
+    def test_power_of_two_never_picks_the_most_loaded(self):
+        counts = Counter(power_of_two(self.nodes, self.rand).node
+                         for _ in xrange(1000))
+        self.assertEqual(counts['https://phx12'], 0)
+        self.assertTrue(counts['https://phx13'] > counts['https://phx14'])
+        self.assertTrue(counts['https://phx14'] > 0)
+
+    def test_policies_work_with_a_single_node(self):
+        nodes = self.nodes[:1]
+        for policy in (least_loaded, weighted_random, power_of_two):
+            self.assertEqual(policy(nodes, self.rand), nodes[0])
+
+    def test_unknown_policy(self):
+        self.assertEqual(get_node_selection_policy('power_of_two'),
+                         power_of_two)
+        self.assertRaises(ValueError, get_node_selection_policy, 'fastest')
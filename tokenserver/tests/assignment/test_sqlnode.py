@@ -2,17 +2,26 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import gc
 import math
 import os
 import time
+import threading
 import unittest
 import uuid
+import weakref
 from collections import defaultdict
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError
 from sqlalchemy.sql import text as sqltext
 from mozsvc.exceptions import BackendError
 from tokenserver.assignment.sqlnode.sql import (SQLNodeAssignment,
                                                 MAX_GENERATION,
-                                                get_timestamp)
+                                                MAX_UPDATE_FLUSH_INTERVAL,
+                                                get_timestamp,
+                                                _InstrumentedQueuePool,
+                                                _get_pool_status)
+from tokenserver.assignment.sqlnode.sharded import ShardedSQLNodeAssignment
 
 
 TEMP_ID = uuid.uuid4().hex
@@ -41,6 +50,34 @@ class NodeAssignmentTests(object):
         user = self.backend.get_user("sync-1.0", "test1@example.com")
         self.assertEqual(user['node'], wanted)
 
+    def test_get_or_create_user(self):
+        user = self.backend.get_or_create_user("sync-1.0", "test1@mozilla.com",
+                                               generation=42,
+                                               client_state="aaa",
+                                               keys_changed_at=12)
+        self.assertEqual(user['node'], 'https://phx12')
+        self.assertEqual(user['generation'], 42)
+        self.assertEqual(user['keys_changed_at'], 12)
+        self.assertEqual(user['client_state'], 'aaa')
+        # A second call returns the existing record rather than a new one.
+        user2 = self.backend.get_or_create_user("sync-1.0",
+                                                "test1@mozilla.com")
+        self.assertEqual(user2['uid'], user['uid'])
+        self.assertEqual(user2['generation'], 42)
+        self.assertEqual(user2['client_state'], 'aaa')
+        # And the record is visible to ordinary reads.
+        user3 = self.backend.get_user("sync-1.0", "test1@mozilla.com")
+        self.assertEqual(user3['uid'], user['uid'])
+
+    def test_get_or_create_user_reassigns_replaced_records(self):
+        user1 = self.backend.allocate_user("sync-1.0", "test@mozilla.com",
+                                           generation=42)
+        self.backend.replace_user_records("sync-1.0", "test@mozilla.com")
+        user2 = self.backend.get_or_create_user("sync-1.0",
+                                                "test@mozilla.com")
+        self.assertNotEqual(user2['uid'], user1['uid'])
+        self.assertEqual(user2['generation'], 42)
+
     def test_allocation_to_least_loaded_node(self):
         self.backend.add_node('sync-1.0', 'https://phx13', 100)
         user1 = self.backend.allocate_user("sync-1.0", "test1@mozilla.com")
@@ -444,8 +481,107 @@ class NodeAssignmentTests(object):
         self.assertEqual(user3["uid"], user2["uid"])
         self.assertNotEqual(user3["first_seen_at"], user2["first_seen_at"])
 
+    def test_allocate_users(self):
+        existing = self.backend.allocate_user("sync-1.0", "test1@mozilla.com")
+        emails = ["test%d@mozilla.com" % (i,) for i in xrange(5)]
+        users = self.backend.allocate_users("sync-1.0",
+                                            iter(emails + emails[2:]))
+        # Existing and duplicated emails are skipped.
+        self.assertEqual([user['email'] for user in users],
+                         [emails[0]] + emails[2:])
+        self.assertEqual(len(set(user['uid'] for user in users)), 4)
+        self.assertFalse(existing['uid'] in [user['uid'] for user in users])
+        for user in users:
+            self.assertEqual(user['node'], 'https://phx12')
+            self.assertEqual(
+                self.backend.get_user("sync-1.0", user['email']), user)
+        self.assertEqual(self.backend.count_users(), 5)
+        self.assertEqual(self.backend.allocate_users("sync-1.0", emails), [])
+
+    def test_allocate_users_to_a_specific_node(self):
+        self.backend.add_node("sync-1.0", "https://phx13", 100)
+        users = self.backend.allocate_users(
+            "sync-1.0", ["test1@mozilla.com", "test2@mozilla.com"],
+            node="https://phx13")
+        for user in users:
+            self.assertEqual(user['node'], 'https://phx13')
+            self.assertEqual(
+                self.backend.get_user("sync-1.0", user['email']), user)
+
+
+class SQLTestCase(unittest.TestCase):
+    """Base class for tests against the SQL backends.
+
+    This cleans up the databases used by `self.backend`, and has helpers
+    for looking and acting behind its back.
+    """
+
+    backend = None  # subclasses must define this on the instance
+
+    def tearDown(self):
+        super(SQLTestCase, self).tearDown()
+        self.backend.close()
+        for backend in getattr(self.backend, 'shards', [self.backend]):
+            backend._engine.dispose()
+            if backend._is_sqlite:
+                for replica in backend._replicas:
+                    replica.engine.dispose()
+                    self._remove_sqlite_db(replica.sqluri)
+                self._remove_sqlite_db(backend.sqluri)
+            else:
+                backend._safe_execute('drop table services;')
+                backend._safe_execute('drop table nodes;')
+                backend._safe_execute('drop table users;')
+
+    def _remove_sqlite_db(self, sqluri):
+        filename = sqluri.split('sqlite://')[-1]
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(filename + suffix):
+                os.remove(filename + suffix)
+
+    def _count_statements(self, func, *args, **kwds):
+        """Call func, returning its result and the statements it executed."""
+        orig_safe_execute = self.backend._safe_execute
+        statements = []
 
-class TestSQLDB(NodeAssignmentTests, unittest.TestCase):
+        def counting_safe_execute(*args, **kwds):
+            statements.append(args[0])
+            return orig_safe_execute(*args, **kwds)
+
+        self.backend._safe_execute = counting_safe_execute
+        try:
+            return func(*args, **kwds), statements
+        finally:
+            del self.backend._safe_execute
+
+    def _race_with_user_creation(self):
+        """Have another request create the next new user just after we've
+        claimed a slot for them.  Returns a list of the users it creates."""
+        get_best_node = self.backend.get_best_node
+        users = []
+
+        def racy_get_best_node(service, email, engine=None):
+            result = get_best_node(service, email, engine)
+            if not users:
+                # Creating the user claims a slot too, but doesn't race.
+                users.append(None)
+                users[0] = self.backend.allocate_user(service, email)
+            return result
+
+        self.backend.get_best_node = racy_get_best_node
+        self.addCleanup(delattr, self.backend, 'get_best_node')
+        return users
+
+    def _get_node_load(self, node='https://phx12'):
+        query = sqltext("SELECT current_load, available FROM nodes "
+                        "WHERE node=:node")
+        res = self.backend._safe_execute(query, node=node)
+        row = res.fetchone()
+        res.close()
+        return row[0], row[1]
+
+
+class TestSQLDB(NodeAssignmentTests, SQLTestCase):
 
     _SQLURI = os.environ.get('MOZSVC_SQLURI', DEFAULT_SQLURI)
 
@@ -453,16 +589,125 @@ class TestSQLDB(NodeAssignmentTests, unittest.TestCase):
         self.backend = SQLNodeAssignment(self._SQLURI, create_tables=True)
         super(TestSQLDB, self).setUp()
 
-    def tearDown(self):
-        super(TestSQLDB, self).tearDown()
-        if self.backend._engine.driver == 'pysqlite':
-            filename = self.backend.sqluri.split('sqlite://')[-1]
-            if os.path.exists(filename):
-                os.remove(filename)
-        else:
-            self.backend._safe_execute('drop table services;')
-            self.backend._safe_execute('drop table nodes;')
-            self.backend._safe_execute('drop table users;')
+    def test_recovery_from_racy_record_creation_uses_single_update(self):
+        timestamp = get_timestamp()
+        uids = set()
+        for _ in xrange(4):
+            user = self.backend.allocate_user("sync-1.0", "test@mozilla.com",
+                                              timestamp=timestamp)
+            uids.add(user["uid"])
+        self.assertEqual(len(uids), 4)
+        _, statements = self._count_statements(
+            self.backend.get_user, "sync-1.0", "test@mozilla.com")
+        # One statement to find that there are several active records,
+        # one to read their full history, and one to repair them.
+        self.assertEqual(len(statements), 3)
+        old_records = list(
+            self.backend.get_old_user_records("sync-1.0", grace_period=0))
+        self.assertEqual(len(old_records), 3)
+
+    def test_get_or_create_user_reads_returning_users_without_transaction(
+            self):
+        user = self.backend.allocate_user("sync-1.0", "test@mozilla.com")
+
+        def no_transactions(*args, **kwds):
+            raise AssertionError("unexpected transaction")
+
+        self.backend._safe_transaction = no_transactions
+        try:
+            user2 = self.backend.get_or_create_user("sync-1.0",
+                                                    "test@mozilla.com")
+        finally:
+            del self.backend._safe_transaction
+        self.assertEqual(user2["uid"], user["uid"])
+
+    def test_get_or_create_user_returns_node_slot_if_user_was_created(self):
+        current_load, available = self._get_node_load("https://phx12")
+        users = self._race_with_user_creation()
+        user = self.backend.get_or_create_user("sync-1.0", "test@mozilla.com")
+        self.assertEqual(user["uid"], users[0]["uid"])
+        self.assertEqual(self._get_node_load("https://phx12"),
+                         (current_load + 1, available - 1))
+
+    def test_get_or_create_user_reads_new_users_once(self):
+        self.backend.get_or_create_user("sync-1.0", "test1@mozilla.com")
+        user, statements = self._count_statements(
+            self.backend.get_or_create_user, "sync-1.0", "test@mozilla.com")
+        # One read of their active record, and then one read of their
+        # history and the insert of their record in a single transaction.
+        user_statements = [st for st in statements if "users" in str(st)]
+        self.assertEqual(len(user_statements), 3)
+        self.assertEqual(user["node"], "https://phx12")
+
+    def _clear_history_summaries(self):
+        query = sqltext("UPDATE users SET old_client_states = NULL, "
+                        "first_seen_at = NULL")
+        self.backend._safe_execute(query).close()
+
+    def test_get_user_reads_only_the_active_record(self):
+        user = self.backend.allocate_user("sync-1.0", "test@mozilla.com")
+        time.sleep(0.01)
+        self.backend.update_user("sync-1.0", user, client_state="aaa")
+        time.sleep(0.01)
+        self.backend.update_user("sync-1.0", user, client_state="bbb")
+        user, statements = self._count_statements(
+            self.backend.get_user, "sync-1.0", "test@mozilla.com")
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(user["client_state"], "bbb")
+        self.assertEqual(set(user["old_client_states"]), set(("", "aaa")))
+
+    def test_history_summary_is_filled_in_when_missing(self):
+        user = self.backend.allocate_user("sync-1.0", "test@mozilla.com")
+        time.sleep(0.01)
+        self.backend.update_user("sync-1.0", user, client_state="aaa")
+        self._clear_history_summaries()
+        # The first read has to consult the full history,
+        # and stores a summary of it on the active record.
+        user1, statements = self._count_statements(
+            self.backend.get_user, "sync-1.0", "test@mozilla.com",
+            primary=True)
+        self.assertEqual(len(statements), 3)
+        self.assertEqual(set(user1["old_client_states"]), set(("",)))
+        # Subsequent reads can use it alone.
+        user2, statements = self._count_statements(
+            self.backend.get_user, "sync-1.0", "test@mozilla.com",
+            primary=True)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(user2, user1)
+
+    def test_backfill_user_history_summaries(self):
+        user = self.backend.allocate_user("sync-1.0", "test1@mozilla.com")
+        for i in xrange(25):
+            time.sleep(0.001)
+            self.backend.update_user("sync-1.0", user,
+                                     client_state="%03d" % (i,))
+        user2 = self.backend.allocate_user("sync-1.0", "test2@mozilla.com")
+        self.backend.update_user("sync-1.0", user2, client_state="aaa")
+        emails = ["test1@mozilla.com", "test2@mozilla.com"]
+        self._clear_history_summaries()
+        reported = []
+        last_uid = self.backend.backfill_user_history_summaries(
+            batch_size=1,
+            progress=lambda last_uid, count: reported.append(count))
+        self.assertEqual(last_uid, user2["uid"])
+        self.assertEqual(reported, [1, 2])
+        # The active records can now be used alone.
+        backfilled = []
+        for email in emails:
+            user, statements = self._count_statements(
+                self.backend.get_user, "sync-1.0", email)
+            self.assertEqual(len(statements), 1)
+            backfilled.append(user)
+        # And they summarize the same records that get_user() reads when
+        # it has to fill in the summary itself.
+        self._clear_history_summaries()
+        self.assertEqual(
+            [self.backend.get_user("sync-1.0", email, primary=True)
+             for email in emails],
+            backfilled)
+        self.assertEqual(len(backfilled[0]["old_client_states"]), 19)
+        # There's nothing left to do if it's run again.
+        self.assertEqual(self.backend.backfill_user_history_summaries(), 0)
 
     def test_default_node_available_capacity(self):
         node = "https://phx13"
@@ -474,6 +719,1065 @@ class TestSQLDB(NodeAssignmentTests, unittest.TestCase):
         res.close()
         self.assertEqual(row["available"], available)
 
+    def test_node_allocation_reuses_compiled_statements(self):
+        cache = self.backend._engine.get_execution_options()["compiled_cache"]
+        self.backend.get_best_node("sync-1.0", "test1@example.com")
+        self.backend.update_node("sync-1.0", "https://phx12", available=10)
+        num_compiled = len(cache)
+        for i in xrange(5):
+            email = "test%d@example.com" % (i + 2,)
+            self.backend.get_best_node("sync-1.0", email)
+            self.backend.update_node("sync-1.0", "https://phx12",
+                                     available=10)
+        self.assertEqual(len(cache), num_compiled)
+
+    def test_node_claim_moves_on_if_slot_is_taken(self):
+        self.backend.update_node("sync-1.0", "https://phx12",
+                                 current_load=0, available=1)
+        self.backend.add_node("sync-1.0", "https://phx13", 100,
+                              current_load=50, available=10)
+        # Have a concurrent allocation take the last slot on phx12
+        # just before we try to claim it.
+        safe_execute = self.backend._safe_execute
+
+        def racy_safe_execute(query, *args, **kwds):
+            if query is self.backend._claim_node_slot_query:
+                self.backend._safe_execute = safe_execute
+                safe_execute(query, *args, **kwds).close()
+            return safe_execute(query, *args, **kwds)
+
+        self.backend._safe_execute = racy_safe_execute
+        try:
+            nodeid, node = self.backend.get_best_node("sync-1.0",
+                                                      "test1@example.com")
+        finally:
+            self.backend._safe_execute = safe_execute
+        self.assertEqual(node, "https://phx13")
+        self.assertEqual(self._get_node_load("https://phx12"), (1, 0))
+        self.assertEqual(self._get_node_load("https://phx13"), (51, 9))
+
+    def test_concurrent_node_claims_do_not_overshoot(self):
+        self.backend.update_node("sync-1.0", "https://phx12",
+                                 capacity=10, current_load=0, available=10)
+        claimed = []
+
+        def claim_nodes(n):
+            for i in xrange(5):
+                email = "test%d-%d@mozilla.com" % (n, i)
+                try:
+                    claimed.append(self.backend.get_best_node("sync-1.0",
+                                                              email))
+                except BackendError:
+                    pass
+
+        threads = [threading.Thread(target=claim_nodes, args=(n,))
+                   for n in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        current_load, available = self._get_node_load("https://phx12")
+        self.assertEqual(current_load, len(claimed))
+        self.assertEqual(current_load + available, 10)
+
+    def test_allocate_users_updates_node_load_in_bulk(self):
+        self.backend.update_node("sync-1.0", "https://phx12",
+                                 current_load=0, available=20)
+        self.backend.add_node("sync-1.0", "https://phx13", 100,
+                              current_load=10, available=20)
+        emails = ["test%d@mozilla.com" % (i,) for i in xrange(30)]
+        users, statements = self._count_statements(
+            self.backend.allocate_users, "sync-1.0", emails)
+        updates = [st for st in statements
+                   if str(st).startswith("UPDATE nodes")]
+        self.assertEqual(len(users), 30)
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(self._get_node_load("https://phx12"), (20, 0))
+        self.assertEqual(self._get_node_load("https://phx13"), (20, 10))
+        nodes = defaultdict(int)
+        for user in users:
+            nodes[user['node']] += 1
+        self.assertEqual(nodes, {"https://phx12": 20, "https://phx13": 10})
+
+    def test_allocate_users_releases_capacity_as_needed(self):
+        self.backend.update_node("sync-1.0", "https://phx12",
+                                 capacity=20, current_load=0, available=5)
+        emails = ["test%d@mozilla.com" % (i,) for i in xrange(25)]
+        with self.assertRaises(BackendError):
+            self.backend.allocate_users("sync-1.0", emails)
+        # Nothing is created if the batch can't be allocated.
+        self.assertEqual(self.backend.count_users(), 0)
+        self.assertEqual(self._get_node_load("https://phx12"), (0, 5))
+        users = self.backend.allocate_users("sync-1.0", emails[:20])
+        self.assertEqual(len(users), 20)
+        self.assertEqual(self._get_node_load("https://phx12"), (20, 0))
+
+    def _count_active_records(self, nodeid):
+        query = sqltext("SELECT COUNT(*) FROM users "
+                        "WHERE nodeid=:nodeid AND replaced_at IS NULL")
+        res = self.backend._safe_execute(query, nodeid=nodeid)
+        count = res.fetchone()[0]
+        res.close()
+        return count
+
+    def test_unassign_node_in_batches(self):
+        self.backend.add_node("sync-1.0", "https://phx13", 100)
+        emails = ["test%d@mozilla.com" % (i,) for i in xrange(7)]
+        users = self.backend.allocate_users("sync-1.0", emails,
+                                            node="https://phx12")
+        self.backend.allocate_user("sync-1.0", "other@mozilla.com",
+                                   node="https://phx13")
+        # An already-replaced record keeps its replaced_at timestamp.
+        self.backend.update_user("sync-1.0", users[0], client_state="aa")
+        time.sleep(0.01)
+        old_records = list(self.backend.get_old_user_records("sync-1.0", 0))
+        self.assertEqual(len(old_records), 1)
+        nodeid = self.backend.get_node_id("sync-1.0", "https://phx12")
+        progress = []
+        last_uid = self.backend.unassign_node(
+            "sync-1.0", "https://phx12", batch_size=3,
+            progress=lambda *args: progress.append(args))
+        self.assertEqual([count for _, count in progress], [3, 6, 7])
+        self.assertEqual(progress[-1][0], last_uid)
+        self.assertEqual(self._count_active_records(nodeid), 0)
+        nodeid2 = self.backend.get_node_id("sync-1.0", "https://phx13")
+        self.assertEqual(self._count_active_records(nodeid2), 1)
+        time.sleep(0.01)
+        self.assertEqual(list(self.backend.get_old_user_records(
+            "sync-1.0", 0, offset=7)), old_records)
+
+    def test_unassign_node_in_batches_can_be_resumed(self):
+        emails = ["test%d@mozilla.com" % (i,) for i in xrange(5)]
+        users = self.backend.allocate_users("sync-1.0", emails)
+        nodeid = self.backend.get_node_id("sync-1.0", "https://phx12")
+
+        def interrupt(last_uid, count):
+            raise KeyboardInterrupt()
+
+        with self.assertRaises(KeyboardInterrupt):
+            self.backend.unassign_node("sync-1.0", "https://phx12",
+                                       batch_size=2, progress=interrupt)
+        self.assertEqual(self._count_active_records(nodeid), 3)
+        # Starting after an earlier uid skips the records before it.
+        self.backend.unassign_node("sync-1.0", "https://phx12",
+                                   batch_size=2, start_uid=users[2]['uid'])
+        self.assertEqual(self._count_active_records(nodeid), 1)
+        self.backend.unassign_node("sync-1.0", "https://phx12", batch_size=2)
+        self.assertEqual(self._count_active_records(nodeid), 0)
+
+    def test_unassign_node_in_batches_is_rate_limited(self):
+        emails = ["test%d@mozilla.com" % (i,) for i in xrange(4)]
+        self.backend.allocate_users("sync-1.0", emails)
+        start = time.time()
+        self.backend.unassign_node("sync-1.0", "https://phx12",
+                                   batch_size=2, max_rate=20)
+        self.assertTrue(time.time() - start >= 0.19)
+
+    def test_remove_node_in_batches(self):
+        self.backend.add_node("sync-1.0", "https://phx13", 100)
+        emails = ["test%d@mozilla.com" % (i,) for i in xrange(5)]
+        self.backend.allocate_users("sync-1.0", emails, node="https://phx12")
+        nodeid = self.backend.get_node_id("sync-1.0", "https://phx12")
+        self.backend.remove_node("sync-1.0", "https://phx12", batch_size=2)
+        self.assertEqual(self._count_active_records(nodeid), 0)
+        self.assertRaises(ValueError, self.backend.get_node_id,
+                          "sync-1.0", "https://phx12")
+        for email in emails:
+            user = self.backend.get_user("sync-1.0", email)
+            self.assertEqual(user["node"], "https://phx13")
+
+    def test_reconcile_node_loads(self):
+        self.backend.add_node("sync-1.0", "https://phx13", 100,
+                              current_load=20, available=3)
+        self.backend.add_node("sync-1.5", "https://phx14", 100,
+                              current_load=7, available=3)
+        emails = ["test%d@mozilla.com" % (i,) for i in xrange(5)]
+        self.backend.allocate_users("sync-1.0", emails, node="https://phx12")
+        self.backend.unassign_node("sync-1.0", "https://phx12",
+                                   batch_size=1, start_uid=4)
+        self.backend.update_node("sync-1.0", "https://phx12",
+                                 current_load=2, available=5)
+        expected = [
+            ("sync-1.0", "https://phx12", 2, 4),
+            ("sync-1.0", "https://phx13", 20, 0),
+        ]
+        # A dry run only reports the differences.
+        results = self.backend.reconcile_node_loads("sync-1.0", batch_size=2,
+                                                    dry_run=True)
+        self.assertEqual(results, expected)
+        self.assertEqual(self._get_node_load("https://phx12"), (2, 5))
+        results = self.backend.reconcile_node_loads("sync-1.0", batch_size=2)
+        self.assertEqual(results, expected)
+        self.assertEqual(self._get_node_load("https://phx12"), (4, 3))
+        self.assertEqual(self._get_node_load("https://phx13"), (0, 23))
+        self.assertEqual(self._get_node_load("https://phx14"), (7, 3))
+        # Available slots are kept within the room left on the node.
+        self.backend.update_node("sync-1.0", "https://phx12",
+                                 current_load=0, available=98)
+        self.backend.reconcile_node_loads()
+        self.assertEqual(self._get_node_load("https://phx12"), (4, 94))
+        self.assertEqual(self._get_node_load("https://phx14"), (0, 10))
+
+    def test_reassign_replaced_users(self):
+        self.backend.add_node("sync-1.0", "https://phx13", 100)
+        emails = ["test%d@mozilla.com" % (i,) for i in xrange(5)]
+        users = self.backend.allocate_users("sync-1.0", emails,
+                                            node="https://phx12")
+        self.backend.update_user("sync-1.0", users[1], generation=12)
+        self.backend.retire_user(emails[2])
+        timestamp = get_timestamp()
+        self.backend.unassign_node("sync-1.0", "https://phx12", timestamp)
+        self.backend.update_node("sync-1.0", "https://phx12", downed=1)
+        # One of them has already come back and been reassigned.
+        returned = self.backend.get_user("sync-1.0", emails[3])
+        progress = []
+        self.backend.reassign_replaced_users(
+            "sync-1.0", timestamp, batch_size=2,
+            progress=lambda *args: progress.append(args))
+        self.assertEqual([count for _, count in progress], [2, 4, 5])
+        nodeid = self.backend.get_node_id("sync-1.0", "https://phx13")
+        self.assertEqual(self._count_active_records(nodeid), 4)
+        # The retired user is left without a live record.
+        retired = self.backend.get_user("sync-1.0", emails[2])
+        self.assertEqual(retired["node"], "https://phx12")
+        for email in emails[:2] + emails[3:]:
+            user = self.backend.get_user("sync-1.0", email)
+            self.assertEqual(user["node"], "https://phx13")
+            # They now have a live record, so reading them doesn't
+            # need to reassign them again.
+            self.assertEqual(self.backend.get_user("sync-1.0", email)["uid"],
+                             user["uid"])
+        user = self.backend.get_user("sync-1.0", emails[1])
+        self.assertEqual(user["generation"], 12)
+        self.assertEqual(
+            self.backend.get_user("sync-1.0", emails[3])["uid"],
+            returned["uid"])
+
+    def test_reassignment_can_be_resumed_after_unassigning_again(self):
+        self.backend.add_node("sync-1.0", "https://phx13", 100)
+        emails = ["test%d@mozilla.com" % (i,) for i in xrange(4)]
+        self.backend.allocate_users("sync-1.0", emails, node="https://phx12")
+        self.backend.update_node("sync-1.0", "https://phx12", downed=1)
+        since = get_timestamp()
+        self.backend.unassign_node("sync-1.0", "https://phx12", since,
+                                   batch_size=2)
+        # The first run only got as far as giving one user a new node,
+        # and in the meantime another user was put on the old one.
+        self.backend.get_user("sync-1.0", emails[0])
+        self.backend.allocate_user("sync-1.0", "new@mozilla.com",
+                                   node="https://phx12")
+        time.sleep(0.002)
+        self.backend.unassign_node("sync-1.0", "https://phx12")
+        self.backend.reassign_replaced_users("sync-1.0", since)
+        nodeid = self.backend.get_node_id("sync-1.0", "https://phx13")
+        self.assertEqual(self._count_active_records(nodeid), 5)
+
+    def test_release_node_capacity_tops_up_nodes_running_low(self):
+        self.backend.update_node("sync-1.0", "https://phx12",
+                                 current_load=50, available=2)
+        self.backend.add_node("sync-1.0", "https://phx13", 100,
+                              current_load=50, available=8)
+        self.backend.add_node("sync-1.0", "https://phx14", 100,
+                              current_load=97, available=1)
+        self.backend.add_node("sync-1.0", "https://phx15", 100,
+                              current_load=0, available=0, downed=1)
+        self.assertEqual(self.backend.release_node_capacity(), 2)
+        self.assertEqual(self._get_node_load("https://phx12"), (50, 10))
+        self.assertEqual(self._get_node_load("https://phx13"), (50, 8))
+        self.assertEqual(self._get_node_load("https://phx14"), (97, 3))
+        self.assertEqual(self._get_node_load("https://phx15"), (0, 0))
+        self.assertEqual(self.backend.release_node_capacity(), 0)
+
+    def test_pool_status(self):
+        if self.backend._engine.driver != 'pysqlite':
+            raise unittest.SkipTest("not using sqlite")
+        status = self.backend.get_pool_status()
+        self.assertEqual(status, {'primary': {'class': 'NullPool'}})
+
+    def test_instrumented_pool_counts_checkouts_and_timeouts(self):
+        engine = create_engine('sqlite://', poolclass=_InstrumentedQueuePool,
+                               pool_size=1, max_overflow=0, pool_timeout=0.01)
+        conn = engine.connect()
+        try:
+            self.assertRaises(TimeoutError, engine.connect)
+            status = _get_pool_status(engine.pool)
+        finally:
+            conn.close()
+        self.assertEqual(status['class'], '_InstrumentedQueuePool')
+        self.assertEqual(status['size'], 1)
+        self.assertEqual(status['in_use'], 1)
+        self.assertEqual(status['idle'], 0)
+        self.assertEqual(status['overflow'], 0)
+        self.assertEqual(status['checkouts'], 1)
+        self.assertEqual(status['timeouts'], 1)
+
+
+class TestSQLDBWithUserCache(TestSQLDB):
+
+    def setUp(self):
+        self.backend = SQLNodeAssignment(self._SQLURI, create_tables=True,
+                                         user_cache_size=10)
+        super(TestSQLDB, self).setUp()
+
+    def _set_generation_behind_the_cache(self, email, generation):
+        query = sqltext("UPDATE users SET generation=:generation "
+                        "WHERE email=:email")
+        res = self.backend._safe_execute(query, generation=generation,
+                                         email=email)
+        res.close()
+
+    def test_user_cache_serves_repeated_reads(self):
+        user = self.backend.allocate_user("sync-1.0", "test@mozilla.com")
+        self.backend.get_user("sync-1.0", "test@mozilla.com")
+        self._set_generation_behind_the_cache("test@mozilla.com", 42)
+        cached = self.backend.get_user("sync-1.0", "test@mozilla.com")
+        self.assertEqual(cached["uid"], user["uid"])
+        self.assertEqual(cached["generation"], 0)
+        # Modifying the returned record doesn't affect the cached copy.
+        cached["old_client_states"]["xxx"] = True
+        cached = self.backend.get_user("sync-1.0", "test@mozilla.com")
+        self.assertEqual(cached["old_client_states"], {})
+
+    def test_user_cache_is_invalidated_by_writes(self):
+        user = self.backend.allocate_user("sync-1.0", "test@mozilla.com")
+        self.backend.get_user("sync-1.0", "test@mozilla.com")
+        self.backend.update_user("sync-1.0", user, generation=12)
+        self.assertEqual(
+            self.backend.get_user("sync-1.0", "test@mozilla.com"), user)
+        self.backend.update_user("sync-1.0", user, client_state="aaa")
+        self.assertEqual(
+            self.backend.get_user("sync-1.0", "test@mozilla.com"), user)
+
+    def test_user_cache_is_invalidated_by_replacement(self):
+        user = self.backend.allocate_user("sync-1.0", "test@mozilla.com")
+        self.backend.get_user("sync-1.0", "test@mozilla.com")
+        self.backend.replace_user_records("sync-1.0", "test@mozilla.com")
+        user2 = self.backend.get_user("sync-1.0", "test@mozilla.com")
+        self.assertNotEqual(user2["uid"], user["uid"])
+        self._set_generation_behind_the_cache("test@mozilla.com", 42)
+        self.backend.retire_user("test@mozilla.com")
+        user3 = self.backend.get_user("sync-1.0", "test@mozilla.com")
+        self.assertEqual(user3["generation"], MAX_GENERATION)
+
+    def test_user_cache_is_invalidated_by_unassign_node(self):
+        user = self.backend.allocate_user("sync-1.0", "test@mozilla.com")
+        self.backend.get_user("sync-1.0", "test@mozilla.com")
+        self.backend.unassign_node("sync-1.0", "https://phx12")
+        user2 = self.backend.get_user("sync-1.0", "test@mozilla.com")
+        self.assertNotEqual(user2["uid"], user["uid"])
+
+    def test_unassign_node_keeps_users_on_other_nodes_cached(self):
+        self.backend.add_node("sync-1.0", "https://phx13", 100)
+        self.backend.update_node("sync-1.0", "https://phx12", available=0)
+        self.backend.allocate_user("sync-1.0", "test@mozilla.com")
+        self.backend.get_user("sync-1.0", "test@mozilla.com")
+        self.backend.unassign_node("sync-1.0", "https://phx12")
+        self.assertIn(("sync-1.0", "test@mozilla.com"),
+                      self.backend._user_cache.data)
+
+    def test_delete_user_record_invalidates_only_that_user(self):
+        user = self.backend.allocate_user("sync-1.0", "test1@mozilla.com")
+        self.backend.allocate_user("sync-1.0", "test2@mozilla.com")
+        self.backend.get_user("sync-1.0", "test1@mozilla.com")
+        self.backend.get_user("sync-1.0", "test2@mozilla.com")
+        self.backend.delete_user_record("sync-1.0", user["uid"])
+        self.assertNotIn(("sync-1.0", "test1@mozilla.com"),
+                         self.backend._user_cache.data)
+        self.assertIn(("sync-1.0", "test2@mozilla.com"),
+                      self.backend._user_cache.data)
+
+    def test_user_cache_is_not_populated_by_reassignment(self):
+        self.backend.allocate_user("sync-1.0", "test@mozilla.com")
+        self.backend.unassign_node("sync-1.0", "https://phx12")
+        # This writes a new record, so the result isn't cached...
+        user = self.backend.get_user("sync-1.0", "test@mozilla.com")
+        self.assertNotIn(("sync-1.0", "test@mozilla.com"),
+                         self.backend._user_cache.data)
+        # ...until it's next read from the db.
+        self.assertEqual(
+            self.backend.get_user("sync-1.0", "test@mozilla.com"), user)
+        self.assertIn(("sync-1.0", "test@mozilla.com"),
+                      self.backend._user_cache.data)
+
+    def test_user_cache_size_is_bounded(self):
+        for i in xrange(20):
+            email = "test%d@mozilla.com" % i
+            self.backend.allocate_user("sync-1.0", email)
+            self.backend.get_user("sync-1.0", email)
+        self.assertEqual(len(self.backend._user_cache.data), 10)
+
+
+class TestSQLDBWithWriteBehind(TestSQLDB):
+
+    def setUp(self):
+        # Use the longest flush interval so the tests can flush explicitly.
+        self.backend = SQLNodeAssignment(
+            self._SQLURI, create_tables=True,
+            update_flush_interval=MAX_UPDATE_FLUSH_INTERVAL)
+        super(TestSQLDB, self).setUp()
+
+    def _get_generation_from_db(self, email):
+        query = sqltext("SELECT generation, keys_changed_at FROM users "
+                        "WHERE email=:email AND replaced_at IS NULL")
+        res = self.backend._safe_execute(query, email=email)
+        row = res.fetchone()
+        res.close()
+        return row[0], row[1]
+
+    def test_in_place_updates_are_deferred_until_flush(self):
+        user = self.backend.allocate_user("sync-1.0", "test@mozilla.com")
+        self.backend.update_user("sync-1.0", user, generation=12)
+        self.assertEqual(user["generation"], 12)
+        self.assertEqual(self._get_generation_from_db("test@mozilla.com"),
+                         (0, 0))
+        # Reads from this process see the queued value.
+        user = self.backend.get_user("sync-1.0", "test@mozilla.com")
+        self.assertEqual(user["generation"], 12)
+        self.assertEqual(self.backend.flush_pending_updates(), 1)
+        self.assertEqual(self._get_generation_from_db("test@mozilla.com"),
+                         (12, 0))
+        self.assertEqual(self.backend.flush_pending_updates(), 0)
+
+    def test_queued_updates_are_merged(self):
+        user1 = self.backend.allocate_user("sync-1.0", "test1@mozilla.com")
+        user2 = self.backend.allocate_user("sync-1.0", "test2@mozilla.com")
+        self.backend.update_user("sync-1.0", user1, generation=12)
+        self.backend.update_user("sync-1.0", user1, keys_changed_at=10)
+        self.backend.update_user("sync-1.0", dict(user1, generation=0),
+                                 generation=7)
+        self.backend.update_user("sync-1.0", user2, generation=5)
+        self.assertEqual(self.backend.flush_pending_updates(), 2)
+        self.assertEqual(self._get_generation_from_db("test1@mozilla.com"),
+                         (12, 10))
+        self.assertEqual(self._get_generation_from_db("test2@mozilla.com"),
+                         (5, 0))
+
+    def test_flushed_updates_never_move_fields_backwards(self):
+        user = self.backend.allocate_user("sync-1.0", "test@mozilla.com",
+                                          generation=5)
+        self.backend.update_user("sync-1.0", user, generation=10)
+        # Simulate another process writing a newer value in the meantime.
+        query = sqltext("UPDATE users SET generation=20")
+        self.backend._safe_execute(query).close()
+        self.backend.flush_pending_updates()
+        self.assertEqual(self._get_generation_from_db("test@mozilla.com"),
+                         (20, 0))
+
+    def test_merged_updates_move_each_field_forward_independently(self):
+        user = self.backend.allocate_user("sync-1.0", "test@mozilla.com")
+        self.backend.update_user("sync-1.0", user, generation=10)
+        self.backend.update_user("sync-1.0", user, keys_changed_at=5)
+        # Simulate another process moving one of the fields past the
+        # queued value; the bump to the other must still be written.
+        query = sqltext("UPDATE users SET keys_changed_at=8")
+        self.backend._safe_execute(query).close()
+        self.backend.flush_pending_updates()
+        self.assertEqual(self._get_generation_from_db("test@mozilla.com"),
+                         (10, 8))
+
+    def test_close_stops_the_flusher_and_flushes(self):
+        user = self.backend.allocate_user("sync-1.0", "test@mozilla.com")
+        self.backend.update_user("sync-1.0", user, generation=12)
+        workers = list(self.backend._workers)
+        self.assertTrue(workers)
+        self.backend.close()
+        for worker in workers:
+            self.assertFalse(worker.is_alive())
+        self.assertEqual(self._get_generation_from_db("test@mozilla.com"),
+                         (12, 0))
+
+    def test_long_flush_intervals_are_rejected(self):
+        self.assertRaises(ValueError, SQLNodeAssignment, self._SQLURI,
+                          update_flush_interval=MAX_UPDATE_FLUSH_INTERVAL + 1)
+
+    def test_closed_backends_are_not_kept_alive(self):
+        backend = SQLNodeAssignment(
+            self._SQLURI, update_flush_interval=MAX_UPDATE_FLUSH_INTERVAL)
+        backend_ref = weakref.ref(backend)
+        backend.close()
+        del backend
+        gc.collect()
+        self.assertEqual(backend_ref(), None)
+
+
+class TestSQLDBWithNodeSnapshot(TestSQLDB):
+
+    def setUp(self):
+        self.backend = SQLNodeAssignment(self._SQLURI, create_tables=True,
+                                         node_snapshot_interval=60)
+        super(TestSQLDB, self).setUp()
+
+    def _count_node_queries(self, func, *args, **kwds):
+        result, statements = self._count_statements(func, *args, **kwds)
+        return result, [str(st) for st in statements if "nodes" in str(st)]
+
+    def test_node_lookups_are_served_from_the_snapshot(self):
+        self.backend.get_node_id("sync-1.0", "https://phx12")
+        nodeid, statements = self._count_node_queries(
+            self.backend.get_node_id, "sync-1.0", "https://phx12")
+        self.assertEqual(statements, [])
+        # Only the claim on the node goes to the db.
+        (nodeid2, node), statements = self._count_node_queries(
+            self.backend.get_best_node, "sync-1.0", "test1@mozilla.com")
+        self.assertEqual(nodeid2, nodeid)
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith("UPDATE"))
+
+    def test_snapshot_is_reloaded_after_changes(self):
+        snapshot = self.backend._get_node_snapshot()
+        self.backend.add_node("sync-1.0", "https://phx13", 100)
+        self.backend.get_node_id("sync-1.0", "https://phx13")
+        snapshot2 = self.backend._get_node_snapshot()
+        self.assertTrue(snapshot2.version > snapshot.version)
+        # It's also reloaded once it gets too old.
+        snapshot2.loaded_at -= 61
+        snapshot3 = self.backend._get_node_snapshot()
+        self.assertTrue(snapshot3.version > snapshot2.version)
+
+    def test_nodes_added_elsewhere_can_still_be_found(self):
+        self.backend._get_node_snapshot()
+        other_backend = SQLNodeAssignment(self._SQLURI)
+        other_backend.add_node("sync-1.0", "https://phx13", 100)
+        nodeid = other_backend.get_node_id("sync-1.0", "https://phx13")
+        self.assertEqual(
+            self.backend.get_node_id("sync-1.0", "https://phx13"), nodeid)
+        self.assertRaises(ValueError, self.backend.get_node_id,
+                          "sync-1.0", "https://phx14")
+
+    def test_stale_snapshot_does_not_overshoot(self):
+        self.backend.update_node("sync-1.0", "https://phx12",
+                                 current_load=0, available=1)
+        self.backend.get_best_node("sync-1.0", "test1@mozilla.com")
+        # Another process fills up the node behind our back.
+        other_backend = SQLNodeAssignment(self._SQLURI)
+        other_backend.update_node("sync-1.0", "https://phx12",
+                                  current_load=100, available=0)
+        self.backend._node_snapshot.nodes_by_id.values()[0].available = 1
+        with self.assertRaises(BackendError):
+            self.backend.get_best_node("sync-1.0", "test2@mozilla.com")
+        self.assertEqual(self._get_node_load("https://phx12"), (100, 0))
+
+
+class TestSQLDBWithSQLitePerformanceMode(TestSQLDB):
+
+    def setUp(self):
+        self.backend = SQLNodeAssignment(self._SQLURI, create_tables=True,
+                                         sqlite_performance_mode=True)
+        super(TestSQLDB, self).setUp()
+
+    def test_pool_status(self):
+        if self.backend._engine.driver != 'pysqlite':
+            raise unittest.SkipTest("not using sqlite")
+        status = self.backend.get_pool_status()['primary']
+        self.assertEqual(status['class'], '_InstrumentedQueuePool')
+        self.assertEqual(status['in_use'], 0)
+        self.assertEqual(status['idle'], 1)
+
+    def test_sqlite_connections_use_wal(self):
+        if self.backend._engine.driver != 'pysqlite':
+            raise unittest.SkipTest("not using sqlite")
+        res = self.backend._safe_execute("PRAGMA journal_mode")
+        self.assertEqual(res.fetchone()[0], "wal")
+        res.close()
+
+    def test_concurrent_allocations(self):
+        errors = []
+
+        def allocate_users(n):
+            try:
+                for i in xrange(10):
+                    email = "test%d-%d@mozilla.com" % (n, i)
+                    self.backend.get_or_create_user("sync-1.0", email)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=allocate_users, args=(n,))
+                   for n in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.backend.count_users(), 40)
+
+
+class TestSQLDBWithReadReplica(SQLTestCase):
+
+    _REPLICA_SQLURI = DEFAULT_SQLURI + '.replica'
+
+    def setUp(self):
+        # The "replica" is a separate, empty db that never gets any writes,
+        # which makes it easy to tell which one we read from.
+        replica = SQLNodeAssignment(self._REPLICA_SQLURI, create_tables=True)
+        replica.add_service('sync-1.0', '{node}/1.0/{uid}')
+        self.backend = SQLNodeAssignment(
+            DEFAULT_SQLURI, create_tables=True,
+            replica_sqluris=self._REPLICA_SQLURI)
+        self.backend.add_service('sync-1.0', '{node}/1.0/{uid}')
+        self.backend.add_node('sync-1.0', 'https://phx12', 100)
+
+    def test_get_user_reads_from_replica_by_default(self):
+        user = self.backend.allocate_user("sync-1.0", "test@mozilla.com")
+        self.assertEqual(
+            self.backend.get_user("sync-1.0", "test@mozilla.com"), None)
+        user2 = self.backend.get_user("sync-1.0", "test@mozilla.com",
+                                      primary=True)
+        self.assertEqual(user2["uid"], user["uid"])
+
+    def test_count_users_reads_from_replica(self):
+        self.backend.allocate_user("sync-1.0", "test@mozilla.com")
+        self.assertEqual(self.backend.count_users(), 0)
+
+    def test_reads_fall_back_to_primary_if_replica_fails(self):
+        self.backend._replicas[0].engine = create_engine(
+            'sqlite:////no/such/directory/tokenserver.db')
+        user = self.backend.allocate_user("sync-1.0", "test@mozilla.com")
+        user2 = self.backend.get_user("sync-1.0", "test@mozilla.com")
+        self.assertEqual(user2["uid"], user["uid"])
+        self.assertFalse(self.backend._replicas[0].healthy)
+
+
+class TestSQLDBWithNodeSelectionPolicy(SQLTestCase):
+
+    def setUp(self):
+        self.backend = SQLNodeAssignment(
+            DEFAULT_SQLURI, create_tables=True,
+            node_selection_policy='power_of_two')
+        self.backend.add_service('sync-1.0', '{node}/1.0/{uid}')
+        for node in ('https://phx12', 'https://phx13', 'https://phx14'):
+            self.backend.add_node('sync-1.0', node, 100, available=100)
+
+    def test_unknown_policy_is_rejected(self):
+        self.assertRaises(ValueError, SQLNodeAssignment, DEFAULT_SQLURI,
+                          node_selection_policy='fastest')
+
+    def test_allocations_are_spread_over_nodes(self):
+        nodes = defaultdict(int)
+        for i in xrange(30):
+            email = "test%d@mozilla.com" % (i,)
+            user = self.backend.allocate_user("sync-1.0", email)
+            nodes[user['node']] += 1
+        self.assertEqual(sum(nodes.values()), 30)
+        # A node with no users wins whenever it's one of the two choices,
+        # so it's vanishingly unlikely that any node gets left out.
+        self.assertEqual(len(nodes), 3)
+
+    def test_allocation_is_not_allowed_to_downed_nodes(self):
+        self.backend.update_node('sync-1.0', 'https://phx12', downed=True)
+        self.backend.update_node('sync-1.0', 'https://phx13', backoff=True)
+        for i in xrange(10):
+            email = "test%d@mozilla.com" % (i,)
+            user = self.backend.allocate_user("sync-1.0", email)
+            self.assertEqual(user['node'], 'https://phx14')
+        self.backend.update_node('sync-1.0', 'https://phx14', downed=True)
+        with self.assertRaises(BackendError):
+            self.backend.allocate_user("sync-1.0", "test@mozilla.com")
+
+
+class TestSQLDBWithSpannerLoadFlushing(SQLTestCase):
+
+    def setUp(self):
+        # Use a long flush interval so the tests can flush explicitly.
+        self.backend = SQLNodeAssignment(
+            DEFAULT_SQLURI, create_tables=True, spanner_node_id=800,
+            migrate_new_user_percentage=100,
+            spanner_load_flush_interval=3600)
+        self.backend.add_service('sync-1.5', '{node}/1.5/{uid}')
+        self.backend.add_node('sync-1.5', 'https://spanner', 0, nodeid=800)
+
+    def _get_spanner_load(self):
+        query = sqltext("SELECT current_load FROM nodes WHERE id=800")
+        res = self.backend._safe_execute(query)
+        current_load = res.fetchone()[0]
+        res.close()
+        return current_load
+
+    def test_spanner_load_is_added_on_flush(self):
+        user = self.backend.allocate_user("sync-1.5", "test@mozilla.com")
+        self.assertEqual(user["node"], "https://spanner")
+        emails = ["test%d@mozilla.com" % (i,) for i in xrange(3)]
+        self.backend.allocate_users("sync-1.5", emails)
+        self.assertEqual(self._get_spanner_load(), 0)
+        self.assertEqual(self.backend.flush_spanner_load(), 4)
+        self.assertEqual(self._get_spanner_load(), 4)
+        self.assertEqual(self.backend.flush_spanner_load(), 0)
+        self.assertEqual(self._get_spanner_load(), 4)
+
+    def test_spanner_load_is_kept_if_flush_fails(self):
+        self.backend.allocate_user("sync-1.5", "test@mozilla.com")
+
+        def fail(*args, **kwds):
+            raise BackendError("boom")
+
+        self.backend._safe_execute = fail
+        try:
+            self.assertRaises(BackendError, self.backend.flush_spanner_load)
+        finally:
+            del self.backend._safe_execute
+        self.backend.allocate_user("sync-1.5", "test2@mozilla.com")
+        self.assertEqual(self.backend.flush_spanner_load(), 2)
+        self.assertEqual(self._get_spanner_load(), 2)
+
+    def test_spanner_load_is_returned_if_user_was_created(self):
+        users = self._race_with_user_creation()
+        user = self.backend.get_or_create_user("sync-1.5", "test@mozilla.com")
+        self.assertEqual(user["uid"], users[0]["uid"])
+        # Only the other request's user is counted.
+        self.assertEqual(self.backend.flush_spanner_load(), 1)
+        self.assertEqual(self._get_spanner_load(), 1)
+
+
+class TestSQLDBWithBackgroundCapacityRelease(SQLTestCase):
+
+    def setUp(self):
+        self.backend = SQLNodeAssignment(DEFAULT_SQLURI, create_tables=True,
+                                         capacity_release_interval=3600)
+        self.backend.add_service('sync-1.0', '{node}/1.0/{uid}')
+        self.backend.add_node('sync-1.0', 'https://phx12', 100,
+                              current_load=10, available=0)
+
+    def test_allocation_does_not_release_capacity(self):
+        with self.assertRaises(BackendError):
+            self.backend.allocate_user("sync-1.0", "test1@mozilla.com")
+        self.backend.release_node_capacity()
+        user = self.backend.allocate_user("sync-1.0", "test1@mozilla.com")
+        self.assertEqual(user['node'], 'https://phx12')
+
+    def test_capacity_is_released_in_the_background(self):
+        backend = SQLNodeAssignment(DEFAULT_SQLURI,
+                                    capacity_release_interval=0.01)
+        try:
+            for _ in xrange(100):
+                time.sleep(0.01)
+                try:
+                    backend.allocate_user("sync-1.0", "test1@mozilla.com")
+                except BackendError:
+                    continue
+                break
+        finally:
+            backend.close()
+        user = backend.get_user("sync-1.0", "test1@mozilla.com")
+        self.assertEqual(user['node'], 'https://phx12')
+
+
+class TestSQLDBWithNodeLeases(SQLTestCase):
+
+    def setUp(self):
+        self.backend = SQLNodeAssignment(DEFAULT_SQLURI, create_tables=True,
+                                         node_lease_size=10)
+        self.backend.add_service('sync-1.0', '{node}/1.0/{uid}')
+        self.backend.add_node('sync-1.0', 'https://phx12', 100,
+                              available=100)
+
+    def test_allocations_are_served_from_a_lease(self):
+        user = self.backend.allocate_user("sync-1.0", "test1@mozilla.com")
+        self.assertEqual(user["node"], "https://phx12")
+        self.assertEqual(self._get_node_load(), (10, 90))
+        emails = ["test%d@mozilla.com" % (i + 2,) for i in xrange(9)]
+
+        def allocate_users():
+            return [self.backend.allocate_user("sync-1.0", email)
+                    for email in emails]
+
+        users, statements = self._count_statements(allocate_users)
+        for user in users:
+            self.assertEqual(user["node"], "https://phx12")
+        # Only the user records were written, not the node.
+        self.assertEqual([st for st in statements if "nodes" in str(st)], [])
+        self.assertEqual(self._get_node_load(), (10, 90))
+        # Once it's used up, another lease is taken out.
+        self.backend.allocate_user("sync-1.0", "test11@mozilla.com")
+        self.assertEqual(self._get_node_load(), (20, 80))
+
+    def test_unused_slots_are_returned_on_release(self):
+        self.backend.allocate_user("sync-1.0", "test1@mozilla.com")
+        self.backend.allocate_user("sync-1.0", "test2@mozilla.com")
+        self.assertEqual(self._get_node_load(), (10, 90))
+        self.backend.release_node_leases()
+        self.assertEqual(self._get_node_load(), (2, 98))
+        # Releasing again is a no-op.
+        self.backend.release_node_leases()
+        self.assertEqual(self._get_node_load(), (2, 98))
+
+    def test_returned_slots_stay_within_capacity_after_reconcile(self):
+        self.backend.allocate_user("sync-1.0", "test1@mozilla.com")
+        self.backend.allocate_user("sync-1.0", "test2@mozilla.com")
+        self.assertEqual(self._get_node_load(), (10, 90))
+        # Another process recounts the load without our leased slots.
+        other = SQLNodeAssignment(DEFAULT_SQLURI)
+        try:
+            other.reconcile_node_loads()
+        finally:
+            other.close()
+        self.assertEqual(self._get_node_load(), (2, 98))
+        self.backend.release_node_leases()
+        self.assertEqual(self._get_node_load(), (0, 100))
+
+    def test_unused_slots_are_returned_on_close(self):
+        self.backend.allocate_user("sync-1.0", "test1@mozilla.com")
+        self.assertEqual(self._get_node_load(), (10, 90))
+        self.backend.close()
+        self.assertEqual(self._get_node_load(), (1, 99))
+
+    def test_expired_leases_are_replaced(self):
+        self.backend.allocate_user("sync-1.0", "test1@mozilla.com")
+        self.backend.release_node_leases(expired=True)
+        self.assertEqual(self._get_node_load(), (10, 90))
+        self.backend._node_leases["sync-1.0"].expires_at = 0
+        self.backend.release_node_leases(expired=True)
+        self.assertEqual(self._get_node_load(), (1, 99))
+        self.backend.allocate_user("sync-1.0", "test2@mozilla.com")
+        self.assertEqual(self._get_node_load(), (11, 89))
+
+    def test_lease_is_limited_to_available_slots(self):
+        self.backend.update_node('sync-1.0', 'https://phx12', available=3)
+        self.backend.allocate_user("sync-1.0", "test1@mozilla.com")
+        self.assertEqual(self._get_node_load(), (3, 0))
+
+    def test_leased_slots_are_not_used_on_downed_nodes(self):
+        self.backend.add_node('sync-1.0', 'https://phx13', 100,
+                              available=100)
+        user = self.backend.allocate_user("sync-1.0", "test1@mozilla.com")
+        self.backend.update_node('sync-1.0', user["node"], downed=True)
+        self.assertEqual(self._get_node_load(user["node"]), (1, 99))
+        user2 = self.backend.allocate_user("sync-1.0", "test2@mozilla.com")
+        self.assertNotEqual(user2["node"], user["node"])
+
+    def test_reassignment_of_replaced_users_takes_a_lease(self):
+        for i in xrange(2):
+            self.backend.allocate_user("sync-1.0", "test%d@mozilla.com" % i)
+        timestamp = get_timestamp()
+        self.backend.unassign_node("sync-1.0", "https://phx12",
+                                   timestamp=timestamp)
+        _, statements = self._count_statements(
+            self.backend.reassign_replaced_users, "sync-1.0", timestamp)
+        # Both users were given slots from a single new lease.
+        updates = [st for st in statements
+                   if str(st).startswith("UPDATE nodes")]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(self.backend._node_leases["sync-1.0"].remaining, 8)
+
+
+class TestSQLDBWithNodeLeasesInSQLitePerformanceMode(
+        TestSQLDBWithNodeLeases):
+
+    def setUp(self):
+        # Each transaction holds the db's write lock from the start, so
+        # anything that waits on it from another connection would fail.
+        self.backend = SQLNodeAssignment(DEFAULT_SQLURI, create_tables=True,
+                                         node_lease_size=10,
+                                         sqlite_performance_mode=True,
+                                         sqlite_busy_timeout=0.5)
+        self.backend.add_service('sync-1.0', '{node}/1.0/{uid}')
+        self.backend.add_node('sync-1.0', 'https://phx12', 100,
+                              available=100)
+
+    def test_reassignment_in_a_transaction_does_not_take_a_lease(self):
+        user = self.backend.allocate_user("sync-1.0", "test1@mozilla.com")
+        self.backend.unassign_node("sync-1.0", "https://phx12")
+        self.assertEqual(self._get_node_load(), (1, 99))
+        with self.backend._safe_transaction("sync-1.0") as connection:
+            user2 = self.backend.get_user("sync-1.0", "test1@mozilla.com",
+                                          engine=connection)
+        self.assertNotEqual(user2["uid"], user["uid"])
+        self.assertEqual(user2["node"], "https://phx12")
+        # Just the one slot was claimed, in the transaction.
+        self.assertEqual(self._get_node_load(), (2, 98))
+        self.assertEqual(self.backend._node_leases, {})
+
+    def test_concurrent_allocations(self):
+        errors = []
+
+        def allocate_users(n):
+            try:
+                for i in xrange(10):
+                    email = "test%d-%d@mozilla.com" % (n, i)
+                    self.backend.get_or_create_user("sync-1.0", email)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=allocate_users, args=(n,))
+                   for n in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.backend.count_users(), 40)
+        self.backend.release_node_leases()
+        self.assertEqual(self._get_node_load(), (40, 60))
+
+
+class TestShardedSQLDBWithOneShard(NodeAssignmentTests, SQLTestCase):
+
+    def setUp(self):
+        self.backend = ShardedSQLNodeAssignment(DEFAULT_SQLURI,
+                                                create_tables=True)
+        super(TestShardedSQLDBWithOneShard, self).setUp()
+
+
+class TestShardedSQLDB(SQLTestCase):
+
+    _SHARD_SQLURIS = [DEFAULT_SQLURI + '.shard0', DEFAULT_SQLURI + '.shard1']
+
+    def setUp(self):
+        self.backend = ShardedSQLNodeAssignment(" ".join(self._SHARD_SQLURIS),
+                                                create_tables=True)
+        self.backend.add_service('sync-1.0', '{node}/1.0/{uid}')
+        self.backend.add_node('sync-1.0', 'https://phx12', 101)
+        # Find some emails that are routed to each shard.
+        self.emails = defaultdict(list)
+        for i in xrange(20):
+            email = "test%d@mozilla.com" % i
+            self.emails[self.backend._get_shard_index(email)].append(email)
+        self.assertTrue(self.emails[0] and self.emails[1])
+
+    def _count_shard_users(self, index):
+        return self.backend.shards[index].count_users()
+
+    def test_node_capacity_is_split_between_shards(self):
+        query = sqltext("SELECT capacity, available FROM nodes")
+        rows = []
+        for shard in self.backend.shards:
+            res = shard._safe_execute(query)
+            rows.append(tuple(res.fetchone()))
+            res.close()
+        self.assertEqual(rows, [(51, 6), (50, 5)])
+
+    def test_users_are_routed_to_their_shard(self):
+        email0 = self.emails[0][0]
+        email1 = self.emails[1][0]
+        user0 = self.backend.allocate_user("sync-1.0", email0)
+        user1 = self.backend.allocate_user("sync-1.0", email1)
+        self.assertEqual(self._count_shard_users(0), 1)
+        self.assertEqual(self._count_shard_users(1), 1)
+        # Each shard starts counting from uid 1, but the uids we hand
+        # out must not collide.
+        self.assertNotEqual(user0["uid"], user1["uid"])
+        self.assertEqual(user0["uid"] % 2, 0)
+        self.assertEqual(user1["uid"] % 2, 1)
+        self.assertEqual(self.backend.get_user("sync-1.0", email0), user0)
+        self.assertEqual(self.backend.get_user("sync-1.0", email1), user1)
+
+    def test_update_user_keeps_uids_global(self):
+        email = self.emails[1][0]
+        user = self.backend.allocate_user("sync-1.0", email)
+        orig_uid = user["uid"]
+        self.backend.update_user("sync-1.0", user, generation=12)
+        self.assertEqual(user["uid"], orig_uid)
+        self.backend.update_user("sync-1.0", user, client_state="aaa")
+        self.assertNotEqual(user["uid"], orig_uid)
+        self.assertEqual(user["uid"] % 2, 1)
+        self.assertEqual(self.backend.get_user("sync-1.0", email), user)
+
+    def test_allocate_users_keeps_uids_global(self):
+        emails = self.emails[0][:3] + self.emails[1][:3]
+        users = self.backend.allocate_users("sync-1.0", emails)
+        self.assertEqual([user["email"] for user in users], emails)
+        self.assertEqual(self._count_shard_users(0), 3)
+        self.assertEqual(self._count_shard_users(1), 3)
+        for user in users:
+            index = self.backend._get_shard_index(user["email"])
+            self.assertEqual(user["uid"] % 2, index)
+            self.assertEqual(
+                self.backend.get_user("sync-1.0", user["email"]), user)
+
+    def test_cross_shard_operations(self):
+        users = []
+        for index in (0, 1):
+            for email in self.emails[index][:2]:
+                user = self.backend.allocate_user("sync-1.0", email)
+                self.backend.update_user("sync-1.0", user, client_state="a")
+                users.append(user)
+        self.assertEqual(self.backend.count_users(), 4)
+        # Old records from all shards are merged together.
+        old_records = list(self.backend.get_old_user_records(
+            "sync-1.0", grace_period=0))
+        self.assertEqual(len(old_records), 4)
+        self.assertEqual(len(list(self.backend.get_old_user_records(
+            "sync-1.0", grace_period=0, limit=3))), 3)
+        self.assertEqual(len(list(self.backend.get_old_user_records(
+            "sync-1.0", grace_period=0, offset=3))), 1)
+        # And can be deleted using the uids we gave out.
+        for record in old_records:
+            self.backend.delete_user_record("sync-1.0", record.uid)
+        self.assertEqual(len(list(self.backend.get_old_user_records(
+            "sync-1.0", grace_period=0))), 0)
+        # Unassigning the node affects all shards.
+        self.backend.unassign_node("sync-1.0", "https://phx12")
+        for user in users:
+            new_user = self.backend.get_user("sync-1.0", user["email"])
+            self.assertNotEqual(new_user["uid"], user["uid"])
+        # Retiring a user works wherever they are.
+        self.backend.retire_user(users[0]["email"])
+        self.backend.retire_user(users[-1]["email"])
+        self.assertEqual(self.backend.count_users(), 2)
+
+    def test_old_user_records_are_paged_through_each_shard(self):
+        for email in self.emails[0][:3] + self.emails[1][:2]:
+            user = self.backend.allocate_user("sync-1.0", email)
+            self.backend.update_user("sync-1.0", user, client_state="a")
+        requests = []
+
+        def record_requests(i, shard):
+            get_old_user_records = shard.get_old_user_records
+
+            def wrapper(service, grace_period, limit, offset, **kwds):
+                requests.append((i, limit, offset))
+                return get_old_user_records(service, grace_period, limit,
+                                            offset, **kwds)
+            shard.get_old_user_records = wrapper
+        for i, shard in enumerate(self.backend.shards):
+            record_requests(i, shard)
+        uids = []
+        for offset in (0, 2, 4):
+            uids.extend(row.uid for row in self.backend.get_old_user_records(
+                "sync-1.0", grace_period=0, limit=2, offset=offset))
+        self.assertEqual(len(set(uids)), 5)
+        # Each shard is only asked for the rows it contributes to a page.
+        self.assertEqual(requests, [(0, 2, 0), (0, 2, 2), (1, 1, 0),
+                                    (0, 2, 4), (1, 2, 1)])
+
+    def test_reconcile_node_loads_adds_up_shards(self):
+        emails = self.emails[0][:3] + self.emails[1][:2]
+        self.backend.allocate_users("sync-1.0", emails)
+        self.backend.update_node("sync-1.0", "https://phx12",
+                                 current_load=0, available=10)
+        results = self.backend.reconcile_node_loads()
+        self.assertEqual(results, [("sync-1.0", "https://phx12", 0, 5)])
+        self.assertEqual(self.backend.reconcile_node_loads(),
+                         [("sync-1.0", "https://phx12", 5, 5)])
+
+    def test_get_node_id(self):
+        nodeid = self.backend.get_node_id("sync-1.0", "https://phx12")
+        self.assertEqual(
+            self.backend.shards[1].get_node_id("sync-1.0", "https://phx12"),
+            nodeid)
+        self.assertRaises(ValueError, self.backend.get_node_id,
+                          "sync-1.0", "https://phx13")
+        # A node added behind our back can get a different id on each.
+        self.backend.shards[1].add_node("sync-1.0", "https://phx13", 10)
+        self.backend.add_node("sync-1.0", "https://phx14", 10)
+        self.assertRaises(BackendError, self.backend.get_node_id,
+                          "sync-1.0", "https://phx14")
+
+    def test_get_migration_percent(self):
+        self.assertEqual(self.backend.get_migration_percent(), 0)
+
+    def test_batched_unassign_node_reports_global_uids(self):
+        users = [self.backend.allocate_user("sync-1.0", email)
+                 for email in self.emails[0][:2] + self.emails[1][:2]]
+        reported = []
+        self.backend.unassign_node(
+            "sync-1.0", "https://phx12", batch_size=10,
+            progress=lambda last_uid, count: reported.append(last_uid))
+        self.assertEqual(sorted(reported),
+                         sorted([users[1]["uid"], users[3]["uid"]]))
+        # There's no one uid from which every shard could be resumed.
+        self.assertRaises(ValueError, self.backend.unassign_node,
+                          "sync-1.0", "https://phx12", batch_size=10,
+                          start_uid=reported[0])
+
 
 if os.environ.get('MOZSVC_MYSQLURI', None) is not None:
     class TestMySQLDB(TestSQLDB):
@@ -115,3 +115,67 @@ class TestLocalBrowserIdVerifier(unittest.TestCase):
                                        issuer="mockmyid.co")
             with self.assertRaises(browserid.errors.InvalidIssuerError):
                 verifier.verify(assertion)
+
+    def test_verifier_caches_successful_results(self):
+        config = self._make_config({  # noqa; indentation below is non-standard
+            "browserid.audiences":
+                "https://testmytoken.com",
+        })
+        with patched_supportdoc_fetching():
+            verifier = config.registry.getUtility(IBrowserIdVerifier)
+            calls = []
+            orig_verify_chain = verifier.verify_certificate_chain
+
+            def counting_verify_chain(*args, **kwds):
+                calls.append(args)
+                return orig_verify_chain(*args, **kwds)
+
+            verifier.verify_certificate_chain = counting_verify_chain
+            valid = make_assertion(email="test@example.com",
+                                   audience="https://testmytoken.com")
+            for _ in xrange(2):
+                self.assertEquals(verifier.verify(valid)["email"],
+                                  "test@example.com")
+            self.assertEquals(len(calls), 1)
+            # Expired assertions are never served from the cache.
+            expired = make_assertion(email="test@example.com",
+                                     audience="https://testmytoken.com",
+                                     exp=1)
+            for _ in xrange(2):
+                with self.assertRaises(browserid.errors.ExpiredSignatureError):
+                    verifier.verify(expired)
+            # Cached results are still checked against the allowed issuers.
+            verifier.allowed_issuers = ["accounts.firefox.com"]
+            with self.assertRaises(browserid.errors.InvalidIssuerError):
+                verifier.verify(valid)
+            self.assertEquals(len(calls), 1)
+
+    def test_verifier_prescreens_obviously_bad_assertions(self):
+        config = self._make_config({  # noqa; indentation below is non-standard
+            "browserid.audiences":
+                "https://testmytoken.com",
+            "browserid.allowed_issuers":
+                "login.persona.org",
+        })
+        verifier = config.registry.getUtility(IBrowserIdVerifier)
+        verifier.prescreen(make_assertion(email="test@example.com",
+                                          audience="https://testmytoken.com"))
+        with self.assertRaises(browserid.errors.InvalidSignatureError):
+            verifier.prescreen("not-an-assertion")
+        with self.assertRaises(browserid.errors.InvalidSignatureError):
+            verifier.prescreen("e30.eyJleHAiOjFlMzAsImlzcyI6MX0.x~"
+                               "e30.eyJleHAiOjFlMzB9.x")
+        with self.assertRaises(browserid.errors.ExpiredSignatureError):
+            verifier.prescreen(make_assertion(
+                email="test@example.com",
+                audience="https://testmytoken.com",
+                exp=1))
+        with self.assertRaises(browserid.errors.AudienceMismatchError):
+            verifier.prescreen(make_assertion(
+                email="test@example.com",
+                audience="https://othertoken.com"))
+        with self.assertRaises(browserid.errors.InvalidIssuerError):
+            verifier.prescreen(make_assertion(
+                email="test@example.com",
+                audience="https://testmytoken.com",
+                issuer="accounts.firefox.com"))
@@ -45,3 +45,21 @@ class TestFixedBackend(unittest.TestCase):
         user = self.backend.get_user(DEFAULT_EMAIL, DEFAULT_SERVICE)
         self.assertEquals(user['uid'], 1)
         self.assertEquals(user['node'], DEFAULT_NODE)
+
+    def test_allocate_users(self):
+        self.backend.allocate_user(DEFAULT_SERVICE, DEFAULT_EMAIL)
+        users = self.backend.allocate_users(
+            DEFAULT_SERVICE, [DEFAULT_EMAIL, "rfkelly@mozilla.com"])
+        self.assertEquals(len(users), 1)
+        self.assertEquals(users[0]['uid'], 2)
+        self.assertEquals(users[0]['node'], DEFAULT_NODE)
+
+    def test_get_or_create_user(self):
+        user = self.backend.get_or_create_user(DEFAULT_SERVICE, DEFAULT_EMAIL,
+                                               generation=42)
+        self.assertEquals(user['uid'], 1)
+        self.assertEquals(user['generation'], 42)
+
+        user = self.backend.get_or_create_user(DEFAULT_SERVICE, DEFAULT_EMAIL)
+        self.assertEquals(user['uid'], 1)
+        self.assertEquals(user['generation'], 42)
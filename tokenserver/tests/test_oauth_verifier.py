@@ -2,23 +2,36 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import json
+import time
+import base64
 import socket
 import unittest
 import responses
 import contextlib
+import threading
+
+import jwt
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
 
 from pyramid.config import Configurator
+from pyramid.testing import DummyRequest
 
 from tokenserver.verifiers import (
+    CircuitOpenError,
     IOAuthVerifier,
     ConnectionError,
     RemoteOAuthVerifier,
+    JWKS_MIN_REFETCH_INTERVAL,
 )
 
 import fxa.errors
 
 
 MOCK_TOKEN = 'token'
+JWKS_URL = 'https://oauth.accounts.firefox.com/v1/jwks'
+VERIFY_URL = 'https://oauth.accounts.firefox.com/v1/verify'
 
 
 class TestRemoteOAuthVerifier(unittest.TestCase):
@@ -43,8 +56,10 @@ class TestRemoteOAuthVerifier(unittest.TestCase):
         return config
 
     @contextlib.contextmanager
-    def _mock_verifier(self, verifier, response=None, exc=None):
+    def _mock_verifier(self, verifier, response=None, exc=None, calls=None):
         def replacement_verify_token_method(*args, **kwds):
+            if calls is not None:
+                calls.append(args)
             if exc is not None:
                 raise exc
             if response is not None:
@@ -220,3 +235,307 @@ class TestRemoteOAuthVerifier(unittest.TestCase):
                 response={"user": "UID", "generation": generation}):
             self.assertEquals(verifier.verify(MOCK_TOKEN)['idpClaims'].get(
                 'fxa-generation'), generation)
+
+    def _make_jwt(self, **claims):
+        payload = base64.urlsafe_b64encode(json.dumps(claims)).rstrip('=')
+        return 'eyJhbGciOiJSUzI1NiJ9.%s.c2lnbmF0dXJl' % (payload,)
+
+    def test_verifier_caches_successful_results(self):
+        config = self._make_config()
+        verifier = config.registry.getUtility(IOAuthVerifier)
+        request = DummyRequest()
+        request.metrics = {}
+        config.begin(request)
+        calls = []
+        try:
+            with self._mock_verifier(verifier, response={"user": "UID"},
+                                     calls=calls):
+                result = verifier.verify(MOCK_TOKEN)
+                result["idpClaims"]["fxa-generation"] = 12
+                self.assertEquals(verifier.verify(MOCK_TOKEN)["idpClaims"],
+                                  {})
+                verifier.verify("other-token")
+        finally:
+            config.end()
+        self.assertEquals(len(calls), 2)
+        self.assertEquals(request.metrics["tokenserver.oauth.cache.hit"], 1)
+        self.assertEquals(request.metrics["tokenserver.oauth.cache.miss"], 2)
+        self.assertTrue("tokenserver.oauth.cache.time_saved" in
+                        request.metrics)
+        # Only a hash of the token is kept.
+        self.assertFalse(MOCK_TOKEN in verifier._cache._cache.data)
+
+    def test_verifier_does_not_cache_failures(self):
+        config = self._make_config()
+        verifier = config.registry.getUtility(IOAuthVerifier)
+        calls = []
+        err = fxa.errors.TrustError()
+        with self._mock_verifier(verifier, exc=err, calls=calls):
+            for _ in xrange(2):
+                with self.assertRaises(fxa.errors.TrustError):
+                    verifier.verify(MOCK_TOKEN)
+        self.assertEquals(len(calls), 2)
+
+    def test_verifier_cache_entries_expire_with_the_token(self):
+        config = self._make_config()
+        verifier = config.registry.getUtility(IOAuthVerifier)
+        calls = []
+        expired = self._make_jwt(exp=int(time.time()) - 1)
+        unexpired = self._make_jwt(exp=int(time.time()) + 60)
+        with self._mock_verifier(verifier, response={"user": "UID"},
+                                 calls=calls):
+            for _ in xrange(2):
+                verifier.verify(expired)
+                verifier.verify(unexpired)
+        self.assertEquals(len(calls), 3)
+
+    def test_verifier_cache_can_be_disabled(self):
+        config = self._make_config({
+            "oauth.cache_size": "0",
+        })
+        verifier = config.registry.getUtility(IOAuthVerifier)
+        calls = []
+        with self._mock_verifier(verifier, response={"user": "UID"},
+                                 calls=calls):
+            verifier.verify(MOCK_TOKEN)
+            verifier.verify(MOCK_TOKEN)
+        self.assertEquals(len(calls), 2)
+
+    def test_verifier_prescreens_obviously_bad_tokens(self):
+        config = self._make_config()
+        verifier = config.registry.getUtility(IOAuthVerifier)
+        scope = verifier.scope
+        verifier.prescreen(MOCK_TOKEN)
+        verifier.prescreen(self._make_jwt(exp=int(time.time()) + 60,
+                                          scope="profile " + scope))
+        with self.assertRaises(fxa.errors.TrustError):
+            verifier.prescreen('eyJhbGciOiJSUzI1NiJ9.bm9wZQ.c2lnbmF0dXJl')
+        with self.assertRaises(fxa.errors.TrustError):
+            verifier.prescreen(self._make_jwt(exp=int(time.time()) - 1,
+                                              scope=scope))
+        with self.assertRaises(fxa.errors.ScopeMismatchError):
+            verifier.prescreen(self._make_jwt(exp=int(time.time()) + 60,
+                                              scope="profile"))
+
+    def test_verifier_uses_connection_pool_and_timeouts(self):
+        config = self._make_config({
+            "oauth.pool_size": "25",
+            "oauth.connect_timeout": "2",
+            "oauth.timeout": "10",
+        })
+        verifier = config.registry.getUtility(IOAuthVerifier)
+        apiclient = verifier._client.apiclient
+        self.assertEquals(apiclient.server_url, verifier.server_url)
+        self.assertEquals(apiclient.timeout, (2, 10))
+        adapter = apiclient._session.get_adapter(verifier.server_url)
+        self.assertEquals(adapter._pool_maxsize, 25)
+
+    def test_verifier_circuit_breaker_opens_and_recovers(self):
+        config = self._make_config({
+            "oauth.cache_size": "0",
+            "oauth.circuit_window": "4",
+            "oauth.circuit_reset_timeout": "60",
+        })
+        verifier = config.registry.getUtility(IOAuthVerifier)
+        calls = []
+        # Rejected tokens don't count as failures.
+        err = fxa.errors.ClientError({"errno": 108, "code": 401})
+        with self._mock_verifier(verifier, exc=err, calls=calls):
+            for _ in xrange(4):
+                with self.assertRaises(fxa.errors.ClientError):
+                    verifier.verify(MOCK_TOKEN)
+        self.assertFalse(verifier._breaker.is_open)
+        # But network and server errors do.
+        with self._mock_verifier(verifier, exc=socket.error, calls=calls):
+            with self.assertRaises(ConnectionError):
+                verifier.verify(MOCK_TOKEN)
+        err = fxa.errors.ServerError({"code": 500})
+        with self._mock_verifier(verifier, exc=err, calls=calls):
+            with self.assertRaises(fxa.errors.ServerError):
+                verifier.verify(MOCK_TOKEN)
+            self.assertTrue(verifier._breaker.is_open)
+            self.assertEquals(len(calls), 6)
+            # Once it's open, calls fail without reaching the server.
+            with self.assertRaises(CircuitOpenError):
+                verifier.verify(MOCK_TOKEN)
+            self.assertEquals(len(calls), 6)
+        # After the timeout, a successful probe closes it again.
+        verifier._breaker._opened_at -= 60
+        with self._mock_verifier(verifier, response={"user": "UID"},
+                                 calls=calls):
+            verifier.verify(MOCK_TOKEN)
+            self.assertFalse(verifier._breaker.is_open)
+            verifier.verify(MOCK_TOKEN)
+        self.assertEquals(len(calls), 8)
+
+    def test_verifier_circuit_breaker_covers_jwts_without_local_keys(self):
+        config = self._make_config({
+            "oauth.cache_size": "0",
+            "oauth.circuit_window": "2",
+        })
+        verifier = config.registry.getUtility(IOAuthVerifier)
+        # With no keys of its own, the client fetches them from the server
+        # to verify a JWT, so that can fail like any other request.
+        token = self._make_jwt(exp=int(time.time()) + 60,
+                               scope=verifier.scope)
+        calls = []
+        with self._mock_verifier(verifier, exc=socket.error, calls=calls):
+            for _ in xrange(2):
+                with self.assertRaises(ConnectionError):
+                    verifier.verify(token)
+            self.assertTrue(verifier._breaker.is_open)
+            with self.assertRaises(CircuitOpenError):
+                verifier.verify(token)
+        self.assertEquals(len(calls), 2)
+
+    def test_verifier_circuit_breaker_survives_interrupted_probe(self):
+        config = self._make_config({
+            "oauth.cache_size": "0",
+            "oauth.circuit_reset_timeout": "60",
+        })
+        verifier = config.registry.getUtility(IOAuthVerifier)
+        verifier._breaker._opened_at = time.time() - 60
+
+        class Interrupted(BaseException):
+            pass
+
+        with self._mock_verifier(verifier, exc=Interrupted()):
+            with self.assertRaises(Interrupted):
+                verifier.verify(MOCK_TOKEN)
+        self.assertTrue(verifier._breaker.is_open)
+        # The next call is let through as a probe, rather than the
+        # circuit being stuck open waiting for the first one.
+        with self._mock_verifier(verifier, response={"user": "UID"}):
+            verifier.verify(MOCK_TOKEN)
+        self.assertFalse(verifier._breaker.is_open)
+
+
+class TestRemoteOAuthVerifierWithJWKS(unittest.TestCase):
+
+    def setUp(self):
+        self.keys = {}
+        self.published_kids = []
+        self.verifier = RemoteOAuthVerifier(jwks_ttl=3600)
+        self.request = DummyRequest()
+        self.request.metrics = {}
+        self.config = Configurator()
+        self.config.begin(self.request)
+
+    def tearDown(self):
+        self.config.end()
+
+    def _add_key(self, kid, publish=True):
+        self.keys[kid] = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048, backend=default_backend())
+        if publish:
+            self.published_kids.append(kid)
+
+    def _stub_jwks(self):
+        def get_jwks(request):
+            keys = []
+            for kid in self.published_kids:
+                key = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(
+                    self.keys[kid].public_key()))
+                key['kid'] = kid
+                keys.append(key)
+            return (200, {}, json.dumps({'keys': keys}))
+        responses.add_callback(responses.GET, JWKS_URL, callback=get_jwks,
+                               content_type='application/json')
+
+    def _make_token(self, kid, user='UID'):
+        claims = {
+            'sub': user,
+            'client_id': 'abcdef',
+            'scope': self.verifier.scope,
+            'exp': int(time.time()) + 60,
+        }
+        return jwt.encode(claims, self.keys[kid], algorithm='RS256',
+                          headers={'kid': kid, 'typ': 'at+jwt'})
+
+    def _count_calls(self, url):
+        return len([call for call in responses.calls
+                    if call.request.url == url])
+
+    @responses.activate
+    def test_jwt_tokens_are_verified_locally(self):
+        self._add_key('k1')
+        self._stub_jwks()
+        for user in ('UID1', 'UID2'):
+            result = self.verifier.verify(self._make_token('k1', user))
+            self.assertEquals(result['email'],
+                              user + '@api.accounts.firefox.com')
+        self.assertEquals(self._count_calls(JWKS_URL), 1)
+        self.assertEquals(self._count_calls(VERIFY_URL), 0)
+        self.assertEquals(
+            self.request.metrics['tokenserver.oauth.verify_local'], 2)
+        self.assertEquals(
+            self.request.metrics['tokenserver.oauth.jwks.fetch'], 1)
+
+    @responses.activate
+    def test_jwt_tokens_are_verified_remotely_without_cached_keys(self):
+        self.verifier = RemoteOAuthVerifier(cache_size=0)
+        self._add_key('k1')
+        self._stub_jwks()
+        for _ in xrange(2):
+            self.verifier.verify(self._make_token('k1'))
+        self.assertEquals(self._count_calls(JWKS_URL), 2)
+        self.assertEquals(
+            self.request.metrics['tokenserver.oauth.verify_remote'], 2)
+        self.assertNotIn('tokenserver.oauth.verify_local',
+                         self.request.metrics)
+
+    @responses.activate
+    def test_opaque_tokens_are_verified_remotely(self):
+        responses.add(responses.POST, VERIFY_URL, json={
+            'user': 'UID',
+            'client_id': 'abcdef',
+            'scope': [self.verifier.scope],
+        })
+        result = self.verifier.verify(MOCK_TOKEN)
+        self.assertEquals(result['email'], 'UID@api.accounts.firefox.com')
+        self.assertEquals(self._count_calls(JWKS_URL), 0)
+        self.assertEquals(
+            self.request.metrics['tokenserver.oauth.verify_remote'], 1)
+
+    @responses.activate
+    def test_unknown_key_prompts_refetch(self):
+        self._add_key('k1')
+        self._stub_jwks()
+        self.verifier.verify(self._make_token('k1'))
+        # The keys are rotated, some time later.
+        self._add_key('k2')
+        self.verifier._jwks._fetched_at -= JWKS_MIN_REFETCH_INTERVAL
+        result = self.verifier.verify(self._make_token('k2'))
+        self.assertEquals(result['email'], 'UID@api.accounts.firefox.com')
+        self.assertEquals(self._count_calls(JWKS_URL), 2)
+        # But a flood of unknown keys doesn't mean a flood of fetches.
+        self._add_key('k3', publish=False)
+        with self.assertRaises(fxa.errors.TrustError):
+            self.verifier.verify(self._make_token('k3'))
+        self.assertEquals(self._count_calls(JWKS_URL), 2)
+
+    @responses.activate
+    def test_stale_keys_are_refreshed_in_the_background(self):
+        self.verifier = RemoteOAuthVerifier(jwks_ttl=0.01, cache_size=0)
+        self._add_key('k1')
+        self._stub_jwks()
+        token = self._make_token('k1')
+        self.verifier.verify(token)
+        time.sleep(0.02)
+        threads = set(threading.enumerate())
+        self.verifier.verify(token)
+        for thread in set(threading.enumerate()) - threads:
+            thread.join()
+        self.assertEquals(self._count_calls(JWKS_URL), 2)
+
+    @responses.activate
+    def test_local_verification_bypasses_open_circuit(self):
+        self._add_key('k1')
+        self._stub_jwks()
+        self.verifier.verify(self._make_token('k1'))
+        self.verifier._breaker._opened_at = time.time()
+        result = self.verifier.verify(self._make_token('k1', user='OTHER'))
+        self.assertEquals(result['email'], 'OTHER@api.accounts.firefox.com')
+        with self.assertRaises(CircuitOpenError):
+            self.verifier.verify(MOCK_TOKEN)
+        self.assertEquals(len(responses.calls), 1)
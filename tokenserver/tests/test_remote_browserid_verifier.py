@@ -3,12 +3,17 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import json
+import time
 import contextlib
 import unittest
 
 from pyramid.config import Configurator
 
-from tokenserver.verifiers import RemoteBrowserIdVerifier, IBrowserIdVerifier
+from tokenserver.verifiers import (
+    CircuitOpenError,
+    RemoteBrowserIdVerifier,
+    IBrowserIdVerifier
+)
 from browserid.tests.support import make_assertion
 import browserid.errors
 
@@ -41,8 +46,11 @@ class TestRemoteBrowserIdVerifier(unittest.TestCase):
         return config
 
     @contextlib.contextmanager
-    def _mock_verifier(self, verifier, exc=None, **response_attrs):
+    def _mock_verifier(self, verifier, exc=None, calls=None,
+                       **response_attrs):
         def replacement_post_method(*args, **kwds):
+            if calls is not None:
+                calls.append(kwds)
             if exc is not None:
                 raise exc
             response = mockobj()
@@ -115,6 +123,8 @@ class TestRemoteBrowserIdVerifier(unittest.TestCase):
                 "https://testmytoken.com",
             "browserid.allowed_issuers":
                 "accounts.firefox.com mockmyid.com",
+            # Re-use the same assertion with different verifier responses.
+            "browserid.cache_size": "0",
         })
         verifier = config.registry.getUtility(IBrowserIdVerifier)
         assertion = make_assertion(email="test@example.com",
@@ -162,3 +172,214 @@ class TestRemoteBrowserIdVerifier(unittest.TestCase):
         with self._mock_verifier(verifier, text=json.dumps(mock_response)):
             with self.assertRaises(browserid.errors.InvalidIssuerError):
                 verifier.verify(assertion)
+
+    def test_verifier_caches_successful_results(self):
+        config = self._make_config({  # noqa; indentation below is non-standard
+            "browserid.audiences":
+                "https://testmytoken.com",
+        })
+        verifier = config.registry.getUtility(IBrowserIdVerifier)
+        assertion = make_assertion(email="test@example.com",
+                                   audience="https://testmytoken.com")
+        mock_response = {
+            "status": "okay",
+            "email": "test@example.com",
+            "audience": "https://testmytoken.com",
+            "issuer": "login.persona.org",
+        }
+        calls = []
+        with self._mock_verifier(verifier, calls=calls,
+                                 text=json.dumps(mock_response)):
+            self.assertEquals(verifier.verify(assertion)["email"],
+                              "test@example.com")
+            self.assertEquals(verifier.verify(assertion)["email"],
+                              "test@example.com")
+            # The result depends on the audience too.
+            verifier.verify(assertion, "https://othertoken.com")
+            self.assertEquals(len(calls), 2)
+            # And the allowed issuers are still checked for cached results.
+            verifier.allowed_issuers = ["accounts.firefox.com"]
+            with self.assertRaises(browserid.errors.InvalidIssuerError):
+                verifier.verify(assertion)
+            self.assertEquals(len(calls), 2)
+        with self._mock_verifier(verifier, calls=calls,
+                                 text='{"status": "error"}'):
+            for _ in xrange(2):
+                with self.assertRaises(browserid.errors.InvalidSignatureError):
+                    verifier.verify(make_assertion(
+                        email="other@example.com",
+                        audience="https://testmytoken.com"))
+        self.assertEquals(len(calls), 4)
+
+    def test_verifier_cache_entries_expire_with_the_assertion(self):
+        config = self._make_config({  # noqa; indentation below is non-standard
+            "browserid.audiences":
+                "https://testmytoken.com",
+        })
+        verifier = config.registry.getUtility(IBrowserIdVerifier)
+        assertion = make_assertion(email="test@example.com",
+                                   audience="https://testmytoken.com",
+                                   exp=int((time.time() - 1) * 1000))
+        mock_response = {
+            "status": "okay",
+            "email": "test@example.com",
+            "audience": "https://testmytoken.com",
+            "issuer": "login.persona.org",
+        }
+        calls = []
+        with self._mock_verifier(verifier, calls=calls,
+                                 text=json.dumps(mock_response)):
+            verifier.verify(assertion)
+            verifier.verify(assertion)
+        self.assertEquals(len(calls), 2)
+
+    def test_verifier_uses_connection_pool_and_timeouts(self):
+        config = self._make_config({  # noqa; indentation below is non-standard
+            "browserid.audiences":
+                "https://testmytoken.com",
+            "browserid.pool_size": "25",
+            "browserid.connect_timeout": "2",
+            "browserid.timeout": "10",
+        })
+        verifier = config.registry.getUtility(IBrowserIdVerifier)
+        adapter = verifier.session.get_adapter(verifier.verifier_url)
+        self.assertEquals(adapter._pool_maxsize, 25)
+        calls = []
+        with self._mock_verifier(verifier, calls=calls,
+                                 text='{"status": "error"}'):
+            with self.assertRaises(browserid.errors.InvalidSignatureError):
+                verifier.verify(make_assertion(
+                    email="test@example.com",
+                    audience="https://testmytoken.com"))
+        self.assertEquals(calls[0]["timeout"], (2, 10))
+
+    def test_verifier_circuit_breaker_opens_and_recovers(self):
+        config = self._make_config({  # noqa; indentation below is non-standard
+            "browserid.audiences":
+                "https://testmytoken.com",
+            "browserid.cache_size": "0",
+            "browserid.circuit_window": "4",
+            "browserid.circuit_failure_rate": "0.5",
+            "browserid.circuit_reset_timeout": "60",
+        })
+        verifier = config.registry.getUtility(IBrowserIdVerifier)
+        assertion = make_assertion(email="test@example.com",
+                                   audience="https://testmytoken.com")
+        mock_response = {
+            "status": "okay",
+            "email": "test@example.com",
+            "audience": "https://testmytoken.com",
+            "issuer": "login.persona.org",
+        }
+        calls = []
+        # Rejected assertions don't count as failures.
+        with self._mock_verifier(verifier, calls=calls,
+                                 text='{"status": "error"}'):
+            for _ in xrange(4):
+                with self.assertRaises(browserid.errors.InvalidSignatureError):
+                    verifier.verify(assertion)
+        self.assertFalse(verifier._breaker.is_open)
+        # But errors from the verifier do.
+        with self._mock_verifier(verifier, calls=calls, status_code=500):
+            for _ in xrange(2):
+                with self.assertRaises(browserid.errors.ConnectionError):
+                    verifier.verify(assertion)
+            self.assertTrue(verifier._breaker.is_open)
+            self.assertEquals(len(calls), 6)
+            # Once it's open, calls fail without reaching the verifier.
+            with self.assertRaises(CircuitOpenError):
+                verifier.verify(assertion)
+            self.assertEquals(len(calls), 6)
+            # After the timeout, a failed probe keeps it open.
+            verifier._breaker._opened_at -= 60
+            with self.assertRaises(browserid.errors.ConnectionError):
+                verifier.verify(assertion)
+            self.assertEquals(len(calls), 7)
+            with self.assertRaises(CircuitOpenError):
+                verifier.verify(assertion)
+            self.assertEquals(len(calls), 7)
+        # And a successful one closes it again.
+        verifier._breaker._opened_at -= 60
+        with self._mock_verifier(verifier, calls=calls,
+                                 text=json.dumps(mock_response)):
+            verifier.verify(assertion)
+            self.assertFalse(verifier._breaker.is_open)
+            verifier.verify(assertion)
+        self.assertEquals(len(calls), 9)
+
+    def test_verifier_circuit_breaker_counts_slow_calls(self):
+        config = self._make_config({  # noqa; indentation below is non-standard
+            "browserid.audiences":
+                "https://testmytoken.com",
+            "browserid.cache_size": "0",
+            "browserid.circuit_window": "2",
+            "browserid.circuit_slow_call_time": "0.01",
+        })
+        verifier = config.registry.getUtility(IBrowserIdVerifier)
+        assertion = make_assertion(email="test@example.com",
+                                   audience="https://testmytoken.com")
+        calls = []
+        with self._mock_verifier(verifier, calls=calls,
+                                 text='{"status": "error"}'):
+            with self.assertRaises(browserid.errors.InvalidSignatureError):
+                verifier.verify(assertion)
+            self.assertFalse(verifier._breaker.is_open)
+            orig_post_method = verifier.session.post
+
+            def slow_post_method(*args, **kwds):
+                time.sleep(0.02)
+                return orig_post_method(*args, **kwds)
+            verifier.session.post = slow_post_method
+            with self.assertRaises(browserid.errors.InvalidSignatureError):
+                verifier.verify(assertion)
+            verifier.session.post = orig_post_method
+        self.assertTrue(verifier._breaker.is_open)
+
+    def test_verifier_circuit_breaker_can_be_disabled(self):
+        config = self._make_config({  # noqa; indentation below is non-standard
+            "browserid.audiences":
+                "https://testmytoken.com",
+            "browserid.circuit_window": "0",
+        })
+        verifier = config.registry.getUtility(IBrowserIdVerifier)
+        self.assertEquals(verifier._breaker, None)
+        assertion = make_assertion(email="test@example.com",
+                                   audience="https://testmytoken.com")
+        with self._mock_verifier(verifier, status_code=500):
+            for _ in xrange(30):
+                with self.assertRaises(browserid.errors.ConnectionError):
+                    verifier.verify(assertion)
+
+    def test_verifier_prescreens_obviously_bad_assertions(self):
+        config = self._make_config({  # noqa; indentation below is non-standard
+            "browserid.audiences":
+                "https://testmytoken.com",
+            "browserid.allowed_issuers":
+                "login.persona.org",
+        })
+        verifier = config.registry.getUtility(IBrowserIdVerifier)
+        verifier.prescreen(make_assertion(email="test@example.com",
+                                          audience="https://testmytoken.com"))
+        # Equivalent origins are left for the verifier to decide on.
+        verifier.prescreen(make_assertion(
+            email="test@example.com",
+            audience="https://testmytoken.com:443"))
+        with self.assertRaises(browserid.errors.InvalidSignatureError):
+            verifier.prescreen("not-an-assertion")
+        with self.assertRaises(browserid.errors.InvalidSignatureError):
+            verifier.prescreen("e30.eyJleHAiOjFlMzAsImlzcyI6MX0.x~"
+                               "e30.eyJleHAiOjFlMzB9.x")
+        with self.assertRaises(browserid.errors.ExpiredSignatureError):
+            verifier.prescreen(make_assertion(
+                email="test@example.com",
+                audience="https://testmytoken.com",
+                exp=1))
+        with self.assertRaises(browserid.errors.AudienceMismatchError):
+            verifier.prescreen(make_assertion(
+                email="test@example.com",
+                audience="http://testmytoken.com"))
+        with self.assertRaises(browserid.errors.InvalidIssuerError):
+            verifier.prescreen(make_assertion(
+                email="test@example.com",
+                audience="https://testmytoken.com",
+                issuer="accounts.firefox.com"))
@@ -1,6 +1,7 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
+import base64
 import contextlib
 import json
 import os
@@ -17,6 +18,7 @@ from mozsvc.plugin import load_and_register
 import tokenserver.views
 from tokenserver.assignment import INodeAssignment
 from tokenserver.verifiers import (
+    CircuitOpenError,
     get_browserid_verifier,
     get_oauth_verifier
 )
@@ -216,6 +218,17 @@ class TestService(unittest.TestCase):
         res = self.app.get('/__lbheartbeat__')
         self.assertEqual(res.json, {})
 
+    def test_pool_status(self):
+        # The endpoint is disabled by default.
+        self.app.get('/__pool__', status=404)
+        settings = self.config.registry.settings
+        settings['tokenserver.pool_status_endpoint'] = True
+        status = {'primary': {'class': 'QueuePool', 'in_use': 1}}
+        with mock.patch.object(self.backend, 'get_pool_status',
+                               return_value=status, create=True):
+            res = self.app.get('/__pool__')
+        self.assertEqual(res.json, {'pid': os.getpid(), 'pools': status})
+
     def test_unauthorized_error_status(self):
         # Totally busted auth -> generic error.
         headers = {'Authorization': 'Unsupported-Auth-Scheme IHACKYOU'}
@@ -252,6 +265,12 @@ class TestService(unittest.TestCase):
         self.assertMetricWasLogged('token.assertion.connection_error')
         self.assertExceptionWasLogged('Unexpected verification error')
         self.clearLogs()
+        # Open circuit -> 503, without a traceback
+        with self.mock_browserid_verifier(exc=CircuitOpenError):
+            res = self.app.get('/1.0/sync/1.1', headers=headers, status=503)
+        self.assertMetricWasLogged('token.assertion.circuit_open_error')
+        self.assertMessageWasNotLogged('Unexpected verification error')
+        self.clearLogs()
         # Some other wacky error -> not captured
         with self.mock_browserid_verifier(exc=ValueError):
             with self.assertRaises(ValueError):
@@ -280,11 +299,58 @@ class TestService(unittest.TestCase):
         self.assertMetricWasLogged('token.oauth.connection_error')
         self.assertExceptionWasLogged('Unexpected verification error')
         self.clearLogs()
+        # Open circuit -> 503, without a traceback
+        with self.mock_oauth_verifier(exc=CircuitOpenError):
+            res = self.app.get('/1.0/sync/1.1', headers=headers, status=503)
+        self.assertMetricWasLogged('token.oauth.connection_error')
+        self.assertMetricWasLogged('token.oauth.circuit_open_error')
+        self.assertMessageWasNotLogged('Unexpected verification error')
+        self.clearLogs()
         # Some other wacky error -> not captured
         with self.mock_oauth_verifier(exc=ValueError):
             with self.assertRaises(ValueError):
                 res = self.app.get('/1.0/sync/1.1', headers=headers)
 
+    def test_obviously_bad_credentials_are_rejected_without_verifying(self):
+        # The verifiers would fail the test if they were called.
+        never = AssertionError("verifier should not be called")
+        # Expired assertion -> "invalid-timestamp"
+        assertion = self._getassertion(exp=1)
+        headers = {'Authorization': 'BrowserID %s' % assertion}
+        with self.mock_browserid_verifier(exc=never):
+            res = self.app.get('/1.0/sync/1.1', headers=headers, status=401)
+        self.assertEqual(res.json['status'], 'invalid-timestamp')
+        self.assertMetricWasLogged('token.assertion.prescreen_failure')
+        self.assertMetricWasLogged('token.assertion.expired_signature_error')
+        self.clearLogs()
+        # Wrong audience -> "invalid-credentials"
+        assertion = self._getassertion(audience='http://evil.com')
+        headers = {'Authorization': 'BrowserID %s' % assertion}
+        with self.mock_browserid_verifier(exc=never):
+            res = self.app.get('/1.0/sync/1.1', headers=headers, status=401)
+        self.assertEqual(res.json['status'], 'invalid-credentials')
+        self.assertMetricWasLogged('token.assertion.prescreen_failure')
+        self.assertMetricWasLogged('token.assertion.audience_mismatch_error')
+        self.clearLogs()
+        # Malformed assertion -> "invalid-credentials"
+        headers = {'Authorization': 'BrowserID garbage'}
+        with self.mock_browserid_verifier(exc=never):
+            res = self.app.get('/1.0/sync/1.1', headers=headers, status=401)
+        self.assertEqual(res.json['status'], 'invalid-credentials')
+        self.assertMetricWasLogged('token.assertion.prescreen_failure')
+        self.assertMessageWasNotLogged('Unexpected verification error')
+        self.clearLogs()
+        # Expired OAuth token -> "invalid-credentials"
+        claims = json.dumps({'exp': 1, 'sub': 'test1'})
+        token = 'eyJhbGciOiJSUzI1NiJ9.%s.c2lnbmF0dXJl' % (
+            base64.urlsafe_b64encode(claims).rstrip('='),)
+        headers = {'Authorization': 'Bearer %s' % token}
+        with self.mock_oauth_verifier(exc=never):
+            res = self.app.get('/1.0/sync/1.1', headers=headers, status=401)
+        self.assertEqual(res.json['status'], 'invalid-credentials')
+        self.assertMetricWasLogged('token.oauth.prescreen_failure')
+        self.assertMessageWasNotLogged('Unexpected verification error')
+
     def test_unverified_token(self):
         headers = {'Authorization': 'BrowserID %s' % self._getassertion()}
         # Assertion should not be rejected if fxa-tokenVerified is unset
@@ -747,6 +813,13 @@ class TestService(unittest.TestCase):
         self.assertMetricWasLogged('metrics_uid')
         self.assertMetricWasLogged('metrics_device_id')
 
+    def test_backend_timings_are_logged(self):
+        assertion = self._getassertion(email="newuser3@test.com")
+        headers = {'Authorization': 'BrowserID %s' % assertion}
+        self.app.get('/1.0/sync/1.1', headers=headers, status=200)
+        self.assertMetricWasLogged('tokenserver.backend.get_user')
+        self.assertMetricWasLogged('tokenserver.backend.allocate_user')
+
     def test_uid_and_kid_from_browserid_assertion(self):
         assertion = self._getassertion(email="testuser@example.com")
         headers_browserid = {
@@ -1,5 +1,12 @@
+import copy
 import json
+import time
+import base64
+import hashlib
+import logging
 import warnings
+import threading
+import collections
 
 from pyramid.threadlocal import get_current_registry
 from zope.interface import implements, Interface
@@ -8,20 +15,30 @@ from zope.interface.interfaces import ComponentLookupError # noqa; for re-export
 import socket
 import requests
 import urlparse
+from mozsvc.metrics import annotate_request
+from repoze.lru import ExpiringLRUCache
 
 import browserid.verifiers.local
 from browserid.errors import (InvalidSignatureError, ExpiredSignatureError,
                               ConnectionError, AudienceMismatchError,
                               InvalidIssuerError)
 from browserid.supportdoc import SupportDocumentManager
+from browserid.utils import unbundle_certs_and_assertion, decode_json_bytes
 
 import fxa.oauth
 import fxa.errors
 import fxa.constants
+from fxa._utils import APIClient, scope_matches
 
 
 DEFAULT_OAUTH_SCOPE = 'https://identity.mozilla.com/apps/oldsync'
 
+# The minimum number of seconds between fetches of the JWKS document that
+# are prompted by tokens signed with a key that we don't know about.
+JWKS_MIN_REFETCH_INTERVAL = 60
+
+logger = logging.getLogger("tokenserver.verifiers")
+
 
 def get_browserid_verifier(registry=None):
     """Returns the registered browserid verifier.
@@ -43,6 +60,341 @@ def get_oauth_verifier(registry=None):
     return registry.getUtility(IOAuthVerifier)
 
 
+class CircuitOpenError(ConnectionError):
+    """Raised instead of calling a remote service whose circuit is open."""
+
+
+class _CircuitBreaker(object):
+    """Stops calling a remote service while it's failing or slow.
+
+    The outcomes of the last `window` calls are kept, where a call fails if
+    it raises one of `failure_types` or takes more than `slow_call_time`
+    seconds.  If the proportion of them that failed reaches `failure_rate`,
+    the circuit opens, and calls fail straight away with CircuitOpenError.
+    After `reset_timeout` seconds a single probe call is let through; the
+    circuit closes again if it succeeds, or stays open for another
+    `reset_timeout` seconds if not.  Calls rejected while the circuit is
+    open, and each time it opens, are reported in the request metrics as
+    `<metrics_prefix>.circuit.{rejected,opened}`.
+    """
+
+    def __init__(self, name, failure_types, window=20, failure_rate=0.5,
+                 slow_call_time=None, reset_timeout=30,
+                 metrics_prefix=None):
+        self.name = name
+        self._failure_types = failure_types
+        self._outcomes = collections.deque(maxlen=window)
+        self._failure_rate = failure_rate
+        self._slow_call_time = slow_call_time
+        self._reset_timeout = reset_timeout
+        self._metrics_prefix = metrics_prefix
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def _annotate(self, name):
+        if self._metrics_prefix is not None:
+            annotate_request(None, self._metrics_prefix + '.circuit.' + name,
+                             1)
+
+    def call(self, func):
+        """Call `func` with no arguments, if the circuit allows it."""
+        with self._lock:
+            probe = False
+            if self._opened_at is not None:
+                if self._probing or \
+                        time.time() - self._opened_at < self._reset_timeout:
+                    self._annotate('rejected')
+                    raise CircuitOpenError("%s is unavailable" % (self.name,))
+                self._probing = probe = True
+        start = time.time()
+        ok = None
+        try:
+            result = func()
+            ok = not self._is_slow(start)
+        except self._failure_types:
+            ok = False
+            raise
+        except Exception:
+            # The service answered, even if it didn't like the request.
+            ok = not self._is_slow(start)
+            raise
+        finally:
+            if ok is not None:
+                self._record(ok, probe)
+            elif probe:
+                # The call was interrupted, e.g. by the greenlet being
+                # killed, so we learned nothing.  Let another probe through.
+                with self._lock:
+                    self._probing = False
+        return result
+
+    def _is_slow(self, start):
+        if self._slow_call_time is None:
+            return False
+        return time.time() - start > self._slow_call_time
+
+    def _record(self, ok, probe):
+        with self._lock:
+            if probe:
+                self._probing = False
+                if ok:
+                    logger.info("Circuit for %s closed", self.name)
+                    self._opened_at = None
+                    self._outcomes.clear()
+                else:
+                    self._opened_at = time.time()
+                return
+            if self._opened_at is not None:
+                # A call that started before the circuit opened.
+                return
+            self._outcomes.append(ok)
+            if len(self._outcomes) < self._outcomes.maxlen:
+                return
+            failures = self._outcomes.count(False)
+            if failures >= self._failure_rate * len(self._outcomes):
+                logger.warning("Circuit for %s opened after %d of %d calls "
+                               "failed", self.name, failures,
+                               len(self._outcomes))
+                self._opened_at = time.time()
+                self._annotate('opened')
+
+
+def _make_circuit_breaker(name, failure_types, metrics_prefix, window,
+                          failure_rate, slow_call_time, reset_timeout):
+    """Make a circuit breaker from config settings, or None if disabled."""
+    if int(window) <= 0:
+        return None
+    if slow_call_time is not None:
+        slow_call_time = float(slow_call_time)
+    return _CircuitBreaker(name, failure_types, int(window),
+                           float(failure_rate), slow_call_time,
+                           float(reset_timeout), metrics_prefix)
+
+
+def _make_session(pool_size):
+    """Make a requests session that keeps up to `pool_size` connections
+    open to each host."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=int(pool_size))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class _VerificationCache(object):
+    """A bounded in-memory cache of successful verification results.
+
+    Entries are keyed by a hash of the credential, so that the credential
+    itself is never kept, and expire after `ttl` seconds or at the expiry
+    time given for them, whichever is sooner.  Hits and misses are reported
+    in the request metrics under the given prefix, along with an estimate
+    of the time saved by each hit, based on the recent verification times.
+    """
+
+    def __init__(self, size, ttl, metrics_prefix):
+        self._cache = ExpiringLRUCache(size, ttl)
+        self._ttl = ttl
+        self._metrics_prefix = metrics_prefix
+        self._verify_time = None
+
+    def _annotate(self, name, value):
+        annotate_request(None, self._metrics_prefix + '.' + name, value)
+
+    def get_or_verify(self, credential, verify, expires_at=None):
+        """Get the cached result for a credential, or verify it.
+
+        The `credential` may be a tuple of strings, if the result depends
+        on more than one.  On a miss, `verify` is called to get the result,
+        which is cached if it succeeds.
+        """
+        if isinstance(credential, tuple):
+            credential = '\0'.join(credential)
+        if isinstance(credential, unicode):
+            credential = credential.encode('utf8')
+        key = hashlib.sha256(credential).hexdigest()
+        result = self._cache.get(key)
+        if result is not None:
+            self._annotate('hit', 1)
+            if self._verify_time is not None:
+                self._annotate('time_saved', self._verify_time)
+            return copy.deepcopy(result)
+        self._annotate('miss', 1)
+        start = time.time()
+        result = verify()
+        now = time.time()
+        if self._verify_time is None:
+            self._verify_time = now - start
+        else:
+            self._verify_time += 0.1 * (now - start - self._verify_time)
+        ttl = self._ttl
+        if expires_at is not None:
+            ttl = min(ttl, expires_at - now)
+        if ttl > 0:
+            self._cache.put(key, copy.deepcopy(result), timeout=ttl)
+        return result
+
+
+def _decode_jwt_segment(token, index):
+    """Decode the header (0) or claims (1) of a JWT, without verifying it.
+
+    Returns None if the token isn't a JWT.
+    """
+    try:
+        segments = str(token).split('.')
+        if len(segments) != 3:
+            return None
+        segment = segments[index] + '=' * (-len(segments[index]) % 4)
+        data = json.loads(base64.urlsafe_b64decode(segment))
+    except (TypeError, ValueError, UnicodeError):
+        return None
+    if not isinstance(data, dict):
+        return None
+    return data
+
+
+def _get_jwt_expiry(token):
+    """Get the expiry time from the claims in a JWT, without verifying it.
+
+    Returns None if the token isn't a JWT, or it has no expiry time.
+    """
+    claims = _decode_jwt_segment(token, 1)
+    try:
+        return float(claims['exp'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class _JWKSCache(object):
+    """A copy of the OAuth server's JWKS document, kept fresh.
+
+    The document is fetched when it's first needed, and is then refreshed
+    in a background thread whenever it's used after being cached for more
+    than `ttl` seconds.  If a token turns up that's signed with a key that
+    isn't in the document, it's fetched again right away, since the keys
+    have probably been rotated, but at most once every
+    JWKS_MIN_REFETCH_INTERVAL seconds.  Fetches are reported in the request
+    metrics as `tokenserver.oauth.jwks.fetch`.
+    """
+
+    def __init__(self, fetch, ttl):
+        self._fetch = fetch
+        self._ttl = ttl
+        self._keys = None
+        self._fetched_at = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _needs_fetch(self, kid):
+        if self._keys is None:
+            return True
+        if kid is None or kid in (key.get('kid') for key in self._keys):
+            return False
+        return time.time() - self._fetched_at >= JWKS_MIN_REFETCH_INTERVAL
+
+    def get_keys(self, kid=None):
+        """Get the list of keys, which should include the given key id."""
+        if self._needs_fetch(kid):
+            with self._lock:
+                # Another thread may have fetched it while we waited.
+                if self._needs_fetch(kid):
+                    self._refresh()
+        elif time.time() - self._fetched_at >= self._ttl:
+            self._refresh_in_background()
+        return self._keys
+
+    def _refresh(self):
+        annotate_request(None, 'tokenserver.oauth.jwks.fetch', 1)
+        self._keys = self._fetch().get('keys', [])
+        self._fetched_at = time.time()
+
+    def _refresh_in_background(self):
+        if self._refreshing:
+            return
+        self._refreshing = True
+        refresher = threading.Thread(target=self._run_refresh)
+        refresher.daemon = True
+        refresher.start()
+
+    def _run_refresh(self):
+        try:
+            with self._lock:
+                self._refresh()
+        except Exception:
+            logger.exception("Error while refreshing JWKS")
+        finally:
+            self._refreshing = False
+
+
+def _decode_assertion(assertion):
+    """Decode the payloads of the certificates in a BrowserID assertion,
+    followed by that of the assertion itself, without verifying them.
+
+    Raises ValueError if the assertion can't be parsed.
+    """
+    try:
+        certificates, assertion = unbundle_certs_and_assertion(assertion)
+        payloads = [decode_json_bytes(token.split('.')[1])
+                    for token in certificates + [assertion]]
+    except (AttributeError, IndexError, KeyError, TypeError, UnicodeError):
+        raise ValueError("Malformed assertion")
+    if len(payloads) < 2:
+        raise ValueError("Malformed assertion")
+    return payloads
+
+
+def _get_assertion_expiry(assertion):
+    """Get the time at which a BrowserID assertion expires, without verifying
+    it.  This is the earliest expiry time of the assertion and the
+    certificates bundled with it.
+
+    Returns None if the assertion can't be parsed.
+    """
+    try:
+        return min(payload['exp']
+                   for payload in _decode_assertion(assertion)) / 1000.0
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _prescreen_assertion(assertion, allowed_issuers):
+    """Reject a BrowserID assertion that's malformed, has expired, or is
+    from an issuer that isn't allowed, without verifying it.
+
+    Returns the payload of the assertion, for checking its audience.
+    """
+    try:
+        payloads = _decode_assertion(assertion)
+        expiry = min(payload['exp'] for payload in payloads) / 1000.0
+        issuer = payloads[0]['iss']
+        audience = payloads[-1]['aud']
+    except (KeyError, TypeError, ValueError):
+        raise InvalidSignatureError("Malformed assertion")
+    if not isinstance(audience, basestring):
+        raise InvalidSignatureError("Malformed assertion")
+    if expiry < time.time():
+        raise ExpiredSignatureError(expiry)
+    if allowed_issuers is not None and issuer not in allowed_issuers:
+        raise InvalidIssuerError("Issuer not allowed: %s" % (issuer,))
+    return payloads[-1]
+
+
+def _get_origin(url):
+    """Get the (scheme, host, port) of a URL, or None if it hasn't got one."""
+    try:
+        parsed = urlparse.urlparse(url)
+        port = parsed.port or {'http': 80, 'https': 443}.get(parsed.scheme)
+    except (AttributeError, TypeError, ValueError):
+        return None
+    if not parsed.scheme or not parsed.hostname:
+        return None
+    return (parsed.scheme, parsed.hostname, port)
+
+
 # This is to simplify the registering of the implementations using pyramid
 # registry.
 class IBrowserIdVerifier(Interface):
@@ -57,13 +409,17 @@ class IOAuthVerifier(Interface):
 class LocalBrowserIdVerifier(browserid.verifiers.local.LocalVerifier):
     implements(IBrowserIdVerifier)
 
-    def __init__(self, trusted_issuers=None, allowed_issuers=None, **kwargs):
+    def __init__(self, trusted_issuers=None, allowed_issuers=None,
+                 cache_size=1000, cache_ttl=300, **kwargs):
         """LocalVerifier constructor, with the following extra config options:
 
         :param ssl_certificate: The path to an optional ssl certificate to
             use when doing SSL requests with the BrowserID server.
             Set to True (the default) to use default certificate authorities.
             Set to False to disable SSL verification.
+        :param cache_size: The number of successfully-verified assertions
+            whose results are kept, until they expire or for at most
+            `cache_ttl` seconds.  Set to 0 to disable the cache.
         """
         if isinstance(trusted_issuers, basestring):
             trusted_issuers = trusted_issuers.split()
@@ -84,6 +440,12 @@ class LocalBrowserIdVerifier(browserid.verifiers.local.LocalVerifier):
         # Disable warning about evolving data formats, it's out of date.
         kwargs.setdefault("warning", False)
         super(LocalBrowserIdVerifier, self).__init__(**kwargs)
+        if int(cache_size) > 0:
+            self._cache = _VerificationCache(int(cache_size),
+                                             float(cache_ttl),
+                                             'tokenserver.assertion.cache')
+        else:
+            self._cache = None
 
     def _emit_warning():
         """Emit a scary warning to discourage unverified SSL access."""
@@ -96,13 +458,34 @@ class LocalBrowserIdVerifier(browserid.verifiers.local.LocalVerifier):
         warnings.warn(msg, RuntimeWarning, stacklevel=2)
 
     def verify(self, assertion, audience=None):
-        data = super(LocalBrowserIdVerifier, self).verify(assertion, audience)
+        if self._cache is None:
+            data = super(LocalBrowserIdVerifier, self).verify(assertion,
+                                                              audience)
+        else:
+            data = self._cache.get_or_verify(
+                (assertion, audience or ''),
+                lambda: super(LocalBrowserIdVerifier, self).verify(assertion,
+                                                                   audience),
+                _get_assertion_expiry(assertion))
+        # The issuer is checked after caching, so that changes to the
+        # allowed issuers apply to cached results too.
         if self.allowed_issuers is not None:
             issuer = data.get('issuer')
             if issuer not in self.allowed_issuers:
                 raise InvalidIssuerError("Issuer not allowed: %s" % (issuer,))
         return data
 
+    def prescreen(self, assertion, audience=None):
+        """Reject obviously bad assertions without verifying them.
+
+        This catches assertions that are malformed, have expired, are from
+        an issuer that isn't allowed, or are for the wrong audience, which
+        verify() would reject anyway, but only after fetching keys and
+        checking signatures.
+        """
+        _prescreen_assertion(assertion, self.allowed_issuers)
+        self.check_audience(assertion, audience)
+
 
 # A verifier that posts to a remote verifier service.
 # The RemoteVerifier implementation from PyBrowserID does its own parsing
@@ -113,7 +496,11 @@ class RemoteBrowserIdVerifier(object):
     implements(IBrowserIdVerifier)
 
     def __init__(self, audiences=None, trusted_issuers=None,
-                 allowed_issuers=None, verifier_url=None, timeout=None):
+                 allowed_issuers=None, verifier_url=None, timeout=None,
+                 cache_size=1000, cache_ttl=300, pool_size=10,
+                 connect_timeout=None, circuit_window=20,
+                 circuit_failure_rate=0.5, circuit_slow_call_time=None,
+                 circuit_reset_timeout=30):
         # Since we don't parse the assertion locally, we cannot support
         # list- or pattern-based audience strings.
         if audiences is not None:
@@ -131,13 +518,63 @@ class RemoteBrowserIdVerifier(object):
         if timeout is None:
             timeout = 30
         self.timeout = timeout
-        self.session = requests.Session()
+        if connect_timeout is not None:
+            self._request_timeout = (float(connect_timeout), float(timeout))
+        else:
+            self._request_timeout = timeout
+        self.session = _make_session(pool_size)
         self.session.verify = True
+        # Fail fast rather than tie up workers while the verifier is down.
+        self._breaker = _make_circuit_breaker(
+            self.verifier_url, (ConnectionError,), 'tokenserver.assertion',
+            circuit_window, circuit_failure_rate, circuit_slow_call_time,
+            circuit_reset_timeout)
+        # Clients often retry with the same assertion, so keep the results
+        # of successful verifications until the assertion expires.
+        if int(cache_size) > 0:
+            self._cache = _VerificationCache(int(cache_size),
+                                             float(cache_ttl),
+                                             'tokenserver.assertion.cache')
+        else:
+            self._cache = None
 
     def verify(self, assertion, audience=None):
         if audience is None:
             audience = self.audiences
+        if self._breaker is None:
+            verify = lambda: self._verify(assertion, audience)  # noqa
+        else:
+            verify = lambda: self._breaker.call(  # noqa
+                lambda: self._verify(assertion, audience))
+        if self._cache is None:
+            data = verify()
+        else:
+            data = self._cache.get_or_verify((assertion, audience or ''),
+                                             verify,
+                                             _get_assertion_expiry(assertion))
+        if self.allowed_issuers is not None:
+            issuer = data.get('issuer')
+            if issuer not in self.allowed_issuers:
+                raise InvalidIssuerError("Issuer not allowed: %s" % (issuer,))
+        return data
+
+    def prescreen(self, assertion, audience=None):
+        """Reject obviously bad assertions without sending them to the
+        verifier, as for LocalBrowserIdVerifier.prescreen().
+
+        The audience is only rejected if it's clearly a different origin,
+        leaving the verifier to decide about anything less clear-cut.
+        """
+        payload = _prescreen_assertion(assertion, self.allowed_issuers)
+        if audience is None:
+            audience = self.audiences
+        if audience is not None:
+            expected = _get_origin(audience)
+            actual = _get_origin(payload.get('aud'))
+            if expected is not None and expected != actual:
+                raise AudienceMismatchError(payload.get('aud'), audience)
 
+    def _verify(self, assertion, audience):
         body = {'assertion': assertion, 'audience': audience}
         if self.trusted_issuers is not None:
             body['trustedIssuers'] = self.trusted_issuers
@@ -146,7 +583,7 @@ class RemoteBrowserIdVerifier(object):
             response = self.session.post(self.verifier_url,
                                          data=json.dumps(body),
                                          headers=headers,
-                                         timeout=self.timeout)
+                                         timeout=self._request_timeout)
         except (socket.error, requests.RequestException) as e:
             msg = "Failed to POST %s. Reason: %s" % (self.verifier_url, str(e))
             raise ConnectionError(msg)
@@ -165,10 +602,6 @@ class RemoteBrowserIdVerifier(object):
             if "expired" in reason or "issued later than" in reason:
                 raise ExpiredSignatureError(reason)
             raise InvalidSignatureError(reason)
-        if self.allowed_issuers is not None:
-            issuer = data.get('issuer')
-            if issuer not in self.allowed_issuers:
-                raise InvalidIssuerError("Issuer not allowed: %s" % (issuer,))
         return data
 
 
@@ -184,18 +617,65 @@ class RemoteOAuthVerifier(object):
     the corresponding FxA BrowserID issuer.  For non-standard FxA hosting
     setups this might require it to dynamically discover the BrowserID
     issuer by querying the OAuth verifier's configuration.
+
+    Since clients re-use their tokens for many requests, the results of
+    verifying up to `cache_size` tokens are kept in memory until the token
+    expires, or for at most `cache_ttl` seconds.
+
+    JWT access tokens are verified locally using the keys in `jwks`, or if
+    `jwks_ttl` is set, in the OAuth server's JWKS document, which is kept
+    fresh as described in _JWKSCache.  Otherwise they're verified remotely,
+    fetching the document for every token, as are all other tokens.
+
+    Requests to the OAuth server go through a pool of up to `pool_size`
+    connections, and a circuit breaker as described in _CircuitBreaker.
+    Tokens verified locally don't go through the breaker.
     """
     implements(IOAuthVerifier)
 
     def __init__(self, server_url=None, default_issuer=None, timeout=30,
-                 scope=DEFAULT_OAUTH_SCOPE, jwks=None):
+                 scope=DEFAULT_OAUTH_SCOPE, jwks=None, cache_size=1000,
+                 cache_ttl=300, jwks_ttl=0, pool_size=10,
+                 connect_timeout=None, circuit_window=20,
+                 circuit_failure_rate=0.5, circuit_slow_call_time=None,
+                 circuit_reset_timeout=30):
         if not scope:
             raise ValueError('Expected a non-empty "scope" argument')
         if jwks is not None:
             jwks = json.loads(jwks).get('keys', [])
-        self._client = fxa.oauth.Client(server_url=server_url, jwks=jwks)
-
-        self._client.timeout = timeout
+            self._jwks = None
+        elif float(jwks_ttl) > 0:
+            # The client is given the latest keys before each verification.
+            jwks = []
+            self._jwks = _JWKSCache(self._fetch_jwks, float(jwks_ttl))
+        else:
+            self._jwks = None
+        # We cache the results ourselves, rather than having the client
+        # cache the tokens, so that the cache is bounded in size and can
+        # expire entries along with the token.
+        self._client = fxa.oauth.Client(server_url=server_url, jwks=jwks,
+                                        cache=None)
+        if int(cache_size) > 0:
+            self._cache = _VerificationCache(int(cache_size),
+                                             float(cache_ttl),
+                                             'tokenserver.oauth.cache')
+        else:
+            self._cache = None
+
+        self._client.apiclient = APIClient(self._client.server_url,
+                                           session=_make_session(pool_size))
+        self._timeout = timeout
+        if connect_timeout is not None:
+            self._client.apiclient.timeout = (float(connect_timeout),
+                                              float(timeout))
+        else:
+            self._client.apiclient.timeout = float(timeout)
+        self._breaker = _make_circuit_breaker(
+            self._client.server_url,
+            (ConnectionError, fxa.errors.ServerError,
+             fxa.errors.OutOfProtocolError),
+            'tokenserver.oauth', circuit_window, circuit_failure_rate,
+            circuit_slow_call_time, circuit_reset_timeout)
         if default_issuer is None:
             # This server_url will have been normalized to end in /v1.
             server_url = self._client.server_url
@@ -230,17 +710,69 @@ class RemoteOAuthVerifier(object):
     def server_url(self):
         return self._client.server_url
 
+    def _fetch_jwks(self):
+        return self._call_remote(lambda: self._client.apiclient.get('/jwks'))
+
+    def _call_remote(self, func, use_breaker=True):
+        """Call `func` to make a request to the OAuth server, converting
+        network errors into ConnectionError."""
+        def call():
+            try:
+                return func()
+            except (socket.error, requests.RequestException) as e:
+                msg = 'Verification request to %s failed; reason: %s'
+                msg %= (self.server_url, str(e))
+                raise ConnectionError(msg)
+        if self._breaker is None or not use_breaker:
+            return call()
+        return self._breaker.call(call)
+
     @property
     def timeout(self):
-        return self._client.timeout
+        return self._timeout
 
     def verify(self, token):
-        try:
-            userinfo = self._client.verify_token(token, self.scope)
-        except (socket.error, requests.RequestException) as e:
-            msg = 'Verification request to %s failed; reason: %s'
-            msg %= (self.server_url, str(e))
-            raise ConnectionError(msg)
+        if self._cache is None:
+            return self._verify(token)
+        return self._cache.get_or_verify(token, lambda: self._verify(token),
+                                         _get_jwt_expiry(token))
+
+    def prescreen(self, token):
+        """Reject obviously bad JWT access tokens without verifying them.
+
+        This catches tokens whose claims are malformed, that have expired,
+        or that don't grant the required scope, which verify() would reject
+        anyway, but only after checking the signature or asking the server.
+        Other tokens can only be checked by the server.
+        """
+        if _decode_jwt_segment(token, 0) is None:
+            return
+        claims = _decode_jwt_segment(token, 1)
+        if claims is None:
+            raise fxa.errors.TrustError({"error": "malformed token"})
+        expiry = _get_jwt_expiry(token)
+        if expiry is not None and expiry < time.time():
+            raise fxa.errors.TrustError({"error": "token has expired"})
+        scope = claims.get('scope')
+        if isinstance(scope, basestring):
+            if not scope_matches(scope.split(), self.scope):
+                raise fxa.errors.ScopeMismatchError(scope.split(), self.scope)
+
+    def _verify(self, token):
+        header = _decode_jwt_segment(token, 0)
+        if header is not None and self._jwks is not None:
+            self._client.jwks = self._jwks.get_keys(header.get('kid'))
+        verify = lambda: self._client.verify_token(token, self.scope)  # noqa
+        # If the client has no keys of its own then it fetches them from the
+        # server to verify a JWT, so that goes through the breaker too.
+        if header is not None and self._client.jwks:
+            annotate_request(None, 'tokenserver.oauth.verify_local', 1)
+            # Only a token signed with an unsupported kind of key is sent
+            # on to the server from here, so don't let it trip the breaker.
+            userinfo = self._call_remote(verify, use_breaker=False)
+        else:
+            annotate_request(None, 'tokenserver.oauth.verify_remote', 1)
+            userinfo = self._call_remote(verify)
         issuer = userinfo.get('issuer', self.default_issuer)
         if not issuer or not isinstance(issuer, basestring):
             msg = 'Could not determine issuer from verifier response'
@@ -14,6 +14,7 @@ from pyramid import httpexceptions
 import tokenlib
 
 from tokenserver.verifiers import (
+    CircuitOpenError,
     ComponentLookupError,
     ConnectionError,
     get_browserid_verifier,
@@ -169,12 +170,32 @@ def valid_authorization(request, **kwargs):
     request.validated['hashed_device_id'] = hashed_device_id
 
 
+def _prescreen(request, verifier, credentials, error_type, metric):
+    """Cheaply reject credentials that are obviously bad, before doing any
+    crypto or network work to verify them.
+
+    Rejections are counted in the request metrics under `metric`, and the
+    error is re-raised to be handled like any other verification failure.
+    """
+    # Custom verifier backends might not be able to pre-screen.
+    prescreen = getattr(verifier, 'prescreen', None)
+    if prescreen is None:
+        return
+    try:
+        prescreen(credentials)
+    except error_type:
+        request.metrics[metric] = 1
+        raise
+
+
 def _validate_browserid_assertion(request, assertion):
     try:
         verifier = get_browserid_verifier(request.registry)
     except ComponentLookupError:
         raise _unauthorized(description='Unsupported')
     try:
+        _prescreen(request, verifier, assertion, browserid.errors.Error,
+                   'token.assertion.prescreen_failure')
         with metrics_timer('tokenserver.assertion.verify', request):
             assertion = verifier.verify(assertion)
     except browserid.errors.Error as e:
@@ -184,8 +205,9 @@ def _validate_browserid_assertion(request, assertion):
         request.metrics['token.assertion.verify_failure'] = 1
         request.metrics['token.assertion.%s' % error_type] = 1
         # Log a full traceback for errors that are not a simple
-        # "your assertion was bad and we dont trust it".
-        if not isinstance(e, browserid.errors.TrustError):
+        # "your assertion was bad and we dont trust it", or a request
+        # that was failed fast because the verifier is unavailable.
+        if not isinstance(e, (browserid.errors.TrustError, CircuitOpenError)):
             logger.exception("Unexpected verification error")
         # Report an appropriate error code.
         if isinstance(e, browserid.errors.ConnectionError):
@@ -215,6 +237,8 @@ def _validate_oauth_token(request, token):
     except ComponentLookupError:
         raise _unauthorized(description='Unsupported')
     try:
+        _prescreen(request, verifier, token, fxa.errors.Error,
+                   'token.oauth.prescreen_failure')
         with metrics_timer('tokenserver.oauth.verify', request):
             token = verifier.verify(token)
     except (fxa.errors.Error, ConnectionError) as e:
@@ -223,7 +247,9 @@ def _validate_oauth_token(request, token):
             request.metrics['token.oauth.errno.%s' % e.errno] = 1
         # Log a full traceback for errors that are not a simple
         # "your token was bad and we dont trust it".
-        if not isinstance(e, fxa.errors.TrustError):
+        if isinstance(e, CircuitOpenError):
+            request.metrics['token.oauth.circuit_open_error'] = 1
+        elif not isinstance(e, fxa.errors.TrustError):
             if not isinstance(e, fxa.errors.InProtocolError):
                 logger.exception("Unexpected verification error")
             elif e.errno not in OAUTH_EXPECTED_ERRNOS:
@@ -366,16 +392,19 @@ def return_token(request):
     service = get_service_name(application, version)
     client_state = request.validated['client-state']
 
-    with metrics_timer('tokenserver.backend.get_user', request):
-        user = backend.get_user(service, email)
-    if not user:
-        allowed = settings.get('tokenserver.allow_new_users', True)
-        if not allowed:
+    allowed = settings.get('tokenserver.allow_new_users', True)
+    if allowed:
+        # Look up the user and allocate them a node if necessary,
+        # letting the backend do this in as few round-trips as it can.
+        # It reports the get_user and allocate_user timings itself.
+        user = backend.get_or_create_user(service, email, generation,
+                                          client_state,
+                                          keys_changed_at=keys_changed_at)
+    else:
+        with metrics_timer('tokenserver.backend.get_user', request):
+            user = backend.get_user(service, email)
+        if not user:
             raise _unauthorized('new-users-disabled')
-        with metrics_timer('tokenserver.backend.allocate_user', request):
-            user = backend.allocate_user(service, email, generation,
-                                         client_state,
-                                         keys_changed_at=keys_changed_at)
 
     # We now perform an elaborate set of consistency checks on the
     # provided claims, which we expect to behave as follows:
@@ -532,6 +561,29 @@ def get_lbheartbeat(request):
     return {}
 
 
+pool_status = Service(name="pool_status", path='/__pool__',
+                      description="Connection pool status")
+
+
+@pool_status.get()
+def get_pool_status(request):
+    """Return the state of this worker's database connection pools.
+
+    This is only available if the `tokenserver.pool_status_endpoint` setting
+    is enabled, and the assignment backend has connection pools to report on.
+    Each worker process has its own pools, so the worker's pid is included.
+    """
+    settings = request.registry.settings
+    if not settings.get('tokenserver.pool_status_endpoint', False):
+        raise httpexceptions.HTTPNotFound()
+    backend = request.registry.getUtility(INodeAssignment)
+    try:
+        get_status = backend.get_pool_status
+    except AttributeError:
+        raise httpexceptions.HTTPNotFound()
+    return {'pid': os.getpid(), 'pools': get_status()}
+
+
 version = Service(name="version", path='/__version__', description="Version")
 HERE = os.path.dirname(os.path.abspath(__file__))
 ORIGIN = os.path.dirname(os.path.dirname(HERE))